@@ -0,0 +1,112 @@
+"""
+Seeds a database with a reproducible synthetic dataset: users with categories, settled and planned
+transactions spread over past months, and messages. The same `--seed` always gives the same rows.
+
+    python -m benchmarks.dataset --db-url sqlite://bench.sqlite3 --users 100 --transactions 1000
+
+The database must be empty, tables are created if they don't exist.
+"""
+import argparse
+import random
+from datetime import datetime, timedelta, timezone
+from typing import NamedTuple, Optional
+
+from tortoise import Tortoise, run_async
+
+from db import rollup, checkpoints
+from db.models import User, Category, Transaction, Message
+from utils.authentication import get_password_hash
+import config
+
+
+PASSWORD = 'benchmark'
+ADMIN_USERNAME = 'benchmark-admin'
+
+
+class DatasetOptions(NamedTuple):
+    users: int = 20
+    categories: int = 10  #: per user
+    transactions: int = 500  #: settled transactions per user
+    planned: int = 20  #: planned, not yet settled transactions per user
+    messages: int = 50  #: per user
+    months: int = 12  #: settled transactions are created within this many past months
+    seed: int = 0
+
+
+class SeededUser(NamedTuple):
+    id: int
+    username: str
+    is_admin: bool
+    category_ids: list[int]
+    transaction_ids: list[int]
+
+
+async def init(db_url: str):
+    await Tortoise.init(db_url=db_url, modules={'models': ['db.models']})
+    await Tortoise.generate_schemas(safe=True)
+
+
+async def seed_user(rng: random.Random, username: str, password: str, options: DatasetOptions,
+                    now: datetime, is_admin: bool = False) -> SeededUser:
+    user = await User.create(username=username, password=password, email=f'{username}@example.com',
+                             is_admin=is_admin)
+    await Category.bulk_create([Category(name=f'Category {index}', user_id=user.id)
+                                for index in range(options.categories)])
+    category_ids = await Category.filter(user_id=user.id).order_by('id').values_list('id', flat=True)
+
+    period = timedelta(days=30 * options.months).total_seconds()
+    transactions, balance = [], 0.0
+    for number in range(1, options.transactions + 1):
+        type, total = rng.random() < 0.3, round(rng.uniform(1, 500), 2)
+        balance += total if type else -total
+        transactions.append(Transaction(number=number, sum=total, type=type, user_id=user.id,
+                                        category_id=rng.choice(category_ids),
+                                        created=now - timedelta(seconds=rng.uniform(0, period))))
+    for number in range(options.transactions + 1, options.transactions + options.planned + 1):
+        transactions.append(Transaction(number=number, sum=round(rng.uniform(1, 500), 2), type=rng.random() < 0.3,
+                                        user_id=user.id, category_id=rng.choice(category_ids), settled=False,
+                                        planned=(now + timedelta(days=rng.randint(1, 60))).date()))
+    await Transaction.bulk_create(transactions, batch_size=config.BULK_CREATE_BATCH_SIZE)
+    await Message.bulk_create([Message(receiver_id=user.id, text=f'Message {index}')
+                               for index in range(options.messages)], batch_size=config.BULK_CREATE_BATCH_SIZE)
+    await User.filter(id=user.id).update(balance=round(balance, 2), next_transaction_number=len(transactions) + 1)
+
+    transaction_ids = await Transaction.filter(user_id=user.id).order_by('id').values_list('id', flat=True)
+    return SeededUser(user.id, username, is_admin, category_ids, transaction_ids)
+
+
+async def seed(options: DatasetOptions, password: Optional[str] = None) -> list[SeededUser]:
+    """ Creates `options.users` users and one admin with the same dataset. Returns them admin last """
+    if await User.exists():
+        raise RuntimeError('Database is not empty, the benchmark dataset needs an empty one')
+    rng = random.Random(options.seed)
+    password = password or get_password_hash(PASSWORD)  #: hashed once, bcrypt would dominate seeding otherwise
+    now = datetime.now(timezone.utc)
+    users = [await seed_user(rng, f'benchmark-{index}', password, options, now) for index in range(options.users)]
+    users.append(await seed_user(rng, ADMIN_USERNAME, password, options, now, is_admin=True))
+    await rollup.rebuild()
+    await checkpoints.rebuild()
+    return users
+
+
+async def main(db_url: str, options: DatasetOptions):
+    await init(db_url)
+    started = datetime.now()
+    users = await seed(options)
+    rows = sum(len(user.transaction_ids) for user in users)
+    print(f'Seeded {len(users)} users and {rows} transactions in {datetime.now() - started}')
+    await Tortoise.close_connections()
+
+
+def add_arguments(parser: argparse.ArgumentParser):
+    defaults = DatasetOptions()
+    for name in DatasetOptions._fields:
+        parser.add_argument(f'--{name}', type=int, default=getattr(defaults, name))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--db-url', default='sqlite://benchmark.sqlite3', help='Tortoise database url')
+    add_arguments(parser)
+    args = parser.parse_args()
+    run_async(main(args.db_url, DatasetOptions(**{name: getattr(args, name) for name in DatasetOptions._fields})))
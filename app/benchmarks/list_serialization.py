@@ -0,0 +1,83 @@
+"""
+Compares two read paths of a transaction list page:
+
+* models - Tortoise models validated by TransactionList and rendered by JSONResponse (the old path)
+* values - `crud.paginate_values` dicts rendered by ORJSONResponse
+
+Run from the app directory with the usual environment variables set:
+
+    python -m benchmarks.list_serialization --rows 1000 --repeat 20
+"""
+import argparse
+import asyncio
+import time
+import tracemalloc
+
+from fastapi.encoders import jsonable_encoder
+from fastapi.responses import JSONResponse, ORJSONResponse
+from tortoise import Tortoise
+
+from db import crud
+from db.models import User, Category, Transaction
+from db.schema import TransactionList, Pagination
+
+
+async def setup(rows: int) -> User:
+    await Tortoise.init(db_url='sqlite://:memory:', modules={'models': ['db.models']})
+    await Tortoise.generate_schemas()
+    user = await User.create(username='benchmark', password='benchmark')
+    category = await Category.create(name='benchmark', user=user)
+    await Transaction.bulk_create([Transaction(number=index, sum=index, type=bool(index % 2), user=user,
+                                               category=category) for index in range(rows)], batch_size=1000)
+    return user
+
+
+async def models_path(user: User, pagination: Pagination) -> bytes:
+    instances, next_cursor = await crud.paginate(crud.get_instances_by_user_id(user.id, 'Transaction'), pagination)
+    response = TransactionList(user_id=user.id, username=user.username, transactions=instances,
+                               next_cursor=next_cursor)
+    return JSONResponse(jsonable_encoder(response)).body
+
+
+async def values_path(user: User, pagination: Pagination) -> bytes:
+    rows, next_cursor = await crud.paginate_values(crud.get_instances_by_user_id(user.id, 'Transaction'),
+                                                   pagination, 'Transaction')
+    return ORJSONResponse({'user_id': user.id, 'username': user.username, 'transactions': rows,
+                           'next_cursor': next_cursor}).body
+
+
+async def measure(path, user: User, pagination: Pagination, repeat: int) -> tuple[float, int]:
+    """ Returns seconds per call and peak of memory allocated during one call """
+    await path(user, pagination)
+    started = time.perf_counter()
+    for _ in range(repeat):
+        await path(user, pagination)
+    elapsed = (time.perf_counter() - started) / repeat
+
+    tracemalloc.start()
+    await path(user, pagination)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return elapsed, peak
+
+
+async def main(rows: int, repeat: int):
+    user = await setup(rows)
+    pagination = Pagination(limit=rows)
+    results = {}
+    for name, path in (('models', models_path), ('values', values_path)):
+        results[name] = await measure(path, user, pagination, repeat)
+        elapsed, peak = results[name]
+        print(f'{name:>6}: {elapsed * 1000:8.2f} ms/page  {elapsed / rows * 1e6:6.2f} us/row  '
+              f'peak {peak / 1024:8.0f} KiB')
+    print(f'values path is {results["models"][0] / results["values"][0]:.1f}x faster and uses '
+          f'{results["models"][1] / results["values"][1]:.1f}x less memory')
+    await Tortoise.close_connections()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--rows', type=int, default=1000, help='rows per page')
+    parser.add_argument('--repeat', type=int, default=20)
+    args = parser.parse_args()
+    asyncio.get_event_loop().run_until_complete(main(args.rows, args.repeat))
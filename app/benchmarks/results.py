@@ -0,0 +1,133 @@
+"""
+JSON result format of `benchmarks.load` and comparison of two runs:
+
+    python -m benchmarks.results baseline.json current.json --threshold 0.1
+
+Exits with status 1 if p95 latency of any router or endpoint grew, or its throughput dropped,
+by more than `threshold` of the baseline.
+
+Result layout (FORMAT_VERSION 1), latencies are in milliseconds:
+
+    {"format": 1, "created": "...", "environment": {"python", "platform", "database", "commit"},
+     "dataset": {DatasetOptions}, "load": {"requests", "auth_requests", "concurrency", "warmup", "seed"},
+     "routers": {"transactions": {"requests", "errors", "seconds", "throughput",
+                                  "latency": {"p50", "p95", "p99", "max"},
+                                  "endpoints": {"GET /transactions/all": {... same without "endpoints"}}}}}
+"""
+import argparse
+import json
+import platform
+import subprocess
+import sys
+from datetime import datetime, timezone
+from typing import Optional
+
+
+FORMAT_VERSION = 1
+
+
+def percentile(values: list[float], fraction: float) -> float:
+    """ Nearest-rank percentile of sorted `values` """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, max(0, round(fraction * len(values)) - 1))]
+
+
+def summarize(latencies: list[float], errors: int, seconds: float) -> dict:
+    """ `latencies` are in seconds """
+    latencies = sorted(latencies)
+    return {
+        'requests': len(latencies),
+        'errors': errors,
+        'seconds': round(seconds, 4),
+        'throughput': round(len(latencies) / seconds, 2) if seconds else 0.0,
+        'latency': {name: round(percentile(latencies, fraction) * 1000, 3)
+                    for name, fraction in (('p50', 0.5), ('p95', 0.95), ('p99', 0.99), ('max', 1))},
+    }
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def build(routers: dict, dataset: dict, load: dict, db_url: str) -> dict:
+    return {
+        'format': FORMAT_VERSION,
+        'created': datetime.now(timezone.utc).isoformat(),
+        'environment': {
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'database': db_url.split(':', 1)[0],  #: only the engine, the url may contain a password
+            'commit': _commit(),
+        },
+        'dataset': dataset,
+        'load': load,
+        'routers': routers,
+    }
+
+
+def save(result: dict, path: str):
+    with open(path, 'w') as file:
+        json.dump(result, file, indent=2)
+
+
+def load(path: str) -> dict:
+    with open(path) as file:
+        result = json.load(file)
+    if result.get('format') != FORMAT_VERSION:
+        raise ValueError(f'{path}: unsupported result format {result.get("format")}')
+    return result
+
+
+def _compare_stats(name: str, baseline: dict, current: dict, threshold: float) -> Optional[str]:
+    old_p95, new_p95 = baseline['latency']['p95'], current['latency']['p95']
+    if old_p95 and new_p95 > old_p95 * (1 + threshold):
+        return f'{name}: p95 {old_p95:.3f} -> {new_p95:.3f} ms'
+    if current['throughput'] < baseline['throughput'] * (1 - threshold):
+        return f'{name}: throughput {baseline["throughput"]:.1f} -> {current["throughput"]:.1f} req/s'
+    return None
+
+
+def compare(baseline: dict, current: dict, threshold: float = 0.1) -> list[str]:
+    """ Regressions of routers and endpoints present in both runs """
+    regressions = []
+    if baseline['dataset'] != current['dataset'] or baseline['load'] != current['load']:
+        regressions.append('runs used different dataset or load options, numbers are not comparable')
+    for router, old in baseline['routers'].items():
+        new = current['routers'].get(router)
+        if new is None:
+            continue
+        regressions.append(_compare_stats(router, old, new, threshold))
+        for endpoint, old_endpoint in old['endpoints'].items():
+            if endpoint in new['endpoints']:
+                regressions.append(_compare_stats(f'{router} {endpoint}', old_endpoint, new['endpoints'][endpoint],
+                                                  threshold))
+    return [regression for regression in regressions if regression]
+
+
+def print_table(result: dict):
+    rows = [(name, row) for router, stats in result['routers'].items()
+            for name, row in [(router, stats)] + [(f'  {endpoint}', endpoint_stats)
+                                                  for endpoint, endpoint_stats in stats['endpoints'].items()]]
+    width = max([64] + [len(name) for name, _ in rows])
+    print(f'{"":{width}} {"req/s":>9} {"p50 ms":>9} {"p95 ms":>9} {"p99 ms":>9} {"errors":>7}')
+    for name, row in rows:
+        latency = row['latency']
+        print(f'{name:{width}} {row["throughput"]:9.1f} {latency["p50"]:9.3f} {latency["p95"]:9.3f} '
+              f'{latency["p99"]:9.3f} {row["errors"]:7}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('baseline')
+    parser.add_argument('current')
+    parser.add_argument('--threshold', type=float, default=0.1, help='allowed relative change')
+    args = parser.parse_args()
+    found = compare(load(args.baseline), load(args.current), args.threshold)
+    for regression in found:
+        print(regression)
+    sys.exit(1 if found else 0)
@@ -0,0 +1,57 @@
+"""
+Boot time of a worker: imports `main` in fresh interpreters and, with --startup, runs its startup handlers
+against the configured database. Thresholds make it usable as a CI check:
+
+    STARTUP_MODE=production python -m benchmarks.startup --runs 5 --startup --max-import 2 --max-startup 1
+
+Prints the median of every timing as JSON and exits with status 1 if a threshold is exceeded.
+"""
+import argparse
+import json
+import statistics
+import subprocess
+import sys
+from pathlib import Path
+
+
+APP_DIR = Path(__file__).resolve().parent.parent
+
+#: Runs in the child. Timings go to stderr, stdout belongs to the logger
+CHILD = '''
+import asyncio, json, sys
+import main
+from utils.startup import timings
+if sys.argv[1] == 'startup':
+    loop = asyncio.get_event_loop()
+    loop.run_until_complete(main.app.router.startup())
+    loop.run_until_complete(main.app.router.shutdown())
+sys.stderr.write('\\n' + json.dumps(timings))
+'''
+
+
+def measure(startup: bool) -> dict:
+    process = subprocess.run([sys.executable, '-c', CHILD, 'startup' if startup else 'import'], cwd=APP_DIR,
+                             stdout=subprocess.DEVNULL, stderr=subprocess.PIPE, text=True)
+    if process.returncode:
+        raise RuntimeError(f'Worker failed to boot:\n{process.stderr}')
+    return json.loads(process.stderr.strip().splitlines()[-1])
+
+
+def main(runs: int, startup: bool, limits: dict) -> int:
+    samples = [measure(startup) for _ in range(runs)]
+    result = {name: round(statistics.median(sample[name] for sample in samples), 3) for name in samples[0]}
+    print(json.dumps(result))
+    exceeded = [name for name, limit in limits.items() if limit is not None and result.get(name, 0) > limit]
+    for name in exceeded:
+        print(f'{name} {result[name]}s is over the limit of {limits[name]}s', file=sys.stderr)
+    return 1 if exceeded else 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--runs', type=int, default=5)
+    parser.add_argument('--startup', action='store_true', help='also run startup handlers, needs the database')
+    parser.add_argument('--max-import', type=float, help='seconds')
+    parser.add_argument('--max-startup', type=float, help='seconds')
+    args = parser.parse_args()
+    sys.exit(main(args.runs, args.startup, {'import': args.max_import, 'startup': args.max_startup}))
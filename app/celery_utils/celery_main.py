@@ -1,9 +1,15 @@
+import asyncio
+
 from celery import Celery
 from celery.schedules import crontab
+from tortoise import Tortoise
 
-from db.models import Transaction, Message
+from db.crud import settle_planned_transactions
+from db import checkpoints
+from db.models import Transaction
+from utils.database import TORTOISE_ORM
 from utils.send_mail import send_email
-from config import MAIL_FROM
+from config import SETTLEMENT_CHUNK_SIZE, CHECKPOINT_CHUNK_SIZE, CHECKPOINT_WORKERS
 
 from datetime import date
 
@@ -19,28 +25,33 @@ def setup_periodic_tasks(sender, **kwargs):
         crontab(hour='1', minute=0),
         check_transaction_planned_date
     )
+    sender.add_periodic_task(
+        crontab(day_of_month='1', hour='0', minute=30),
+        create_balance_checkpoints
+    )
+
+
+@app.task
+def check_transaction_planned_date() -> int:
+    """ Celery does not await coroutines, so the settlement runs on the worker event loop """
+    return asyncio.get_event_loop().run_until_complete(settle_due_transactions())
+
+
+async def settle_due_transactions() -> int:
+    if Transaction._meta.default_connection is None:  # worker process has not bound models to the DB yet
+        await Tortoise.init(config=TORTOISE_ORM)
+    settled, emails = await settle_planned_transactions(date.today(), SETTLEMENT_CHUNK_SIZE)
+    for email in emails:
+        await send_email('BudgetApi', email)
+    return settled
 
 
 @app.task
-async def check_transaction_planned_date():
-    today = date.today()
-    instances = await Transaction.filter(planned=today)
-    for instance in instances:
-        await instance.fetch_related('user')
-        user = instance.user
-        if instance.type:
-            user.balance += instance.sum
-        else:
-            user.balance -= instance.sum
-        await user.save()
-
-        if user.fixed_balance and user.balance >= user.fixed_balance:
-            await Message.create(receiver=user,
-                                 text='You have reached your balance')
-
-        if user.email:
-            await send_email('BudgetApi', MAIL_FROM)
-        else:
-            text = f'Your transaction №{instance.number} has been added to balance'
-            await Message.create(receiver=user,
-                                 text=text)
+def create_balance_checkpoints() -> int:
+    return asyncio.get_event_loop().run_until_complete(add_month_checkpoints())
+
+
+async def add_month_checkpoints() -> int:
+    if Transaction._meta.default_connection is None:
+        await Tortoise.init(config=TORTOISE_ORM)
+    return await checkpoints.add_checkpoints(chunk_size=CHECKPOINT_CHUNK_SIZE, workers=CHECKPOINT_WORKERS)
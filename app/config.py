@@ -8,6 +8,18 @@ DB_NAME = env.str('DB_NAME')
 DB_PASSWORD = env.str('DB_PASSWORD')
 DB_HOST = env.str('DB_HOST')
 DB_USER = env.str('DB_USER')
+DB_PORT = env.int('DB_PORT', 5432)
+DB_POOL_MIN_SIZE = env.int('DB_POOL_MIN_SIZE', 1)
+DB_POOL_MAX_SIZE = env.int('DB_POOL_MAX_SIZE', 5)
+DB_STATEMENT_CACHE_SIZE = env.int('DB_STATEMENT_CACHE_SIZE', 100)  #: prepared statements per connection, 0 disables
+
+DB_REPLICA_HOST = env.str('DB_REPLICA_HOST', '')  #: reads of GET requests go to this host if it's set
+DB_REPLICA_PORT = env.int('DB_REPLICA_PORT', DB_PORT)
+DB_REPLICA_NAME = env.str('DB_REPLICA_NAME', DB_NAME)
+DB_REPLICA_POOL_MIN_SIZE = env.int('DB_REPLICA_POOL_MIN_SIZE', DB_POOL_MIN_SIZE)
+DB_REPLICA_POOL_MAX_SIZE = env.int('DB_REPLICA_POOL_MAX_SIZE', DB_POOL_MAX_SIZE)
+REPLICA_STICKY_SECONDS = env.float('REPLICA_STICKY_SECONDS', 5)  #: reads of a user stay on primary after their write
+REPLICA_WRITE_TRACK_SIZE = env.int('REPLICA_WRITE_TRACK_SIZE', 10000)  #: recent writers kept before expired ones are dropped
 
 MAIL_USERNAME = env.str('MAIL_USERNAME')
 MAIL_PASSWORD = env.str('MAIL_PASSWORD')
@@ -19,3 +31,50 @@ MAIL_FROM_NAME = env.str('MAIL_FROM_NAME')
 ADMIN_USERNAME = env.str('ADMIN_USERNAME')
 ADMIN_EMAIL = env.str('ADMIN_EMAIL')
 ADMIN_PASSWORD = env.str('ADMIN_PASSWORD')
+
+STARTUP_MODE = env.str('STARTUP_MODE', 'development')  #: production - check migrations instead of generating schemas
+
+PAGE_SIZE = env.int('PAGE_SIZE', 100)
+MAX_PAGE_SIZE = env.int('MAX_PAGE_SIZE', 1000)
+EXPORT_CHUNK_SIZE = env.int('EXPORT_CHUNK_SIZE', 1000)
+
+TIMELINE_DEFAULT_DAYS = env.int('TIMELINE_DEFAULT_DAYS', 365)  #: history of the timeline when "from" is not given
+TIMELINE_MAX_DAYS = env.int('TIMELINE_MAX_DAYS', 20 * 366)
+FORECAST_HISTORY_MONTHS = env.int('FORECAST_HISTORY_MONTHS', 24)  #: complete months the forecast is fitted on
+FORECAST_MAX_MONTHS = env.int('FORECAST_MAX_MONTHS', 24)
+
+AUTH_CACHE_SIZE = env.int('AUTH_CACHE_SIZE', 10000)
+AUTH_CACHE_TTL = env.int('AUTH_CACHE_TTL', 60)  #: seconds, 0 disables the cache
+
+PASSWORD_HASH_WORKERS = env.int('PASSWORD_HASH_WORKERS', 4)  #: bcrypt calls allowed to run at the same time
+
+BULK_CREATE_MAX_ITEMS = env.int('BULK_CREATE_MAX_ITEMS', 10000)
+BULK_CREATE_BATCH_SIZE = env.int('BULK_CREATE_BATCH_SIZE', 1000)
+
+SETTLEMENT_CHUNK_SIZE = env.int('SETTLEMENT_CHUNK_SIZE', 1000)
+CHECKPOINT_CHUNK_SIZE = env.int('CHECKPOINT_CHUNK_SIZE', 1000)  #: users per DB transaction of the monthly checkpoint job
+CHECKPOINT_WORKERS = env.int('CHECKPOINT_WORKERS', 4)  #: chunks processed concurrently
+
+MAIL_TLS = env.bool('MAIL_TLS', True)  #: STARTTLS after connecting
+MAIL_SSL = env.bool('MAIL_SSL', False)
+MAIL_POOL_SIZE = env.int('MAIL_POOL_SIZE', 10)  #: persistent SMTP connections, also the number of concurrent sends
+MAIL_RATE_LIMIT = env.float('MAIL_RATE_LIMIT', 500)  #: messages per second, 0 disables the limit
+MAIL_CHUNK_SIZE = env.int('MAIL_CHUNK_SIZE', 1000)  #: recipients fetched from DB at a time
+
+PUBSUB_BACKEND = env.str('PUBSUB_BACKEND', 'memory')  #: memory - single process, postgres - LISTEN/NOTIFY between workers
+MESSAGE_STREAM_KEEPALIVE = env.int('MESSAGE_STREAM_KEEPALIVE', 15)  #: seconds between SSE keepalive comments
+
+RATE_LIMIT_BACKEND = env.str('RATE_LIMIT_BACKEND', 'memory')  #: memory - per worker, postgres - shared by workers
+RATE_LIMIT_READ = env.float('RATE_LIMIT_READ', 50)  #: GET requests per second per user, 0 disables the limit
+RATE_LIMIT_READ_BURST = env.int('RATE_LIMIT_READ_BURST', 100)
+RATE_LIMIT_WRITE = env.float('RATE_LIMIT_WRITE', 10)  #: other requests per second per user
+RATE_LIMIT_WRITE_BURST = env.int('RATE_LIMIT_WRITE_BURST', 50)
+
+SHED_MAX_IN_FLIGHT = env.int('SHED_MAX_IN_FLIGHT', 0)  #: requests in progress before answering 503, 0 disables
+SHED_MAX_POOL_WAIT = env.float('SHED_MAX_POOL_WAIT', 0)  #: seconds of average DB connection wait, 0 disables
+SHED_RETRY_AFTER = env.int('SHED_RETRY_AFTER', 1)  #: seconds
+
+LOG_FILE = env.str('LOG_FILE', 'app.log')
+LOG_MAX_BYTES = env.int('LOG_MAX_BYTES', 10 * 1024 * 1024)  #: size rotation threshold
+LOG_BACKUP_COUNT = env.int('LOG_BACKUP_COUNT', 10)  #: gzipped rotated files to keep
+LOG_ROTATE_WHEN = env.str('LOG_ROTATE_WHEN', '')  #: e.g. "midnight" rotates by time instead of size
@@ -0,0 +1,33 @@
+"""
+Helpers of the maintenance jobs in db.rollup and db.checkpoints, which process users by id ranges
+"""
+import asyncio
+from datetime import date, datetime
+from typing import Awaitable, Callable, Optional
+
+from .models import User
+
+
+def to_date(value) -> Optional[date]:
+    """ Date of a TruncDate bucket, sqlite returns it as a string and Postgres as a datetime """
+    if isinstance(value, str):
+        return date.fromisoformat(value[:10])
+    return value.date() if isinstance(value, datetime) else value
+
+
+async def lock_users(first_id: int, last_id: int):
+    # Locked users can't create or change transactions until the range is done
+    await User.filter(id__gte=first_id, id__lte=last_id).select_for_update().only('id')
+
+
+async def run_chunks(function: Callable[[int, int], Awaitable], chunk_size: int, workers: int) -> list:
+    """ Calls `function(first_id, last_id)` for chunks of `chunk_size` users, `workers` chunks at a time """
+    user_ids = await User.all().order_by('id').values_list('id', flat=True)
+    semaphore = asyncio.Semaphore(workers)
+
+    async def run_chunk(chunk: list[int]):
+        async with semaphore:
+            return await function(chunk[0], chunk[-1])
+
+    return await asyncio.gather(*(run_chunk(user_ids[index:index + chunk_size])
+                                  for index in range(0, len(user_ids), chunk_size)))
@@ -0,0 +1,149 @@
+"""
+Balance checkpoints at the start of every month which follows a month with settled transactions.
+
+    python -m db.checkpoints --check --chunk-size 1000 --workers 4
+    python -m db.checkpoints --chunk-size 1000 --workers 4
+
+--check recomputes checkpoints from transactions and reports the stored ones which differ,
+without it checkpoints are rebuilt. Users are split into id ranges, every range is computed
+in its own DB transaction by one GROUP BY query and ranges are processed concurrently.
+"""
+import argparse
+from bisect import bisect_left
+from datetime import date, datetime, timedelta
+from itertools import accumulate
+from typing import NamedTuple, Optional
+
+from tortoise import Tortoise, run_async, timezone
+from tortoise.functions import Sum
+from tortoise.transactions import in_transaction
+
+from .batch import lock_users, run_chunks, to_date
+from .crud import effective_between, get_balance_at
+from .models import Transaction, BalanceCheckpoint
+from .functions import TruncDate
+from utils.timeline import month_start
+import config
+
+
+class Mismatch(NamedTuple):
+    user_id: int
+    date: date
+    stored: float
+    expected: float
+
+
+async def monthly_totals(first_id: int, last_id: int) -> dict[int, tuple[list[date], list[float]]]:
+    """ Month starts with settled transactions and balances at the start of the following months, per user.
+        Months are local like in `effective_date` (see TruncDate) """
+    rows = await Transaction.filter(user_id__gte=first_id, user_id__lte=last_id, settled=True).annotate(
+        created_month=TruncDate('created', 'month'), planned_month=TruncDate('planned', 'month'), total=Sum('sum')
+    ).group_by('user_id', 'created_month', 'planned_month', 'type').values(
+        'user_id', 'created_month', 'planned_month', 'type', 'total'
+    )
+    nets = {}
+    for row in rows:
+        month = to_date(row['planned_month']) or to_date(row['created_month'])
+        user_nets = nets.setdefault(row['user_id'], {})
+        user_nets[month] = user_nets.get(month, 0) + (row['total'] if row['type'] else -row['total'])
+    return {user_id: (sorted(user_nets), list(accumulate(user_nets[month] for month in sorted(user_nets))))
+            for user_id, user_nets in nets.items()}
+
+
+def expected_balance(months: list[date], balances: list[float], day: date) -> float:
+    """ Balance at the start of `day` from `monthly_totals`, `day` is a month start """
+    index = bisect_left(months, day)
+    return balances[index - 1] if index else 0
+
+
+async def rebuild_users(first_id: int, last_id: int, until: date) -> int:
+    """ Replaces checkpoints of users with ids in [first_id, last_id] by ones computed from transactions,
+        up to the month start `until`. Returns number of checkpoints """
+    async with in_transaction(BalanceCheckpoint._meta.default_connection):
+        await lock_users(first_id, last_id)
+        await BalanceCheckpoint.filter(user_id__gte=first_id, user_id__lte=last_id).delete()
+        checkpoints = [BalanceCheckpoint(user_id=user_id, date=month_start(month, 1), balance=balance)
+                       for user_id, (months, balances) in (await monthly_totals(first_id, last_id)).items()
+                       for month, balance in zip(months, balances) if month_start(month, 1) <= until]
+        await BalanceCheckpoint.bulk_create(checkpoints, batch_size=config.BULK_CREATE_BATCH_SIZE)
+    return len(checkpoints)
+
+
+async def check_users(first_id: int, last_id: int) -> list[Mismatch]:
+    """ Stored checkpoints of users with ids in [first_id, last_id] which differ from transactions """
+    async with in_transaction(BalanceCheckpoint._meta.default_connection):
+        await lock_users(first_id, last_id)
+        totals = await monthly_totals(first_id, last_id)
+        stored = await BalanceCheckpoint.filter(user_id__gte=first_id, user_id__lte=last_id).values_list(
+            'user_id', 'date', 'balance')
+    mismatches = []
+    for user_id, day, balance in stored:
+        expected = expected_balance(*totals.get(user_id, ([], [])), day)
+        if abs(balance - expected) > 1e-6 * max(1.0, abs(expected)):
+            mismatches.append(Mismatch(user_id, day, balance, expected))
+    return mismatches
+
+
+async def add_users(first_id: int, last_id: int, day: date) -> int:
+    """ Adds checkpoints at `day` for users with ids in [first_id, last_id] who have settled transactions
+        in the month before it, each from the previous checkpoint. Returns number of checkpoints """
+    async with in_transaction(BalanceCheckpoint._meta.default_connection):
+        await lock_users(first_id, last_id)
+        user_ids = await Transaction.filter(
+            effective_between(month_start(day, -1), day), user_id__gte=first_id, user_id__lte=last_id, settled=True
+        ).distinct().values_list('user_id', flat=True)
+        existing = set(await BalanceCheckpoint.filter(user_id__in=user_ids, date=day).values_list('user_id', flat=True))
+        checkpoints = []
+        for user_id in sorted(set(user_ids) - existing):
+            balance, _ = await get_balance_at(user_id, day - timedelta(days=1))
+            checkpoints.append(BalanceCheckpoint(user_id=user_id, date=day, balance=balance))
+        await BalanceCheckpoint.bulk_create(checkpoints, batch_size=config.BULK_CREATE_BATCH_SIZE)
+    return len(checkpoints)
+
+
+def _current_month() -> date:
+    return month_start(timezone.localtime(timezone.now()).date())
+
+
+async def rebuild(chunk_size: int = 1000, workers: int = 4) -> int:
+    """ Rebuilds checkpoints of all users up to the current month. Returns number of checkpoints """
+    until = _current_month()
+    return sum(await run_chunks(lambda first_id, last_id: rebuild_users(first_id, last_id, until),
+                                chunk_size, workers))
+
+
+async def check(chunk_size: int = 1000, workers: int = 4) -> list[Mismatch]:
+    """ Recomputes checkpoints of all users from transactions. Returns stored checkpoints which differ """
+    return [mismatch for mismatches in await run_chunks(check_users, chunk_size, workers)
+            for mismatch in mismatches]
+
+
+async def add_checkpoints(day: Optional[date] = None, chunk_size: int = 1000, workers: int = 4) -> int:
+    """ Monthly job, adds checkpoints at the start of the current month. Returns number of checkpoints """
+    day = day or _current_month()
+    return sum(await run_chunks(lambda first_id, last_id: add_users(first_id, last_id, day), chunk_size, workers))
+
+
+async def main(check_only: bool, chunk_size: int, workers: int):
+    from utils.database import TORTOISE_ORM
+
+    await Tortoise.init(config=TORTOISE_ORM)
+    started = datetime.now()
+    if check_only:
+        mismatches = await check(chunk_size, workers)
+        for mismatch in mismatches:
+            print(f'user {mismatch.user_id} at {mismatch.date}: stored {mismatch.stored}, '
+                  f'expected {mismatch.expected}')
+        print(f'Checked in {datetime.now() - started}, {len(mismatches)} checkpoints differ')
+    else:
+        rows = await rebuild(chunk_size, workers)
+        print(f'Rebuilt {rows} balance checkpoints in {datetime.now() - started}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Check or rebuild balance checkpoints')
+    parser.add_argument('--check', action='store_true', help='only report checkpoints which differ')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='users per DB transaction')
+    parser.add_argument('--workers', type=int, default=4, help='chunks processed concurrently')
+    args = parser.parse_args()
+    run_async(main(args.check, args.chunk_size, args.workers))
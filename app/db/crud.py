@@ -1,29 +1,274 @@
-from .models import User, Category, Transaction
+from .models import User, Category, Transaction, Message, TransactionRollup, BalanceCheckpoint
+from .functions import TruncDate, LocalDate, EpochDay
 from db import schema
+from utils.pubsub import hub
+from utils.conditional import DataVersion
+import config
 
-from typing import Optional, Union
+from tortoise.queryset import QuerySet
+from tortoise.query_utils import Q
+from tortoise.functions import Sum, Count
+from tortoise.expressions import F
+from tortoise.transactions import in_transaction
+from tortoise import timezone
+
+from typing import Optional, Union, AsyncIterator
+from datetime import datetime, date, timedelta
+import base64
 
 
 models = {
     'Category': Category,
     'User': User,
-    'Transaction': Transaction
+    'Transaction': Transaction,
+    'Message': Message
+}
+
+#: Columns of list responses, in the order of the pydantic schemas
+response_fields = {
+    'Category': ('id', 'name', 'created'),
+    'Transaction': ('id', 'number', 'sum', 'type', 'planned', 'settled', 'created', 'category_id'),
+    'Message': ('id', 'text', 'created')
 }
 
 
+def data_version_bump() -> dict:
+    """ Update kwargs for User which mark data of the user as changed """
+    return {'data_version': F('data_version') + 1, 'data_modified': timezone.now()}
+
+
+async def touch_user(user_id: int):
+    await User.filter(id=user_id).update(**data_version_bump())
+
+
+def _owner_id(instance: Union[User, Category, Transaction, Message]) -> int:
+    if isinstance(instance, User):
+        return instance.id
+    if isinstance(instance, Message):
+        return instance.receiver_id
+    return instance.user_id
+
+
+async def get_data_version(user_id: int) -> DataVersion:
+    rows = await User.filter(id=user_id).values_list('data_version', 'data_modified')
+    version, modified = rows[0] if rows else (0, None)
+    return DataVersion(user_id, version, modified)
+
+
 async def create_instance(data: dict, model_name: str) -> Union[User, Category, Transaction]:
     model = models[model_name]
     instance = await model.create(**data)
+    if 'user_id' in data:
+        await touch_user(data['user_id'])
     return instance
 
 
+async def reserve_transaction_numbers(user_id: int, count: int = 1, balance_delta: float = 0) -> tuple[int, float]:
+    """ Bumps the user counter by `count` and applies the balance delta with one UPDATE.
+        Must run inside a DB transaction: the updated row stays locked until commit,
+        so concurrent callers never get the same numbers.
+        Returns the first reserved number and the new balance """
+    await User.filter(id=user_id).update(next_transaction_number=F('next_transaction_number') + count,
+                                         balance=F('balance') + balance_delta, **data_version_bump())
+    (next_number, balance), = await User.filter(id=user_id).values_list('next_transaction_number', 'balance')
+    return next_number - count, balance
+
+
+async def lock_user(user_id: int):
+    """ Row lock on the user serializes balance and rollup writes of the user until commit """
+    await User.filter(id=user_id).select_for_update().only('id')
+
+
+def _rollup_key(transaction: Transaction) -> tuple[int, int, int, int, bool]:
+    created = transaction.created
+    created = timezone.localtime(created) if timezone.is_aware(created) else created
+    return transaction.user_id, transaction.category_id, created.year, created.month, transaction.type
+
+
+async def update_rollup(transactions: list[Transaction], sign: int = 1):
+    """ Adds (sign=1) or subtracts (sign=-1) settled transactions to/from TransactionRollup.
+        Must run inside a DB transaction which has locked the users (see lock_user) """
+    totals = {}
+    for transaction in transactions:
+        if transaction.settled:
+            total = totals.setdefault(_rollup_key(transaction), [0, 0])
+            total[0] += transaction.sum
+            total[1] += 1
+    for (user_id, category_id, year, month, type), (total, count) in totals.items():
+        key = {'user_id': user_id, 'category_id': category_id, 'year': year, 'month': month, 'type': type}
+        updated = await TransactionRollup.filter(**key).update(sum=F('sum') + sign * total,
+                                                               count=F('count') + sign * count)
+        if not updated:
+            await TransactionRollup.create(**key, sum=sign * total, count=sign * count)
+        elif sign < 0:
+            await TransactionRollup.filter(**key, count__lte=0).delete()
+
+
+async def update_balances(transactions: list[Transaction], sign: int = 1):
+    """ Adds (sign=1) or subtracts (sign=-1) settled transactions to/from User.balance.
+        Must run inside a DB transaction which has locked the users (see lock_user) """
+    deltas = {}
+    for transaction in transactions:
+        if transaction.settled:
+            delta = transaction.sum if transaction.type else -transaction.sum
+            deltas[transaction.user_id] = deltas.get(transaction.user_id, 0) + sign * delta
+    for user_id, delta in sorted(deltas.items()):
+        await User.filter(id=user_id).update(balance=F('balance') + delta)
+
+
+def effective_date(transaction: Transaction) -> date:
+    """ Day the transaction counts in the balance from, see BalanceCheckpoint """
+    if transaction.planned:
+        return transaction.planned
+    created = transaction.created
+    return (timezone.localtime(created) if timezone.is_aware(created) else created).date()
+
+
+def effective_ranges(start: Optional[date], end: Optional[date]) -> tuple[dict, dict]:
+    """ Filters of regular and of planned transactions effective in [start, end), None is an open bound """
+    regular, planned = {'planned__isnull': True}, {}
+    if start:
+        regular['created__gte'] = timezone.make_aware(datetime.combine(start, datetime.min.time()))
+        planned['planned__gte'] = start
+    if end:
+        regular['created__lt'] = timezone.make_aware(datetime.combine(end, datetime.min.time()))
+        planned['planned__lt'] = end
+    return regular, planned
+
+
+def effective_between(start: Optional[date], end: date) -> Q:
+    """ Transactions effective in [start, end), start None is an open bound """
+    regular, planned = effective_ranges(start, end)
+    return Q(**regular) | Q(**planned)
+
+
+async def update_checkpoints(transactions: list[Transaction], sign: int = 1):
+    """ Adds (sign=1) or subtracts (sign=-1) settled transactions to/from balance checkpoints after their day.
+        Must run inside a DB transaction which has locked the users (see lock_user) """
+    today = timezone.localtime(timezone.now()).date()
+    deltas = {}
+    for transaction in transactions:
+        day = effective_date(transaction)
+        if transaction.settled and day < today:  # checkpoints are never later than today
+            key = (transaction.user_id, day)
+            deltas[key] = deltas.get(key, 0) + sign * (transaction.sum if transaction.type else -transaction.sum)
+    for (user_id, day), delta in deltas.items():
+        await BalanceCheckpoint.filter(user_id=user_id, date__gt=day).update(balance=F('balance') + delta)
+
+
+async def get_balance_delta(user_id: int, start: Optional[date], end: date) -> float:
+    """ Sum of settled transactions effective in [start, end). Regular and planned transactions are summed
+        separately: an OR of both ranges can't use either index and scans every transaction of the user """
+    totals = []
+    for effective in effective_ranges(start, end):
+        totals += await Transaction.filter(user_id=user_id, settled=True, **effective).annotate(
+            total=Sum('sum')).group_by('type').values_list('type', 'total')
+    return sum(total if type else -total for type, total in totals)
+
+
+async def get_balance_at(user_id: int, day: date) -> tuple[float, Optional[date]]:
+    """ Balance at the end of `day` from the nearest checkpoint and transactions effective after it.
+        Returns the balance and the date of the checkpoint, None if there was none """
+    end = day + timedelta(days=1)
+    rows = await BalanceCheckpoint.filter(user_id=user_id, date__lte=end).order_by('-date').limit(1).values_list(
+        'date', 'balance')
+    start, balance = rows[0] if rows else (None, 0)
+    return balance + await get_balance_delta(user_id, start, end), start
+
+
+async def create_transaction(data: dict, user_id: int) -> tuple[Transaction, Optional[float]]:
+    """ Inserts the transaction and applies its sum to the user balance atomically.
+        Returns the transaction and the new balance, balance is None for planned transactions """
+    planned = bool(data.get('planned'))  #: Planned transaction will be added to balance later
+    delta = 0 if planned else (data['sum'] if data['type'] else -data['sum'])
+    async with in_transaction(Transaction._meta.default_connection):
+        data['number'], balance = await reserve_transaction_numbers(user_id, balance_delta=delta)
+        instance = await Transaction.create(**data, user_id=user_id, settled=not planned)
+        await update_rollup([instance])
+        await update_checkpoints([instance])
+    return instance, None if planned else balance
+
+
+async def bulk_create_transactions(items: list[dict], user_id: int) -> tuple[int, float]:
+    """ Inserts all items with a contiguous block of numbers and applies one aggregated
+        balance delta in a single DB transaction. Returns the first number and the new balance """
+    delta = sum(item['sum'] if item['type'] else -item['sum'] for item in items if not item.get('planned'))
+    async with in_transaction(Transaction._meta.default_connection):
+        first_number, balance = await reserve_transaction_numbers(user_id, len(items), delta)
+        instances = [Transaction(**item, number=first_number + index, user_id=user_id, settled=not item.get('planned'))
+                     for index, item in enumerate(items)]
+        await Transaction.bulk_create(instances, batch_size=config.BULK_CREATE_BATCH_SIZE)
+        await update_rollup(instances)
+        await update_checkpoints(instances)
+    return first_number, balance
+
+
+async def settle_planned_transactions(day: date, chunk_size: int) -> tuple[int, set[str]]:
+    """
+    Adds planned transactions due by `day` to balances. Every chunk is one DB transaction:
+    due rows are locked (skipping rows another worker holds), per-user deltas are summed by the database,
+    each user gets one UPDATE and notification messages are inserted with bulk_create.
+    Returns number of settled transactions and emails of users to notify.
+    """
+    settled, emails = 0, set()
+    while True:
+        async with in_transaction(Transaction._meta.default_connection):
+            instances = await Transaction.filter(settled=False, planned__lte=day).order_by('id').limit(
+                chunk_size).select_for_update(skip_locked=True).only(
+                'id', 'user_id', 'number', 'category_id', 'created', 'planned', 'type', 'sum', 'settled')
+            if not instances:
+                return settled, emails
+            ids = [instance.id for instance in instances]
+            totals = await Transaction.filter(id__in=ids).annotate(total=Sum('sum')).group_by(
+                'user_id', 'type').values('user_id', 'type', 'total')
+            deltas = {}
+            for row in totals:
+                deltas[row['user_id']] = deltas.get(row['user_id'], 0) + (row['total'] if row['type'] else -row['total'])
+            for user_id, delta in sorted(deltas.items()):  #: users are locked in id order, workers never deadlock
+                await User.filter(id=user_id).update(balance=F('balance') + delta, **data_version_bump())
+            await Transaction.filter(id__in=ids).update(settled=True)
+            for instance in instances:
+                instance.settled = True
+            await update_rollup(instances)
+            await update_checkpoints(instances)
+
+            users = {user['id']: user for user in await User.filter(id__in=list(deltas)).values(
+                'id', 'email', 'balance', 'fixed_balance')}
+            messages = [Message(receiver_id=user['id'], text='You have reached your balance')
+                        for user in users.values() if user['fixed_balance'] and user['balance'] >= user['fixed_balance']]
+            for instance in instances:
+                user = users[instance.user_id]
+                if user['email']:
+                    emails.add(user['email'])
+                else:
+                    messages.append(Message(receiver_id=user['id'],
+                                            text=f'Your transaction №{instance.number} has been added to balance'))
+            await Message.bulk_create(messages, batch_size=config.BULK_CREATE_BATCH_SIZE)
+        await hub.publish(*{message.receiver_id for message in messages})
+        settled += len(instances)
+
+
 async def update_instance(data: schema.BaseModel, instance_id: int, model_name: str) -> \
         Union[User, Category, Transaction]:
     instance = await get_object_by_id(instance_id, model_name)
-    for key, value in data.dict().items():
-        if value is not None:
-            setattr(instance, key, value)
-    await instance.save()
+    async with in_transaction(models[model_name]._meta.default_connection):
+        if model_name == 'Transaction':
+            await lock_user(instance.user_id)
+            await instance.refresh_from_db()
+            await update_balances([instance], -1)
+            await update_rollup([instance], -1)
+            await update_checkpoints([instance], -1)
+        for key, value in data.dict().items():
+            if value is not None:
+                setattr(instance, key, value)
+        await instance.save()
+        if model_name == 'Transaction':
+            await update_balances([instance])
+            await update_rollup([instance])
+            await update_checkpoints([instance])
+        await touch_user(_owner_id(instance))
+    if model_name == 'User':
+        await hub.invalidate_principal(instance_id)
     return instance
 
 
@@ -31,7 +276,24 @@ async def delete_instance(obj_id: int, model_name: str) -> tuple[bool, str]:
     model = models[model_name]
     instance = await model.get_or_none(id=obj_id)
     try:
-        await instance.delete()
+        async with in_transaction(model._meta.default_connection):
+            if model_name == 'Transaction':
+                await lock_user(instance.user_id)
+                await instance.refresh_from_db()
+                await update_balances([instance], -1)
+                await update_rollup([instance], -1)
+                await update_checkpoints([instance], -1)
+            elif model_name == 'Category':  #: transactions of the category are deleted by cascade
+                await lock_user(instance.user_id)
+                transactions = await Transaction.filter(category_id=obj_id, settled=True)
+                await update_balances(transactions, -1)
+                await update_rollup(transactions, -1)
+                await update_checkpoints(transactions, -1)
+            await instance.delete()
+            if model_name != 'User':
+                await touch_user(_owner_id(instance))
+        if model_name == 'User':
+            await hub.invalidate_principal(obj_id)
         return True, 'OK. Deleted'
     except Exception as e:
         return False, str(e)
@@ -42,10 +304,209 @@ async def get_object_by_id(instance_id: int, model_name: str) -> Union[User, Cat
     return await model.get_or_none(id=instance_id)
 
 
+async def get_user_category_ids(user_id: int, category_ids: set[int]) -> set[int]:
+    """ Subset of `category_ids` which belong to the user """
+    return set(await Category.filter(user_id=user_id, id__in=category_ids).values_list('id', flat=True))
+
+
 async def get_user_by_username(username: str) -> Optional[User]:
     return await User.get_or_none(username=username)
 
 
-async def get_instances_by_user_id(user_id: int, model_name: str) -> list[Optional[Union[Category, Transaction]]]:
+async def get_last_message_id(user_id: int) -> int:
+    ids = await Message.get_messages(user_id).order_by('-id').limit(1).values_list('id', flat=True)
+    return ids[0] if ids else 0
+
+
+def get_users_with_email() -> QuerySet:
+    return User.exclude(email__isnull=True).exclude(email='')
+
+
+async def iterate_user_emails(chunk_size: int) -> AsyncIterator[list[str]]:
+    """ Yields emails of users in chunks, walking the table by id keyset """
+    last_id = 0
+    while True:
+        rows = await get_users_with_email().filter(id__gt=last_id).order_by('id').limit(
+            chunk_size).values_list('id', 'email')
+        if not rows:
+            return
+        yield [email for _, email in rows]
+        if len(rows) < chunk_size:
+            return
+        last_id = rows[-1][0]
+
+
+def get_instances_by_user_id(user_id: int, model_name: str) -> QuerySet:
     model = models[model_name]
-    return await model.filter(user__id=user_id)
+    return model.filter(user_id=user_id)
+
+
+def encode_cursor(created: datetime, instance_id: int) -> str:
+    value = f'{created.isoformat()},{instance_id}'
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_cursor(cursor: str) -> tuple[datetime, int]:
+    """ Raises ValueError if cursor was not produced by `encode_cursor` """
+    created, instance_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(',')
+    return datetime.fromisoformat(created), int(instance_id)
+
+
+def _after(queryset: QuerySet, created: datetime, instance_id: int) -> QuerySet:
+    return queryset.filter(Q(created__gt=created) | Q(id__gt=instance_id), created__gte=created)
+
+
+async def paginate(queryset: QuerySet, pagination: schema.Pagination) -> \
+        tuple[list[Union[Category, Transaction, Message]], Optional[str]]:
+    """ Keyset pagination on (created, id). Returns page and cursor of the next one """
+    if pagination.created is not None:
+        queryset = _after(queryset, pagination.created, pagination.id)
+    instances = await queryset.order_by('created', 'id').limit(pagination.limit + 1)
+    if len(instances) <= pagination.limit:
+        return instances, None
+    instances = instances[:pagination.limit]
+    return instances, encode_cursor(instances[-1].created, instances[-1].id)
+
+
+def encode_sorted_cursor(order: str, value: Union[float, datetime], instance_id: int) -> str:
+    value = value.isoformat() if isinstance(value, datetime) else repr(value)
+    return base64.urlsafe_b64encode(f'{order},{value},{instance_id}'.encode()).decode()
+
+
+def decode_sorted_cursor(cursor: str, order: str) -> tuple[Union[float, datetime], int]:
+    """ Raises ValueError if cursor was not produced by `encode_sorted_cursor` for the same order """
+    cursor_order, value, instance_id = base64.urlsafe_b64decode(cursor.encode()).decode().split(',')
+    if cursor_order != order:
+        raise ValueError('Cursor belongs to another order')
+    column = order.lstrip('-')
+    return datetime.fromisoformat(value) if column == 'created' else float(value), int(instance_id)
+
+
+async def paginate_sorted_values(queryset: QuerySet, pagination: schema.SortedPagination, model_name: str) -> \
+        tuple[list[dict], Optional[str]]:
+    """ Keyset pagination on (column, id) in either direction, `pagination.order` is "column" or "-column".
+        The filter, the order and the limit go to a single query """
+    column = pagination.order.lstrip('-')
+    descending = pagination.order.startswith('-')
+    if pagination.value is not None:
+        if descending:
+            queryset = queryset.filter(Q(**{f'{column}__lt': pagination.value}) | Q(id__lt=pagination.id),
+                                       **{f'{column}__lte': pagination.value})
+        else:
+            queryset = queryset.filter(Q(**{f'{column}__gt': pagination.value}) | Q(id__gt=pagination.id),
+                                       **{f'{column}__gte': pagination.value})
+    ordering = (f'-{column}', '-id') if descending else (column, 'id')
+    rows = await queryset.order_by(*ordering).limit(pagination.limit + 1).values(*response_fields[model_name])
+    if len(rows) <= pagination.limit:
+        return rows, None
+    rows = rows[:pagination.limit]
+    return rows, encode_sorted_cursor(pagination.order, rows[-1][column], rows[-1]['id'])
+
+
+async def paginate_values(queryset: QuerySet, pagination: schema.Pagination, model_name: str) -> \
+        tuple[list[dict], Optional[str]]:
+    """ Same as `paginate`, but fetches only the response columns as dicts,
+        which can be serialized directly without building models and pydantic objects """
+    if pagination.created is not None:
+        queryset = _after(queryset, pagination.created, pagination.id)
+    rows = await queryset.order_by('created', 'id').limit(pagination.limit + 1).values(*response_fields[model_name])
+    if len(rows) <= pagination.limit:
+        return rows, None
+    rows = rows[:pagination.limit]
+    return rows, encode_cursor(rows[-1]['created'], rows[-1]['id'])
+
+
+async def iterate_values(queryset: QuerySet, fields: tuple[str, ...], chunk_size: int) -> AsyncIterator[list[dict]]:
+    """ Yields chunks of rows as dicts, walking the queryset by (created, id) keyset """
+    fields = tuple(dict.fromkeys(('created', 'id') + fields))
+    chunk_queryset = queryset
+    while True:
+        rows = await chunk_queryset.order_by('created', 'id').limit(chunk_size).values(*fields)
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        chunk_queryset = _after(queryset, rows[-1]['created'], rows[-1]['id'])
+
+
+async def get_balance_columns(user_id: int, start: date, end: Optional[date]) -> tuple[float, list[tuple]]:
+    """ Balance at the start of `start` and (day, settled, type, sum) totals per day of transactions effective
+        in [start, end) and of all pending ones, `end` None is an open bound.
+        Day is EpochDay of the planned date of planned transactions and the local date of creation of others.
+        The opening balance comes from the nearest checkpoint (see get_balance_at), regular and planned
+        transactions are range scans of the (user, created) and (user, planned) indexes """
+    opening, _ = await get_balance_at(user_id, start - timedelta(days=1))
+    regular, planned = effective_ranges(start, end)
+    #: values_list can't group by annotations
+    rows = await Transaction.filter(user_id=user_id, **regular).annotate(
+        day=EpochDay(LocalDate('created')), total=Sum('sum')
+    ).group_by('day', 'settled', 'type').values('day', 'settled', 'type', 'total')
+    rows += await Transaction.filter(Q(**planned) | Q(settled=False), user_id=user_id, planned__isnull=False).annotate(
+        day=EpochDay(LocalDate('planned')), total=Sum('sum')
+    ).group_by('day', 'settled', 'type').values('day', 'settled', 'type', 'total')
+    return opening, [(row['day'], row['settled'], row['type'], row['total']) for row in rows]
+
+
+async def get_rollup_history(user_id: int, start: date, end: date) -> list[tuple]:
+    """ (year, month, category_id, type, sum) of settled transactions of months in [start, end) """
+    return await TransactionRollup.get_rollups_by_range(
+        user_id, datetime.combine(start, datetime.min.time()), datetime.combine(end, datetime.min.time())
+    ).values_list('year', 'month', 'category_id', 'type', 'sum')
+
+
+async def get_transactions_summary(queryset: QuerySet, group_by: str) -> dict:
+    """ Income/outcome totals per period and category, aggregated by a single GROUP BY query """
+    rows = await queryset.annotate(
+        bucket=TruncDate('created', group_by), total=Sum('sum'), count=Count('id')
+    ).group_by('bucket', 'category_id', 'type').order_by('bucket').values(
+        'bucket', 'category_id', 'type', 'total', 'count'
+    )
+    return _build_summary(rows)
+
+
+def is_month_start(value: Optional[datetime]) -> bool:
+    """ Whether a range bound can be answered from monthly rollups. None is an open bound """
+    if value is None:
+        return True
+    value = timezone.localtime(value)
+    return value.day == 1 and value.time() == datetime.min.time()
+
+
+async def get_rollup_summary(user_id: int, group_by: str, start: Optional[datetime] = None,
+                             end: Optional[datetime] = None) -> dict:
+    """ Same as get_transactions_summary for month/year buckets but reads O(months * categories)
+        rollup rows instead of the transactions. start/end must satisfy is_month_start """
+    rows = await TransactionRollup.get_rollups_by_range(user_id, start, end).order_by('year', 'month').values(
+        'year', 'month', 'category_id', 'type', total='sum', count='count'
+    )
+    for row in rows:
+        row['bucket'] = date(row.pop('year'), row.pop('month') if group_by == 'month' else 1, 1)
+    return _build_summary(rows)
+
+
+def _build_summary(rows: list[dict]) -> dict:
+    """ Nests rows of (bucket, category_id, type, total, count) ordered by bucket into periods and categories """
+    summary = {'income': 0, 'outcome': 0, 'income_count': 0, 'outcome_count': 0, 'periods': []}
+    periods = {}
+    for row in rows:
+        bucket = row['bucket']
+        if isinstance(bucket, datetime):
+            bucket = bucket.date()
+        elif isinstance(bucket, str):
+            bucket = date.fromisoformat(bucket[:10])
+        if bucket not in periods:
+            periods[bucket] = {'start': bucket, 'income': 0, 'outcome': 0, 'income_count': 0,
+                               'outcome_count': 0, 'categories': {}}
+            summary['periods'].append(periods[bucket])
+        category = periods[bucket]['categories'].setdefault(
+            row['category_id'],
+            {'category_id': row['category_id'], 'income': 0, 'outcome': 0, 'income_count': 0, 'outcome_count': 0}
+        )
+        kind = 'income' if row['type'] else 'outcome'
+        for totals in (summary, periods[bucket], category):
+            totals[kind] += row['total']
+            totals[f'{kind}_count'] += row['count']
+    for period in summary['periods']:
+        period['categories'] = list(period['categories'].values())
+    return summary
@@ -0,0 +1,79 @@
+from typing import Type, Union
+
+from pypika import Table
+from pypika.functions import Cast
+from pypika.terms import AtTimezone, Function as BaseFunction, Term, ValueWrapper
+from tortoise import Model, timezone
+from tortoise.fields import DatetimeField
+from tortoise.functions import Function
+
+
+class TruncDate(Function):
+    """
+    Start of the day, week, month or year the local date of the field falls into (see LocalDate).
+    Postgres returns a date, sqlite returns the date as 'YYYY-MM-DD' string.
+    """
+
+    sqlite_modifiers = {
+        'day': ('start of day', ),
+        'week': ('weekday 0', '-6 days'),
+        'month': ('start of month', ),
+        'year': ('start of year', ),
+    }
+
+    def __init__(self, field: str, period: str) -> None:
+        super().__init__(LocalDate(field), period)
+        self.dialect = None
+
+    def _get_function_field(self, field: Term, period: str) -> BaseFunction:
+        if self.dialect == 'sqlite':
+            return BaseFunction('DATE', field, *self.sqlite_modifiers[period])
+        # A date would be cast to timestamptz in the session time zone, timestamp keeps it as is
+        return Cast(BaseFunction('DATE_TRUNC', period, Cast(field, 'TIMESTAMP')), 'DATE')
+
+    def resolve(self, model: Type[Model], table: Table) -> dict:
+        self.dialect = model._meta.db.capabilities.dialect
+        return super().resolve(model, table)
+
+
+class LocalDate(Function):
+    """
+    Calendar date of datetime fields in the time zone of Tortoise config (see tortoise.timezone),
+    date fields are taken as they are. With several fields it is the date of the first one which is not null.
+    Postgres converts with AT TIME ZONE, so the session time zone doesn't matter. sqlite has no time zone
+    database and takes dates in UTC, the default time zone.
+    """
+
+    def __init__(self, *fields: str) -> None:
+        super().__init__(fields[0], *fields[1:])
+
+    def _get_date(self, model: Type[Model], table: Table, field: str) -> Term:
+        term = self._resolve_field_for_model(model, table, field)['field']
+        is_datetime = isinstance(model._meta.fields_map[field], DatetimeField)
+        if model._meta.db.capabilities.dialect == 'sqlite':
+            return BaseFunction('DATE', term)
+        return Cast(AtTimezone(term, timezone.get_timezone()), 'DATE') if is_datetime else term
+
+    def resolve(self, model: Type[Model], table: Table) -> dict:
+        dates = [self._get_date(model, table, field) for field in (self.field, *self.default_values)]
+        return {'joins': [], 'field': dates[0] if len(dates) == 1 else BaseFunction('COALESCE', *dates)}
+
+
+class EpochDay(Function):
+    """
+    Number of days since 1970-01-01 of a date, e.g. EpochDay(LocalDate('created')).
+    Lets NumPy take date columns as integers without converting every value to a Python date.
+    """
+
+    def __init__(self, field: Union[str, Function]) -> None:
+        super().__init__(field)
+        self.dialect = None
+
+    def _get_function_field(self, field: Term) -> Term:
+        if self.dialect == 'sqlite':
+            return Cast(BaseFunction('JULIANDAY', field) - 2440587.5, 'INTEGER')
+        return field - Cast(ValueWrapper('1970-01-01'), 'DATE')
+
+    def resolve(self, model: Type[Model], table: Table) -> dict:
+        self.dialect = model._meta.db.capabilities.dialect
+        return super().resolve(model, table)
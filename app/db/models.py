@@ -1,8 +1,10 @@
-from typing import Optional
+from typing import Optional, Sequence
 
-from tortoise import Model, fields
+from tortoise import Model, fields, timezone
+from tortoise.queryset import QuerySet
+from tortoise.query_utils import Q
 
-from datetime import datetime
+from datetime import datetime, timedelta
 
 
 class User(Model):
@@ -18,8 +20,14 @@ class User(Model):
 
     is_admin = fields.BooleanField(default=False)
 
+    next_transaction_number = fields.IntField(default=1)  #: per-user counter of Transaction.number
+
+    data_version = fields.BigIntField(default=0)  #: bumped by every write to data of the user
+
+    data_modified = fields.DatetimeField(null=True)
+
     class PydanticMeta:
-        exclude = ['password', 'is_admin']
+        exclude = ['password', 'is_admin', 'next_transaction_number', 'data_version', 'data_modified']
 
 
 class Message(Model):
@@ -30,17 +38,24 @@ class Message(Model):
     created = fields.DatetimeField(auto_now_add=True)
 
     @classmethod
-    async def get_messages(cls, user_id: int) -> list['Message']:
-        return await cls.filter(receiver__id=user_id)
+    def get_messages(cls, user_id: int) -> QuerySet['Message']:
+        return cls.filter(receiver_id=user_id)
+
+    class Meta:
+        indexes = (('receiver', 'created', 'id'), )
 
 
 class Category(Model):
     id = fields.IntField(pk=True, index=True)
     name = fields.CharField(max_length=255)
+    created = fields.DatetimeField(auto_now_add=True)
 
     user: fields.ForeignKeyRelation[User] = fields.ForeignKeyField('models.User',
                                                                    related_name='categories')
 
+    class Meta:
+        indexes = (('user', 'created', 'id'), )
+
 
 class Transaction(Model):
     id = fields.IntField(pk=True, index=True)
@@ -48,53 +63,154 @@ class Transaction(Model):
     sum = fields.FloatField()
     type = fields.BooleanField(default=True)  #: True is "Income", False is "Outcome"
 
+    planned = fields.DateField(null=True)  #: Date when the transaction is added to balance
+
+    settled = fields.BooleanField(default=True)  #: False until planned transaction is added to balance
+
     created = fields.DatetimeField(auto_now_add=True)
     user: fields.ForeignKeyRelation[User] = fields.ForeignKeyField('models.User',
                                                                    related_name='transactions')
     category: fields.ForeignKeyRelation[Category] = fields.ForeignKeyField('models.Category',
                                                                            related_name='transactions')
 
-    @classmethod
-    async def get_transactions_by_period(cls, user_id: int, period: str, number: int = None,
-                                         type: bool = None) -> list['Transaction']:
-        current_data = datetime.now()
-        instances = cls.filter(user__id=user_id)
-        if type:
-            instances = instances.filter(type=type)
+    @staticmethod
+    def get_period_range(period: str, number: int = None) -> tuple[datetime, datetime]:
+        """ Half-open [start, end) range of the day/month of the current year or of the whole year.
+            Raises ValueError if number is out of range for the period """
+        current_data = timezone.now()
         if period == 'day':
-            if not number:
-                number = current_data.day
-            instances = instances.filter(created__day=number)
+            start = datetime(current_data.year, current_data.month, number or current_data.day)
+            end = start + timedelta(days=1)
         elif period == 'month':
-            if not number:
-                number = current_data.month
-            instances = instances.filter(created__month=number)
+            start = datetime(current_data.year, number or current_data.month, 1)
+            end = datetime(start.year + start.month // 12, start.month % 12 + 1, 1)
         else:
-            if not number:
-                number = current_data.year
-            instances = instances.filter(created__year=number)
-        return await instances
+            start = datetime(number or current_data.year, 1, 1)
+            end = datetime(start.year + 1, 1, 1)
+        return timezone.make_aware(start), timezone.make_aware(end)
+
+    @classmethod
+    def get_transactions_by_range(cls, user_id: int, start: Optional[datetime] = None,
+                                  end: Optional[datetime] = None, type: bool = None) -> QuerySet['Transaction']:
+        instances = cls.filter(user_id=user_id)
+        if isinstance(type, bool):
+            instances = instances.filter(type=type)
+        if start:
+            instances = instances.filter(created__gte=start)
+        if end:
+            instances = instances.filter(created__lt=end)
+        return instances
 
     @classmethod
-    async def get_transaction_by_type(cls, user_id: int, type: bool) -> list['Transaction']:
-        return await cls.filter(user__id=user_id, type=type)
+    def get_transactions_by_period(cls, user_id: int, period: str, number: int = None, type: bool = None,
+                                   start: Optional[datetime] = None,
+                                   end: Optional[datetime] = None) -> QuerySet['Transaction']:
+        """ Explicit start/end take precedence over the bounds of the period """
+        period_start, period_end = cls.get_period_range(period, number)
+        return cls.get_transactions_by_range(user_id, start or period_start, end or period_end, type)
 
     @classmethod
-    async def get_transactions_by_category(cls, user_id: int, category_id: int,
-                                           type: Optional[bool] = None) -> list['Transaction']:
+    def get_transaction_by_type(cls, user_id: int, type: bool) -> QuerySet['Transaction']:
+        return cls.filter(user_id=user_id, type=type)
+
+    @classmethod
+    def get_transactions_by_category(cls, user_id: int, category_id: int,
+                                     type: Optional[bool] = None) -> QuerySet['Transaction']:
         if isinstance(type, bool):
-            return await cls.filter(user__id=user_id, category__id=category_id, type=type)
-        return await cls.filter(user__id=user_id, category__id=category_id)
+            return cls.filter(user_id=user_id, category_id=category_id, type=type)
+        return cls.filter(user_id=user_id, category_id=category_id)
 
     @classmethod
-    async def get_next_transaction_number(cls, user_id: int) -> int:
-        last_instance = await cls.filter(user__id=user_id).order_by('-id').limit(1).first()
-        if not last_instance:
-            return 1
-        return last_instance.number + 1
+    def get_transactions_by_filter(cls, user_id: int, type: Optional[bool] = None, category_ids: Sequence[int] = (),
+                                   start: Optional[datetime] = None, end: Optional[datetime] = None,
+                                   min_sum: Optional[float] = None, max_sum: Optional[float] = None,
+                                   settled: Optional[bool] = None) -> QuerySet['Transaction']:
+        """ All conditions at once, so they end up in the WHERE clause of a single query """
+        conditions = {'user_id': user_id}
+        if isinstance(type, bool):
+            conditions['type'] = type
+        if category_ids:
+            conditions['category_id__in'] = list(category_ids)
+        if start:
+            conditions['created__gte'] = start
+        if end:
+            conditions['created__lt'] = end
+        if min_sum is not None:
+            conditions['sum__gte'] = min_sum
+        if max_sum is not None:
+            conditions['sum__lte'] = max_sum
+        if isinstance(settled, bool):
+            conditions['settled'] = settled
+        return cls.filter(**conditions)
 
     def category_id(self) -> int:
+        """ Only declares the computed schema field. Instances loaded by the ORM carry the raw
+            `category_id` column value which shadows this method, so serialization never loads the category """
         return self.category.id
 
+    class Meta:
+        unique_together = (('user', 'number'), )
+        indexes = (('user', 'created', 'id'), ('user', 'type', 'created', 'id'),
+                   ('category', 'created', 'id'), ('settled', 'planned'), ('user', 'sum', 'id'), ('user', 'planned'))
+
     class PydanticMeta:
         computed = ('category_id', )
+
+
+class TransactionRollup(Model):
+    """ Sum and count of settled transactions per user, category, month and type.
+        Kept up to date by db.crud in the same DB transaction as the transactions """
+    id = fields.IntField(pk=True)
+    user: fields.ForeignKeyRelation[User] = fields.ForeignKeyField('models.User', related_name='rollups',
+                                                                   on_delete=fields.CASCADE)
+    category: fields.ForeignKeyRelation[Category] = fields.ForeignKeyField('models.Category',
+                                                                           related_name='rollups',
+                                                                           on_delete=fields.CASCADE)
+    year = fields.IntField()
+    month = fields.SmallIntField()
+    type = fields.BooleanField()
+    sum = fields.FloatField(default=0)
+    count = fields.IntField(default=0)
+
+    @classmethod
+    def get_rollups_by_range(cls, user_id: int, start: Optional[datetime] = None,
+                             end: Optional[datetime] = None) -> QuerySet['TransactionRollup']:
+        """ start/end have to be first days of months, end is exclusive """
+        instances = cls.filter(user_id=user_id)
+        if start:
+            instances = instances.filter(Q(year__gt=start.year) | Q(year=start.year, month__gte=start.month))
+        if end:
+            instances = instances.filter(Q(year__lt=end.year) | Q(year=end.year, month__lt=end.month))
+        return instances
+
+    class Meta:
+        unique_together = (('user', 'category', 'year', 'month', 'type'), )
+
+
+class BalanceCheckpoint(Model):
+    """ Balance of a user at the start of `date`, the sum of settled transactions effective before it.
+        Transactions are effective on their planned date if they have one, otherwise on the day of creation.
+        Created for month starts by db.checkpoints, kept up to date by db.crud in the same DB transaction
+        as the transactions """
+    id = fields.IntField(pk=True)
+    user: fields.ForeignKeyRelation[User] = fields.ForeignKeyField('models.User', related_name='balance_checkpoints',
+                                                                   on_delete=fields.CASCADE)
+    date = fields.DateField()
+    balance = fields.FloatField(default=0)
+
+    class Meta:
+        unique_together = (('user', 'date'), )
+
+
+class MailBroadcast(Model):
+    """ Progress of an admin broadcast, in the database so that every worker can report it.
+        The worker which sends the broadcast saves progress after every chunk of recipients.
+        Only the last failures are kept in `errors`, see utils.mailer.Mailer.max_errors """
+    id = fields.CharField(pk=True, max_length=32)
+    status = fields.CharField(max_length=20, default='pending')
+    total = fields.IntField()
+    sent = fields.IntField(default=0)
+    failed = fields.IntField(default=0)
+    errors = fields.JSONField(default=list)
+    created = fields.DatetimeField(auto_now_add=True)
+    finished = fields.DatetimeField(null=True)
@@ -0,0 +1,61 @@
+"""
+Rebuilds TransactionRollup from scratch:
+
+    python -m db.rollup --chunk-size 1000 --workers 4
+
+Users are split into id ranges, every range is rebuilt in its own DB transaction
+by one GROUP BY query and ranges are processed concurrently.
+"""
+import argparse
+from datetime import datetime
+
+from tortoise import Tortoise, run_async
+from tortoise.functions import Sum, Count
+from tortoise.transactions import in_transaction
+
+from .batch import lock_users, run_chunks, to_date
+from .models import Transaction, TransactionRollup
+from .functions import TruncDate
+import config
+
+
+async def rebuild_users(first_id: int, last_id: int) -> int:
+    """ Replaces rollups of users with ids in [first_id, last_id]. Returns number of rollup rows """
+    async with in_transaction(TransactionRollup._meta.default_connection):
+        await lock_users(first_id, last_id)
+        await TransactionRollup.filter(user_id__gte=first_id, user_id__lte=last_id).delete()
+        rows = await Transaction.filter(user_id__gte=first_id, user_id__lte=last_id, settled=True).annotate(
+            bucket=TruncDate('created', 'month'), total=Sum('sum'), count=Count('id')
+        ).group_by('user_id', 'category_id', 'bucket', 'type').values(
+            'user_id', 'category_id', 'bucket', 'type', 'total', 'count'
+        )
+        rollups = []
+        for row in rows:
+            bucket = to_date(row['bucket'])
+            rollups.append(TransactionRollup(user_id=row['user_id'], category_id=row['category_id'],
+                                             year=bucket.year, month=bucket.month, type=row['type'],
+                                             sum=row['total'], count=row['count']))
+        await TransactionRollup.bulk_create(rollups, batch_size=config.BULK_CREATE_BATCH_SIZE)
+    return len(rollups)
+
+
+async def rebuild(chunk_size: int = 1000, workers: int = 4) -> int:
+    """ Rebuilds rollups of all users by chunks of `chunk_size` users, `workers` chunks at a time """
+    return sum(await run_chunks(rebuild_users, chunk_size, workers))
+
+
+async def main(chunk_size: int, workers: int):
+    from utils.database import TORTOISE_ORM
+
+    await Tortoise.init(config=TORTOISE_ORM)
+    started = datetime.now()
+    rows = await rebuild(chunk_size, workers)
+    print(f'Rebuilt {rows} rollup rows in {datetime.now() - started}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Rebuild monthly transaction rollups')
+    parser.add_argument('--chunk-size', type=int, default=1000, help='users per DB transaction')
+    parser.add_argument('--workers', type=int, default=4, help='chunks rebuilt concurrently')
+    args = parser.parse_args()
+    run_async(main(args.chunk_size, args.workers))
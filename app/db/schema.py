@@ -4,9 +4,9 @@ from .models import User, Category, Transaction, Message
 
 from pydantic import BaseModel
 
-from typing import Optional, List
+from typing import Optional, List, Union
 
-from datetime import date
+from datetime import date, datetime
 
 
 User_Schema = pydantic_model_creator(User)
@@ -15,6 +15,41 @@ Category_Schema = pydantic_model_creator(Category)
 Message_Schema = pydantic_model_creator(Message)
 
 
+class Pagination(BaseModel):
+    limit: int
+    created: Optional[datetime] = None  #: position of the last row of the previous page
+    id: Optional[int] = None
+
+
+class SortedPagination(BaseModel):
+    limit: int
+    order: str = 'created'  #: sort column, "-" prefix for descending order
+    value: Optional[Union[float, datetime]] = None  #: sort key of the last row of the previous page
+    id: Optional[int] = None
+
+
+class TransactionFilter(BaseModel):
+    type: Optional[bool] = None
+    category_ids: List[int] = []
+    start: Optional[datetime] = None  #: inclusive
+    end: Optional[datetime] = None  #: exclusive
+    min_sum: Optional[float] = None
+    max_sum: Optional[float] = None
+    settled: Optional[bool] = None
+
+
+class BalanceAt(BaseModel):
+    user_id: int
+    at: date
+    balance: float  #: settled transactions effective by the end of `at`
+    checkpoint: Optional[date] = None  #: checkpoint the balance was computed from
+
+
+class DateRange(BaseModel):
+    start: Optional[datetime] = None  #: inclusive
+    end: Optional[datetime] = None  #: exclusive
+
+
 class UserIn(BaseModel):
     username: str
     password: str
@@ -52,6 +87,7 @@ class CategoryList(BaseModel):
     user_id: int  #: user id
     username: str
     categories: List[Category_Schema]
+    next_cursor: Optional[str] = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -67,6 +103,13 @@ class CreateTransaction(BaseModel):
         orm_mode = True
 
 
+class BulkTransactionResult(BaseModel):
+    created: int
+    first_number: int
+    last_number: int
+    balance: float
+
+
 class EditTransaction(BaseModel):
     sum: Optional[float] = None
     user: Optional[int] = None
@@ -80,6 +123,7 @@ class TransactionList(BaseModel):
     user_id: int  #: user id
     username: str
     transactions: List[Transaction_Schema]
+    next_cursor: Optional[str] = None
 
     class Config:
         arbitrary_types_allowed = True
@@ -89,6 +133,77 @@ class MessageList(BaseModel):
     user_id: int
     username: str
     messages: List[Message_Schema]
+    next_cursor: Optional[str] = None
 
     class Config:
         arbitrary_types_allowed = True
+
+
+class CategorySummary(BaseModel):
+    category_id: int
+    income: float
+    outcome: float
+    income_count: int
+    outcome_count: int
+
+
+class PeriodSummary(BaseModel):
+    start: date  #: first day of the period
+    income: float
+    outcome: float
+    income_count: int
+    outcome_count: int
+    categories: List[CategorySummary]
+
+
+class TransactionSummary(BaseModel):
+    user_id: int
+    username: str
+    group_by: str
+    income: float
+    outcome: float
+    income_count: int
+    outcome_count: int
+    periods: List[PeriodSummary]
+
+
+class CategoryForecast(BaseModel):
+    category_id: int
+    net: float  #: income minus outcome
+
+
+class MonthForecast(BaseModel):
+    start: date  #: first day of the month
+    net: float
+    balance: float  #: projected balance at the end of the month
+    categories: List[CategoryForecast]
+
+
+class TransactionTimeline(BaseModel):
+    user_id: int
+    username: str
+    start: date
+    end: date  #: exclusive
+    today: date  #: balances of later days are projected from pending planned transactions
+    dates: List[date]
+    balance: List[float]  #: balance at the end of each day of `dates`
+    forecast: List[MonthForecast] = []
+
+
+class BroadcastError(BaseModel):
+    email: str
+    error: str
+
+
+class BroadcastJob(BaseModel):
+    id: str
+    status: str
+    total: int
+    sent: int
+    failed: int
+    errors: List[BroadcastError]
+    created: datetime
+    finished: Optional[datetime] = None
+
+    class Config:
+        orm_mode = True
@@ -1,5 +1,15 @@
-from typing import Optional
-from fastapi import Request, HTTPException
+import math
+from typing import Optional, List
+from datetime import date, datetime
+from fastapi import Request, HTTPException, Query, Depends
+from tortoise import timezone
+
+from db.crud import decode_cursor, decode_sorted_cursor, get_data_version as get_user_data_version
+from db.schema import Pagination, SortedPagination, DateRange, TransactionFilter
+from utils.conditional import DataVersion
+from utils.database import read_from_replica, mark_write, wrote_recently
+from utils.ratelimit import rate_limiter
+import config
 
 
 def get_user_fixed_balance(request: Request) -> Optional[float]:
@@ -8,9 +18,93 @@ def get_user_fixed_balance(request: Request) -> Optional[float]:
         return user.fixed_balance
 
 
+async def rate_limit(request: Request):
+    """ Token bucket of the current user, GET requests and writes are limited separately """
+    group = 'read' if request.method in ('GET', 'HEAD') else 'write'
+    retry_after = await rate_limiter.acquire(group, request.state.user.id)
+    if retry_after:
+        raise HTTPException(status_code=429, detail='Too many requests',
+                            headers={'Retry-After': str(math.ceil(retry_after))})
+
+
+async def route_reads(request: Request):
+    """
+    GET requests read from the replica. Any other request marks the user as a writer,
+    so their reads stay on the primary for REPLICA_STICKY_SECONDS and they see what they wrote.
+    Async on purpose, the context variable set in a threadpool wouldn't reach the handler
+    """
+    user_id = request.state.user.id
+    if request.method not in ('GET', 'HEAD'):
+        mark_write(user_id)
+    elif not wrote_recently(user_id):
+        read_from_replica.set(True)
+
+
 def check_is_admin(request: Request):
     if not request.state.user.is_admin:
         raise HTTPException(
             status_code=403,
             detail='User is not an admin'
         )
+
+
+def get_pagination(limit: int = Query(config.PAGE_SIZE, ge=1, le=config.MAX_PAGE_SIZE),
+                   after: Optional[str] = None) -> Pagination:
+    if after is None:
+        return Pagination(limit=limit)
+    try:
+        created, instance_id = decode_cursor(after)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail='Invalid cursor'
+        )
+    return Pagination(limit=limit, created=created, id=instance_id)
+
+
+def get_date_range(date_from: Optional[date] = Query(None, alias='from'),
+                   date_to: Optional[date] = Query(None, alias='to')) -> DateRange:
+    """ Half-open [from, to) range of dates """
+    if date_from and date_to and date_from >= date_to:
+        raise HTTPException(
+            status_code=400,
+            detail='"from" must be earlier than "to"'
+        )
+    return DateRange(
+        start=timezone.make_aware(datetime.combine(date_from, datetime.min.time())) if date_from else None,
+        end=timezone.make_aware(datetime.combine(date_to, datetime.min.time())) if date_to else None
+    )
+
+
+def get_sorted_pagination(order: str = Query('created', regex='^-?(created|sum)$'),
+                          limit: int = Query(config.PAGE_SIZE, ge=1, le=config.MAX_PAGE_SIZE),
+                          after: Optional[str] = None) -> SortedPagination:
+    if after is None:
+        return SortedPagination(limit=limit, order=order)
+    try:
+        value, instance_id = decode_sorted_cursor(after, order)
+    except ValueError:
+        raise HTTPException(
+            status_code=400,
+            detail='Invalid cursor'
+        )
+    return SortedPagination(limit=limit, order=order, value=value, id=instance_id)
+
+
+def get_transaction_filter(type: Optional[bool] = None, category: List[int] = Query([]),
+                           min_sum: Optional[float] = None, max_sum: Optional[float] = None,
+                           status: Optional[str] = Query(None, regex='^(settled|planned)$'),
+                           date_range: DateRange = Depends(get_date_range)) -> TransactionFilter:
+    if min_sum is not None and max_sum is not None and min_sum > max_sum:
+        raise HTTPException(
+            status_code=400,
+            detail='"min_sum" must not be greater than "max_sum"'
+        )
+    return TransactionFilter(type=type, category_ids=category, start=date_range.start, end=date_range.end,
+                             min_sum=min_sum, max_sum=max_sum, settled=None if status is None else status == 'settled')
+
+
+async def get_data_version(request: Request) -> DataVersion:
+    """ Version of the user from the path or of the current user. Lets list endpoints answer 304 before querying """
+    user_id = int(request.path_params.get('user_id', request.state.user.id))
+    return await get_user_data_version(user_id)
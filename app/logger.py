@@ -1,16 +1,112 @@
+import atexit
+import copy
+import gzip
 import logging
+import logging.handlers
+import os
+import queue
+import shutil
 import sys
+from contextvars import ContextVar
+from datetime import datetime, timezone
+from typing import Optional
 
+import orjson
 
-def get_logger(name: str = __file__, file: str = 'app.log', encoding: str = 'utf-8') -> logging.Logger:
-    logger = logging.Logger(name)
+import config
+
+
+request_id: ContextVar[Optional[str]] = ContextVar('request_id', default=None)
+
+#: Attributes every LogRecord has, everything else was passed with `extra`
+_record_attributes = set(logging.makeLogRecord({}).__dict__) | {'message', 'asctime'}
+
+
+class JsonFormatter(logging.Formatter):
+    """ One JSON object per line with time, level, message, request id and `extra` fields of the record """
+    def format(self, record: logging.LogRecord) -> str:
+        data = {
+            'time': datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+        }
+        data.update({key: value for key, value in record.__dict__.items() if key not in _record_attributes})
+        if record.exc_info:
+            data['exception'] = self.formatException(record.exc_info)
+        elif record.exc_text:
+            data['exception'] = record.exc_text
+        return orjson.dumps(data, default=str).decode()
+
+
+class QueueHandler(logging.handlers.QueueHandler):
+    """ Unlike the stdlib handler, keeps the traceback out of the message and does no formatting in the caller """
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        record = copy.copy(record)
+        record.msg = record.getMessage()
+        record.args = None
+        if record.exc_info:
+            record.exc_text = logging.Formatter().formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+
+class RequestIdFilter(logging.Filter):
+    """ Runs in the logging thread of the caller, so the id of the current request is still available """
+    def filter(self, record: logging.LogRecord) -> bool:
+        if not hasattr(record, 'request_id'):
+            record.request_id = request_id.get()
+        return True
 
-    fh = logging.FileHandler(file, encoding=encoding)
-    logger.addHandler(fh)
 
+def _gzip_rotator(source: str, dest: str):
+    with open(source, 'rb') as source_file, gzip.open(dest, 'wb') as dest_file:
+        shutil.copyfileobj(source_file, dest_file)
+    os.remove(source)
+
+
+def get_file_handler(file: str, encoding: str) -> logging.Handler:
+    """ Rotates by time if LOG_ROTATE_WHEN is set, otherwise by LOG_MAX_BYTES. Rotated files are gzipped """
+    if config.LOG_ROTATE_WHEN:
+        handler = logging.handlers.TimedRotatingFileHandler(file, when=config.LOG_ROTATE_WHEN,
+                                                            backupCount=config.LOG_BACKUP_COUNT,
+                                                            encoding=encoding, utc=True)
+    else:
+        handler = logging.handlers.RotatingFileHandler(file, maxBytes=config.LOG_MAX_BYTES,
+                                                       backupCount=config.LOG_BACKUP_COUNT, encoding=encoding)
+    handler.namer = lambda name: f'{name}.gz'
+    handler.rotator = _gzip_rotator
+    return handler
+
+
+def get_logger(name: str = __file__, file: str = config.LOG_FILE, encoding: str = 'utf-8') -> logging.Logger:
+    """
+    Records are put on an in-memory queue by the calling thread.
+    Formatting, file/stdout writes and rotation happen in a QueueListener thread.
+    """
+    logger = logging.Logger(name)
+
+    formatter = JsonFormatter()
+    fh = get_file_handler(file, encoding)
+    fh.setFormatter(formatter)
     sh = logging.StreamHandler(stream=sys.stdout)
-    logger.addHandler(sh)
+    sh.setFormatter(formatter)
+
+    log_queue = queue.Queue(-1)
+    qh = QueueHandler(log_queue)
+    qh.addFilter(RequestIdFilter())
+    logger.addHandler(qh)
+
+    listener = logging.handlers.QueueListener(log_queue, fh, sh, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    logger.queue = log_queue
     return logger
 
 
+def flush(logger: Optional[logging.Logger] = None):
+    """ Blocks until the listener has written every queued record """
+    (logger or log).queue.join()
+
+
 log = get_logger()
@@ -1,14 +1,19 @@
+import time
+boot_started = time.perf_counter()
+
 from fastapi import FastAPI
-import uvicorn
 
 from routers import users, categories, transactions, admin
-from utils.authentication import router as auth_router, get_password_hash
+from utils.authentication import router as auth_router
 
 from tortoise.contrib.fastapi import register_tortoise
 from utils.database import TORTOISE_ORM
+from utils.pubsub import hub
+from utils.middleware import RequestLogMiddleware, MetricsMiddleware, LoadSheddingMiddleware
+from utils.metrics import instrument_db, instrument_background_tasks
+from utils.startup import timings, check_migrations, ensure_admin, register_collectors
 from logger import log
 
-from db.models import User
 import config
 
 app = FastAPI()
@@ -17,25 +22,43 @@ app.include_router(auth_router)
 app.include_router(categories.router)
 app.include_router(transactions.router)
 app.include_router(admin.router)
+app.add_middleware(LoadSheddingMiddleware, exempt=('/admin/metrics', '/users/me/messages/stream'))
+app.add_middleware(RequestLogMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 register_tortoise(
     app=app,
     config=TORTOISE_ORM,
-    generate_schemas=True,
+    generate_schemas=config.STARTUP_MODE != 'production',
     add_exception_handlers=True
 )
 
+imported = time.perf_counter()
+timings['import'] = imported - boot_started
+
 
 @app.on_event('startup')
 async def startup_event():
-    password = get_password_hash(config.ADMIN_PASSWORD)
-    _ = await User.get_or_create(
-        username=config.ADMIN_USERNAME,
-        defaults={'email': config.ADMIN_EMAIL, 'is_admin': True,
-                  'password': password}
-    )
+    if config.STARTUP_MODE == 'production':
+        await check_migrations()
+    await ensure_admin(config.ADMIN_USERNAME, config.ADMIN_PASSWORD, config.ADMIN_EMAIL)
+    await hub.start()
+    instrument_db()
+    instrument_background_tasks()
+    register_collectors()
+    # Includes Tortoise.init of register_tortoise, its startup handler runs first
+    timings['startup'] = time.perf_counter() - imported
+    log.info('Startup finished', extra={'mode': config.STARTUP_MODE, 'import_seconds': round(timings['import'], 3),
+                                        'startup_seconds': round(timings['startup'], 3)})
+
+
+@app.on_event('shutdown')
+async def shutdown_event():
+    await hub.stop()
 
 
 if __name__ == '__main__':
+    import uvicorn
+
     uvicorn.run(app, host='0.0.0.0', port=8000)
     log.info('App started')
@@ -0,0 +1,37 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "user" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "username" VARCHAR(155) NOT NULL UNIQUE,
+    "password" VARCHAR(255) NOT NULL,
+    "email" VARCHAR(100),
+    "balance" DOUBLE PRECISION NOT NULL  DEFAULT 0,
+    "use_fixed_balance" BOOL NOT NULL  DEFAULT False,
+    "fixed_balance" DOUBLE PRECISION NOT NULL  DEFAULT 0,
+    "is_admin" BOOL NOT NULL  DEFAULT False
+);
+CREATE TABLE IF NOT EXISTS "category" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "name" VARCHAR(255) NOT NULL,
+    "user_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS "message" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "text" TEXT NOT NULL,
+    "created" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "receiver_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS "transaction" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "number" INT NOT NULL,
+    "sum" DOUBLE PRECISION NOT NULL,
+    "type" BOOL NOT NULL  DEFAULT True,
+    "created" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "category_id" INT NOT NULL REFERENCES "category" ("id") ON DELETE CASCADE,
+    "user_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE
+);
+CREATE TABLE IF NOT EXISTS "aerich" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "version" VARCHAR(255) NOT NULL,
+    "app" VARCHAR(20) NOT NULL,
+    "content" JSONB NOT NULL
+);
@@ -0,0 +1,4 @@
+-- upgrade --
+CREATE INDEX "idx_transaction_user_id_989b0c" ON "transaction" ("user_id", "planned");
+-- downgrade --
+DROP INDEX "idx_transaction_user_id_989b0c";
@@ -0,0 +1,14 @@
+-- upgrade --
+ALTER TABLE "category" ADD "created" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP;
+CREATE INDEX "idx_category_user_id_487307" ON "category" ("user_id", "created", "id");
+CREATE INDEX "idx_message_receive_95915b" ON "message" ("receiver_id", "created", "id");
+CREATE INDEX "idx_transaction_user_id_f0cdce" ON "transaction" ("user_id", "created", "id");
+CREATE INDEX "idx_transaction_user_id_f48547" ON "transaction" ("user_id", "type", "created", "id");
+CREATE INDEX "idx_transaction_categor_6f98e2" ON "transaction" ("category_id", "created", "id");
+-- downgrade --
+DROP INDEX "idx_transaction_categor_6f98e2";
+DROP INDEX "idx_transaction_user_id_f48547";
+DROP INDEX "idx_transaction_user_id_f0cdce";
+DROP INDEX "idx_message_receive_95915b";
+DROP INDEX "idx_category_user_id_487307";
+ALTER TABLE "category" DROP COLUMN "created";
@@ -0,0 +1,18 @@
+-- upgrade --
+ALTER TABLE "user" ADD "next_transaction_number" INT NOT NULL  DEFAULT 1;
+WITH "numbered" AS (
+    SELECT "id", "user_id", ROW_NUMBER() OVER (PARTITION BY "user_id", "number" ORDER BY "id") AS "copy",
+           MAX("number") OVER (PARTITION BY "user_id") AS "max_number"
+    FROM "transaction"
+), "renumbered" AS (
+    SELECT "id", "max_number" + ROW_NUMBER() OVER (PARTITION BY "user_id" ORDER BY "id") AS "number"
+    FROM "numbered" WHERE "copy" > 1
+)
+UPDATE "transaction" SET "number" = "renumbered"."number" FROM "renumbered" WHERE "transaction"."id" = "renumbered"."id";
+UPDATE "user" SET "next_transaction_number" = COALESCE(
+    (SELECT MAX("number") FROM "transaction" WHERE "transaction"."user_id" = "user"."id"), 0
+) + 1;
+ALTER TABLE "transaction" ADD CONSTRAINT "uid_transaction_user_id_74b588" UNIQUE ("user_id", "number");
+-- downgrade --
+ALTER TABLE "transaction" DROP CONSTRAINT "uid_transaction_user_id_74b588";
+ALTER TABLE "user" DROP COLUMN "next_transaction_number";
@@ -0,0 +1,8 @@
+-- upgrade --
+ALTER TABLE "transaction" ADD "planned" DATE;
+ALTER TABLE "transaction" ADD "settled" BOOL NOT NULL  DEFAULT True;
+CREATE INDEX "idx_transaction_settled_40ad6d" ON "transaction" ("settled", "planned");
+-- downgrade --
+DROP INDEX "idx_transaction_settled_40ad6d";
+ALTER TABLE "transaction" DROP COLUMN "settled";
+ALTER TABLE "transaction" DROP COLUMN "planned";
@@ -0,0 +1,21 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "transactionrollup" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "year" INT NOT NULL,
+    "month" SMALLINT NOT NULL,
+    "type" BOOL NOT NULL,
+    "sum" DOUBLE PRECISION NOT NULL  DEFAULT 0,
+    "count" INT NOT NULL  DEFAULT 0,
+    "category_id" INT NOT NULL REFERENCES "category" ("id") ON DELETE CASCADE,
+    "user_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE,
+    CONSTRAINT "uid_transaction_user_id_9193c3" UNIQUE ("user_id", "category_id", "year", "month", "type")
+);
+COMMENT ON TABLE "transactionrollup" IS 'Sum and count of settled transactions per user, category, month and type.';
+-- Months in UTC, the Tortoise time zone of the app. Run python -m db.rollup after setting another one
+INSERT INTO "transactionrollup" ("user_id", "category_id", "year", "month", "type", "sum", "count")
+    SELECT "user_id", "category_id", EXTRACT(YEAR FROM "local"), EXTRACT(MONTH FROM "local"), "type",
+           SUM("sum"), COUNT(*)
+    FROM (SELECT *, "created" AT TIME ZONE 'UTC' AS "local" FROM "transaction" WHERE "settled") AS "settled_transaction"
+    GROUP BY "user_id", "category_id", EXTRACT(YEAR FROM "local"), EXTRACT(MONTH FROM "local"), "type";
+-- downgrade --
+DROP TABLE IF EXISTS "transactionrollup";
@@ -0,0 +1,6 @@
+-- upgrade --
+ALTER TABLE "user" ADD "data_version" BIGINT NOT NULL  DEFAULT 0;
+ALTER TABLE "user" ADD "data_modified" TIMESTAMPTZ;
+-- downgrade --
+ALTER TABLE "user" DROP COLUMN "data_modified";
+ALTER TABLE "user" DROP COLUMN "data_version";
@@ -0,0 +1,4 @@
+-- upgrade --
+CREATE INDEX "idx_transaction_user_id_f078ea" ON "transaction" ("user_id", "sum", "id");
+-- downgrade --
+DROP INDEX "idx_transaction_user_id_f078ea";
@@ -0,0 +1,20 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "balancecheckpoint" (
+    "id" SERIAL NOT NULL PRIMARY KEY,
+    "date" DATE NOT NULL,
+    "balance" DOUBLE PRECISION NOT NULL  DEFAULT 0,
+    "user_id" INT NOT NULL REFERENCES "user" ("id") ON DELETE CASCADE,
+    CONSTRAINT "uid_balancechec_user_id_56c577" UNIQUE ("user_id", "date")
+);
+COMMENT ON TABLE "balancecheckpoint" IS 'Balance of a user at the start of `date`, the sum of settled transactions effective before it.';
+-- Days in UTC, the Tortoise time zone of the app. Run python -m db.checkpoints after setting another one
+INSERT INTO "balancecheckpoint" ("user_id", "date", "balance")
+    SELECT "user_id", ("month" + INTERVAL '1 month')::DATE, SUM(SUM("delta")) OVER (PARTITION BY "user_id" ORDER BY "month")
+    FROM (SELECT "user_id",
+                 DATE_TRUNC('month', COALESCE("planned", ("created" AT TIME ZONE 'UTC')::DATE)::TIMESTAMP) AS "month",
+                 CASE WHEN "type" THEN "sum" ELSE -"sum" END AS "delta"
+          FROM "transaction" WHERE "settled") AS "effective"
+    GROUP BY "user_id", "month"
+    HAVING "month" < DATE_TRUNC('month', NOW() AT TIME ZONE 'UTC');
+-- downgrade --
+DROP TABLE IF EXISTS "balancecheckpoint";
@@ -0,0 +1,10 @@
+-- upgrade --
+CREATE UNLOGGED TABLE IF NOT EXISTS "rate_limit_bucket" (
+    "key" VARCHAR(100) NOT NULL PRIMARY KEY,
+    "tokens" DOUBLE PRECISION NOT NULL,
+    "allowed" BOOL NOT NULL,
+    "updated" TIMESTAMPTZ NOT NULL
+);
+COMMENT ON TABLE "rate_limit_bucket" IS 'Token buckets of RATE_LIMIT_BACKEND=postgres, see utils.ratelimit.PostgresBackend.';
+-- downgrade --
+DROP TABLE IF EXISTS "rate_limit_bucket";
@@ -0,0 +1,14 @@
+-- upgrade --
+CREATE TABLE IF NOT EXISTS "mailbroadcast" (
+    "id" VARCHAR(32) NOT NULL  PRIMARY KEY,
+    "status" VARCHAR(20) NOT NULL  DEFAULT 'pending',
+    "total" INT NOT NULL,
+    "sent" INT NOT NULL  DEFAULT 0,
+    "failed" INT NOT NULL  DEFAULT 0,
+    "errors" JSONB NOT NULL,
+    "created" TIMESTAMPTZ NOT NULL  DEFAULT CURRENT_TIMESTAMP,
+    "finished" TIMESTAMPTZ
+);
+COMMENT ON TABLE "mailbroadcast" IS 'Progress of an admin broadcast, in the database so that every worker can report it.';
+-- downgrade --
+DROP TABLE IF EXISTS "mailbroadcast";
@@ -1,13 +1,14 @@
-from fastapi import APIRouter, Depends, BackgroundTasks
-from starlette.responses import FileResponse
+from fastapi import APIRouter, Depends, BackgroundTasks, HTTPException
+from starlette.responses import FileResponse, PlainTextResponse
 
 from utils.authentication import get_current_user
-from dependencies import check_is_admin
+from dependencies import check_is_admin, route_reads, rate_limit
 
-from utils.send_mail import send_email_background
-from config import MAIL_FROM, MAIL_FROM_NAME
-from db.crud import update_instance
-from db.schema import UserAdmin, User_Schema
+from utils.mailer import mailer
+from utils.metrics import metrics
+from config import MAIL_FROM_NAME, MAIL_CHUNK_SIZE, LOG_FILE
+from db.crud import update_instance, get_users_with_email, iterate_user_emails
+from db.schema import UserAdmin, User_Schema, BroadcastJob
 from logger import log
 
 
@@ -15,7 +16,9 @@ router = APIRouter(
     prefix='/admin',
     tags=['admin'],
     dependencies=[Depends(get_current_user),
-                  Depends(check_is_admin)]
+                  Depends(check_is_admin),
+                  Depends(rate_limit),
+                  Depends(route_reads)]
 )
 
 
@@ -24,9 +27,20 @@ async def admin_panel():
     return {'admin-panel': 'You have access to this page'}
 
 
-@router.get('/broadcast')
+@router.get('/broadcast', response_model=BroadcastJob)
 async def broadcast_mailing(text: str, background_task: BackgroundTasks):
-    await send_email_background(background_task, MAIL_FROM, MAIL_FROM_NAME, text)
+    job = await mailer.create_job(await get_users_with_email().count())
+    background_task.add_task(mailer.broadcast, job, iterate_user_emails(MAIL_CHUNK_SIZE), MAIL_FROM_NAME, text)
+    log.info(f'Broadcast #{job.id} to {job.total} users has been started')
+    return BroadcastJob.from_orm(job)
+
+
+@router.get('/broadcast/{job_id}', response_model=BroadcastJob)
+async def broadcast_status(job_id: str):
+    job = await mailer.get_job(job_id)
+    if not job:
+        raise HTTPException(status_code=404, detail='Broadcast not found')
+    return BroadcastJob.from_orm(job)
 
 
 @router.patch('/change_admin_status', response_model=User_Schema)
@@ -35,6 +49,11 @@ async def change_user_admin_status(data: UserAdmin):
     return await update_instance(data, data.user_id, 'User')
 
 
+@router.get('/metrics', response_class=PlainTextResponse)
+async def get_metrics():
+    return PlainTextResponse(metrics.render(), media_type='text/plain; version=0.0.4')
+
+
 @router.get('/get_log_file')
 async def get_log_file():
-    return FileResponse('app.log', filename='app.log', media_type='text/plain')
+    return FileResponse(LOG_FILE, filename='app.log', media_type='text/plain')
@@ -1,16 +1,19 @@
 from fastapi import APIRouter, Depends, Request
+from fastapi.responses import ORJSONResponse, Response
 
 from utils.authentication import get_current_user
 
-from db.schema import Category_Schema, CategoryList, CreateCategory, EditCategory
+from db.schema import Category_Schema, CategoryList, CreateCategory, EditCategory, Pagination
 from db import crud
+from dependencies import get_pagination, get_data_version, rate_limit, route_reads
+from utils.conditional import DataVersion
 from logger import log
 
 
 router = APIRouter(
     prefix='/categories',
     tags=['categories'],
-    dependencies=[Depends(get_current_user)]
+    dependencies=[Depends(get_current_user), Depends(rate_limit), Depends(route_reads)]
 )
 
 
@@ -18,16 +21,21 @@ router = APIRouter(
 async def create_category_handler(request: Request, category: CreateCategory):
     user = request.state.user
     data = category.dict()
-    data['user'] = user
+    data['user_id'] = user.id
     log.info('Created new category')
     return await crud.create_instance(data, 'Category')
 
 
 @router.get('/all', response_model=CategoryList)
-async def get_categories_list(request: Request):
+async def get_categories_list(request: Request, pagination: Pagination = Depends(get_pagination),
+                              version: DataVersion = Depends(get_data_version)):
+    if version.is_not_modified(request):
+        return Response(status_code=304, headers=version.headers())
     user = request.state.user
-    categories = await crud.get_instances_by_user_id(user.id, 'Category')
-    return {'user_id': user.id, 'username': user.username, 'categories': categories}
+    categories, next_cursor = await crud.paginate_values(crud.get_instances_by_user_id(user.id, 'Category'),
+                                                         pagination, 'Category')
+    return ORJSONResponse({'user_id': user.id, 'username': user.username, 'categories': categories,
+                           'next_cursor': next_cursor}, headers=version.headers())
 
 
 @router.get('/detail/{category_id}', response_model=Category_Schema)
@@ -1,23 +1,44 @@
-from fastapi import APIRouter, Depends, Request, HTTPException, BackgroundTasks
+from fastapi import APIRouter, Depends, Request, HTTPException, BackgroundTasks, Query
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
 
 from utils.authentication import get_current_user
 
-from db.schema import TransactionList, CreateTransaction, Transaction_Schema, EditTransaction
+from db.schema import TransactionList, CreateTransaction, Transaction_Schema, EditTransaction, Pagination, \
+    TransactionSummary, DateRange, BulkTransactionResult, SortedPagination, TransactionFilter, TransactionTimeline
 from db import crud
 from db.models import Transaction
 
-from app.dependencies import get_user_fixed_balance
+from app.dependencies import get_user_fixed_balance, get_pagination, get_date_range, get_data_version, rate_limit, \
+    route_reads, get_sorted_pagination, get_transaction_filter
+from utils.conditional import DataVersion
 from utils.send_mail import send_message
+from utils.export import csv_stream, ndjson_stream
+from utils import timeline
+import config
 
-from typing import Optional
+from tortoise import timezone
+
+from typing import Optional, List
+from datetime import timedelta
 
 
 router = APIRouter(
     prefix='/transactions',
     tags=['transactions'],
-    dependencies=[Depends(get_current_user)]
+    dependencies=[Depends(get_current_user), Depends(rate_limit), Depends(route_reads)]
 )
 
+EXPORT_FIELDS = ('id', 'number', 'sum', 'type', 'created', 'category_id')
+
+
+def _get_transactions_by_period(user_id: int, period: str, number: Optional[int], date_range: DateRange):
+    try:
+        return Transaction.get_transactions_by_period(user_id=user_id, period=period, number=number,
+                                                      start=date_range.start, end=date_range.end)
+    except ValueError:
+        raise HTTPException(status_code=400,
+                            detail='Wrong period number')
+
 
 @router.post('/create', response_model=Transaction_Schema)
 async def create_transaction_handler(request: Request, transaction: CreateTransaction,
@@ -28,60 +49,177 @@ async def create_transaction_handler(request: Request, transaction: CreateTransa
     if fixed_balance and data['sum'] >= fixed_balance:  #: User has to confirm that he use fixed balance
         await send_message(user.id, 'You have reached your balance', background_tasks)
 
-    data['number'] = await Transaction.get_next_transaction_number(user.id)
-    data['user'] = user
-    data['category'] = await crud.get_object_by_id(transaction.category, 'Category')
-    instance = await crud.create_instance(data, 'Transaction')
-    if not data['planned']:  #: Planned transaction will be added to balance later
-        if instance.type:
-            user.balance += instance.sum
-        else:
-            user.balance -= instance.sum
-        await user.save()
-    return await Transaction_Schema.from_tortoise_orm(instance)
+    data['category_id'] = data.pop('category')
+    instance, _ = await crud.create_transaction(data, user.id)
+    return Transaction_Schema.from_orm(instance)
+
+
+@router.post('/bulk', response_model=BulkTransactionResult)
+async def bulk_create_transactions_handler(request: Request, transactions: List[CreateTransaction],
+                                           background_tasks: BackgroundTasks,
+                                           fixed_balance: float = Depends(get_user_fixed_balance)):
+    if not transactions or len(transactions) > config.BULK_CREATE_MAX_ITEMS:
+        raise HTTPException(status_code=422,
+                            detail=f'Expected from 1 to {config.BULK_CREATE_MAX_ITEMS} transactions')
+    user = request.state.user
+    items = []
+    for transaction in transactions:
+        data = transaction.dict()
+        data['category_id'] = data.pop('category')
+        items.append(data)
+
+    category_ids = {item['category_id'] for item in items}
+    missing = category_ids - await crud.get_user_category_ids(user.id, category_ids)
+    if missing:
+        raise HTTPException(status_code=404,
+                            detail=f'Categories not found: {sorted(missing)}')
+    if fixed_balance and any(item['sum'] >= fixed_balance for item in items):
+        await send_message(user.id, 'You have reached your balance', background_tasks)
+
+    first_number, balance = await crud.bulk_create_transactions(items, user.id)
+    return {'created': len(items), 'first_number': first_number,
+            'last_number': first_number + len(items) - 1, 'balance': balance}
 
 
 @router.get('/all', response_model=TransactionList)
-async def get_transaction_list(request: Request):
+async def get_transaction_list(request: Request, pagination: Pagination = Depends(get_pagination),
+                               version: DataVersion = Depends(get_data_version)):
+    if version.is_not_modified(request):
+        return Response(status_code=304, headers=version.headers())
+    user = request.state.user
+    transactions, next_cursor = await crud.paginate_values(crud.get_instances_by_user_id(user.id, 'Transaction'),
+                                                           pagination, 'Transaction')
+    return ORJSONResponse({'user_id': user.id, 'username': user.username, 'transactions': transactions,
+                           'next_cursor': next_cursor}, headers=version.headers())
+
+
+@router.get('/query', response_model=TransactionList)
+async def query_transactions(request: Request, filters: TransactionFilter = Depends(get_transaction_filter),
+                             pagination: SortedPagination = Depends(get_sorted_pagination),
+                             version: DataVersion = Depends(get_data_version)):
+    """ Transactions matching all given filters, sorted by `order` (created, -created, sum or -sum) """
+    if version.is_not_modified(request):
+        return Response(status_code=304, headers=version.headers())
     user = request.state.user
-    transactions = await crud.get_instances_by_user_id(user.id, 'Transaction')
-    return {'user_id': user.id, 'username': user.username, 'transactions': transactions}
+    instances = Transaction.get_transactions_by_filter(user.id, filters.type, filters.category_ids, filters.start,
+                                                       filters.end, filters.min_sum, filters.max_sum, filters.settled)
+    transactions, next_cursor = await crud.paginate_sorted_values(instances, pagination, 'Transaction')
+    return ORJSONResponse({'user_id': user.id, 'username': user.username, 'transactions': transactions,
+                           'next_cursor': next_cursor}, headers=version.headers())
 
 
 @router.get('/all/statistic/{period}/{number}', response_model=TransactionList)
-async def get_transaction_statistic(period: str, request: Request, number: int = None):
+async def get_transaction_statistic(period: str, request: Request, number: int = None,
+                                    date_range: DateRange = Depends(get_date_range)):
     if period not in ('day', 'month', 'year'):
         raise HTTPException(status_code=404,
                             detail='Wrong period name')
     user = request.state.user
-    instances = await Transaction.get_transactions_by_period(user_id=user.id, period=period, number=number)
-    return {'user_id': user.id, 'username': user.username, 'transactions': instances}
+    instances = await _get_transactions_by_period(user.id, period, number, date_range).values(
+        *crud.response_fields['Transaction'])
+    return ORJSONResponse({'user_id': user.id, 'username': user.username, 'transactions': instances,
+                           'next_cursor': None})
+
+
+@router.get('/summary', response_model=TransactionSummary)
+async def get_transaction_summary(request: Request, group_by: str = Query('month', regex='^(day|week|month|year)$'),
+                                  period: Optional[str] = Query(None, regex='^(day|month|year)$'),
+                                  number: Optional[int] = None, date_range: DateRange = Depends(get_date_range)):
+    """ Totals of settled transactions, month and year buckets over whole months are read from rollups """
+    user = request.state.user
+    start, end = date_range.start, date_range.end
+    if period:
+        try:
+            period_start, period_end = Transaction.get_period_range(period, number)
+        except ValueError:
+            raise HTTPException(status_code=400,
+                                detail='Wrong period number')
+        start, end = start or period_start, end or period_end
+    if group_by in ('month', 'year') and crud.is_month_start(start) and crud.is_month_start(end):
+        summary = await crud.get_rollup_summary(user.id, group_by, start, end)
+    else:
+        instances = Transaction.get_transactions_by_range(user.id, start, end).filter(settled=True)
+        summary = await crud.get_transactions_summary(instances, group_by)
+    return {'user_id': user.id, 'username': user.username, 'group_by': group_by, **summary}
+
+
+@router.get('/timeline', response_model=TransactionTimeline)
+async def get_transaction_timeline(request: Request, date_range: DateRange = Depends(get_date_range),
+                                   forecast: int = Query(0, ge=0, le=config.FORECAST_MAX_MONTHS)):
+    """ Daily balance over [from, to) including pending planned transactions and optionally a forecast
+        of the next `forecast` months. Without "to" the series ends after the last planned transaction """
+    user = request.state.user
+    today = timezone.localtime(timezone.now()).date()
+    start = timezone.localtime(date_range.start).date() if date_range.start else \
+        today - timedelta(days=config.TIMELINE_DEFAULT_DAYS)
+    end = timezone.localtime(date_range.end).date() if date_range.end else None
+    if end and end <= start:
+        raise HTTPException(status_code=400,
+                            detail='"from" must be earlier than "to"')
+    if (end or today) - start > timedelta(days=config.TIMELINE_MAX_DAYS):
+        raise HTTPException(status_code=400,
+                            detail=f'Timeline is limited to {config.TIMELINE_MAX_DAYS} days')
+
+    opening, rows = await crud.get_balance_columns(user.id, start, end)
+    columns = timeline.to_columns(rows)
+    result = timeline.running_balance(columns, opening, start, end, today)
+    if forecast:
+        balance, _ = await crud.get_balance_at(user.id, today)
+        current = timeline.month_start(today)
+        history = await crud.get_rollup_history(user.id, timeline.month_start(current, -config.FORECAST_HISTORY_MONTHS),
+                                                current)
+        result['forecast'] = timeline.forecast_months(history, columns, balance, today,
+                                                      config.FORECAST_HISTORY_MONTHS, forecast)
+    return ORJSONResponse({'user_id': user.id, 'username': user.username, 'today': today, **result})
 
 
 @router.get('/all/{type}/', response_model=TransactionList)
-async def get_transactions_by_type(type: bool, request: Request):
+async def get_transactions_by_type(type: bool, request: Request, pagination: Pagination = Depends(get_pagination),
+                                   version: DataVersion = Depends(get_data_version)):
+    if version.is_not_modified(request):
+        return Response(status_code=304, headers=version.headers())
     user = request.state.user
-    instances = await Transaction.get_transaction_by_type(user.id, type)
-    return {'user_id': user.id, 'username': user.username, 'transactions': instances}
+    instances, next_cursor = await crud.paginate_values(Transaction.get_transaction_by_type(user.id, type),
+                                                        pagination, 'Transaction')
+    return ORJSONResponse({'user_id': user.id, 'username': user.username, 'transactions': instances,
+                           'next_cursor': next_cursor}, headers=version.headers())
 
 
 @router.get('/all/by_category/{category_id}', response_model=TransactionList)
-async def get_transactions_by_category(request: Request, category_id: int, transaction_type: Optional[bool] = None):
+async def get_transactions_by_category(request: Request, category_id: int, transaction_type: Optional[bool] = None,
+                                       pagination: Pagination = Depends(get_pagination),
+                                       version: DataVersion = Depends(get_data_version)):
+    if version.is_not_modified(request):
+        return Response(status_code=304, headers=version.headers())
+    user = request.state.user
+    instances, next_cursor = await crud.paginate_values(
+        Transaction.get_transactions_by_category(user.id, category_id, transaction_type), pagination, 'Transaction'
+    )
+    return ORJSONResponse({'user_id': user.id, 'username': user.username, 'transactions': instances,
+                           'next_cursor': next_cursor}, headers=version.headers())
+
+
+@router.get('/export')
+async def export_transactions(request: Request, format: str = Query('csv', regex='^(csv|ndjson)$')):
     user = request.state.user
-    instances = await Transaction.get_transactions_by_category(user.id, category_id, transaction_type)
-    return {'user_id': user.id, 'username': user.username, 'transactions': instances}
+    chunks = crud.iterate_values(crud.get_instances_by_user_id(user.id, 'Transaction'), EXPORT_FIELDS,
+                                 config.EXPORT_CHUNK_SIZE)
+    if format == 'csv':
+        return StreamingResponse(csv_stream(chunks, EXPORT_FIELDS), media_type='text/csv',
+                                 headers={'Content-Disposition': 'attachment; filename="transactions.csv"'})
+    return StreamingResponse(ndjson_stream(chunks), media_type='application/x-ndjson')
 
 
 @router.get('/detail/{transaction_id}', response_model=Transaction_Schema)
 async def get_transaction(transaction_id: int):
     instance = await crud.get_object_by_id(transaction_id, 'Transaction')
-    return await Transaction_Schema.from_tortoise_orm(instance)
+    return Transaction_Schema.from_orm(instance)
 
 
 @router.patch('/detail/{transaction_id}/edit', response_model=Transaction_Schema)
 async def edit_transaction(transaction_id: int, data: EditTransaction):
     instance = await crud.update_instance(data, transaction_id, 'Transaction')
-    return await Transaction_Schema.from_tortoise_orm(instance)
+    return Transaction_Schema.from_orm(instance)
 
 
 @router.delete('/detail/{transaction_id}/delete')
@@ -1,18 +1,76 @@
-from fastapi import APIRouter, Depends, Request
+from fastapi import APIRouter, Depends, Request, Header, Query
+from fastapi.responses import StreamingResponse, ORJSONResponse, Response
 
-from db.schema import User_Schema, EditUser, MessageList
+from db.schema import User_Schema, EditUser, MessageList, Pagination, BalanceAt
 from db import crud
 from db.models import Message
+from dependencies import get_pagination, get_data_version, rate_limit, route_reads
+from utils.conditional import DataVersion
 
 from utils.authentication import get_current_user
+from utils.pubsub import hub, Subscription
+from utils.database import read_from_replica
+import config
+
+from tortoise import timezone
+
+from typing import Optional, AsyncIterator, Callable, Awaitable
+from datetime import date
+import orjson
 
 router = APIRouter(
     prefix='/users',
     tags=['users'],
-    dependencies=[Depends(get_current_user)]
+    dependencies=[Depends(get_current_user), Depends(rate_limit), Depends(route_reads)]
 )
 
 
+async def message_events(subscription: Subscription, last_id: int,
+                         is_disconnected: Callable[[], Awaitable[bool]]) -> AsyncIterator[str]:
+    """
+    Server-sent events with user messages which have id greater than `last_id`.
+    Hub notifications only wake the stream up, rows are always read from DB, so nothing is lost between wakeups
+    """
+    while not await is_disconnected():
+        messages = await Message.get_messages(subscription.user_id).filter(id__gt=last_id).order_by('id').limit(
+            config.PAGE_SIZE).values('id', 'text', 'created')
+        for message in messages:
+            yield f'id: {message["id"]}\nevent: message\ndata: {orjson.dumps(message).decode()}\n\n'
+        if messages:
+            last_id = messages[-1]['id']
+            continue
+        if not await subscription.wait(config.MESSAGE_STREAM_KEEPALIVE):
+            yield ': keepalive\n\n'
+
+
+@router.get('/me/messages/stream')
+async def stream_user_messages(request: Request, last_event_id: Optional[int] = Header(None),
+                               after: Optional[int] = Query(None, description='Id of the last received message')):
+    """ Pushes new messages of current user. Reconnecting clients resume with Last-Event-ID header or `after` """
+    user = request.state.user
+    last_id = last_event_id if last_event_id is not None else after
+
+    async def events():
+        read_from_replica.set(False)  #: a notified message has to be readable right away, replica may lag
+        async with hub.subscribe(user.id) as subscription:
+            start_id = last_id if last_id is not None else await crud.get_last_message_id(user.id)
+            async for event in message_events(subscription, start_id, request.is_disconnected):
+                yield event
+
+    return StreamingResponse(events(), media_type='text/event-stream',
+                             headers={'Cache-Control': 'no-cache', 'X-Accel-Buffering': 'no'})
+
+
+@router.get('/me/balance', response_model=BalanceAt)
+async def get_balance_at(request: Request, at: Optional[date] = None):
+    """ Balance at the end of the day `at`, today by default. Starts from the nearest balance checkpoint
+        and adds only transactions effective after it """
+    user = request.state.user
+    at = at or timezone.localtime(timezone.now()).date()
+    balance, checkpoint = await crud.get_balance_at(user.id, at)
+    return {'user_id': user.id, 'at': at, 'balance': round(balance, 2), 'checkpoint': checkpoint}
+
+
 @router.get('/detail/{user_id}', response_model=User_Schema)
 async def get_user_handler(user_id: int):
     return await crud.get_object_by_id(user_id, 'User')
@@ -29,7 +87,11 @@ async def edit_user_data(user_id: int, data: EditUser):
 
 
 @router.get('/detail/{user_id}/messages', response_model=MessageList)
-async def get_user_messages(request: Request, user_id: int):
+async def get_user_messages(request: Request, user_id: int, pagination: Pagination = Depends(get_pagination),
+                            version: DataVersion = Depends(get_data_version)):
+    if version.is_not_modified(request):
+        return Response(status_code=304, headers=version.headers())
     user = request.state.user
-    instances = await Message.get_messages(user_id)
-    return {'user_id': user_id, 'username': user.username, 'messages': instances}
+    instances, next_cursor = await crud.paginate_values(Message.get_messages(user_id), pagination, 'Message')
+    return ORJSONResponse({'user_id': user_id, 'username': user.username, 'messages': instances,
+                           'next_cursor': next_cursor}, headers=version.headers())
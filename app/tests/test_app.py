@@ -1,19 +1,47 @@
 import pytest
 from fastapi.testclient import TestClient
-from fastapi import FastAPI
+from fastapi import FastAPI, BackgroundTasks
 
-from typing import Generator
+from typing import Generator, Optional
+from contextlib import contextmanager
 
+from tortoise import Tortoise
 from tortoise.contrib.test import finalizer, initializer
+from tortoise.backends.sqlite.client import SqliteClient
+from tortoise.router import router as connection_router
+from tortoise.transactions import current_transaction_map, in_transaction
+from tortoise.expressions import F
+from aerich.models import Aerich
 
 from routers import users, categories, transactions, admin
-from utils.authentication import router as auth_router, get_password_hash
+from routers.users import message_events
+from utils.authentication import router as auth_router, get_password_hash, get_password_hash_async, verify_password
+from utils.cache import principal_cache
+from utils.hashing import password_hasher
+from utils.mailer import mailer, SMTPPool
+from utils.pubsub import hub
+from utils.ratelimit import rate_limiter, MemoryBackend
+from utils.metrics import metrics
+from utils.middleware import RequestLogMiddleware, MetricsMiddleware, LoadSheddingMiddleware
+from utils.metrics import instrument_db, instrument_background_tasks
+import logger
+from utils.send_mail import send_message
+from utils import database, pubsub, startup, timeline
 import config
 
-from db.models import Transaction, User
+from db.models import Transaction, User, Category, BalanceCheckpoint, MailBroadcast
+from db import crud, rollup, checkpoints
 from celery_utils.celery_main import check_transaction_planned_date
 
-from datetime import datetime, date
+from datetime import datetime, date, timezone
+import asyncio
+import json
+import gzip
+import time
+import uuid
+from contextvars import ContextVar
+
+import numpy as np
 
 user_data = {
     'username': 'test_user',
@@ -31,6 +59,9 @@ app.include_router(auth_router)
 app.include_router(categories.router)
 app.include_router(transactions.router)
 app.include_router(admin.router)
+app.add_middleware(LoadSheddingMiddleware, exempt=('/admin/metrics', '/users/me/messages/stream'))
+app.add_middleware(RequestLogMiddleware)
+app.add_middleware(MetricsMiddleware)
 
 
 @app.on_event('startup')
@@ -42,11 +73,15 @@ async def startup_event():
         email=config.ADMIN_EMAIL,
         is_admin=True
     )
+    await hub.start()
+    instrument_db()
+    instrument_background_tasks()
+    startup.register_collectors()
 
 
 @pytest.fixture(scope='module', autouse=True)
 def client() -> Generator:
-    initializer(['db.models'], db_url='sqlite:///:memory')
+    initializer(['db.models', 'aerich.models'], db_url='sqlite:///:memory')
     with TestClient(app) as c:
         yield c
     finalizer()
@@ -78,6 +113,24 @@ def create_transactions(client: TestClient, get_token):
         client.post('/transactions/create', json=data, headers=get_token)
 
 
+@contextmanager
+def count_queries():
+    """ Collects SQL sent through the default connection outside of DB transactions """
+    db = Transaction._meta.db
+    queries = []
+    methods = ('execute_query', 'execute_query_dict', 'execute_insert', 'execute_many')
+    for name in methods:
+        async def execute(query, *args, _execute=getattr(db, name), **kwargs):
+            queries.append(query)
+            return await _execute(query, *args, **kwargs)
+        setattr(db, name, execute)
+    try:
+        yield queries
+    finally:
+        for name in methods:
+            delattr(db, name)
+
+
 def test_startup_event(client: TestClient):
     data = {
         'username': config.ADMIN_USERNAME,
@@ -114,6 +167,22 @@ def test_success_login(client: TestClient):
     assert 'access_token' in response.json().keys()
 
 
+def test_password_hashing_off_event_loop(client: TestClient):
+    event_loop = client.task.get_loop()
+
+    async def hash_passwords():
+        ticks = 0
+        task = asyncio.ensure_future(asyncio.gather(*(get_password_hash_async('secret') for _ in range(3))))
+        while not task.done():
+            ticks += 1
+            await asyncio.sleep(0.01)
+        return ticks, task.result()
+    ticks, hashes = event_loop.run_until_complete(hash_passwords())
+    assert ticks > 1  #: event loop kept running while hashing
+    assert all(verify_password('secret', password_hash) for password_hash in hashes)
+    assert password_hasher.queue_depth == 0
+
+
 def test_get_detail(get_token, client: TestClient):
     response = client.get('/users/detail/2', headers=get_token)
     assert response.status_code == 200
@@ -132,6 +201,25 @@ def test_edit_user(get_token, client: TestClient):
     assert response_data['use_fixed_balance'] is True
 
 
+def test_principal_cache(get_token, client: TestClient):
+    principal_cache.clear()
+    hits, misses = principal_cache.hits, principal_cache.misses
+    client.get('/users/detail/2', headers=get_token)
+    response = client.get('/users/detail/2', headers=get_token)
+    assert response.status_code == 200
+    assert principal_cache.misses == misses + 1
+    assert principal_cache.hits == hits + 1
+
+    response = client.patch('/users/detail/2', json={'fixed_balance': 100000}, headers=get_token)
+    assert response.status_code == 200
+    assert principal_cache.stats()['size'] == 0
+    client.get('/users/detail/2', headers=get_token)
+    assert principal_cache.misses == misses + 2
+
+    hub.dispatch(pubsub.PRINCIPALS, 2)  # another worker changed the user
+    assert principal_cache.stats()['size'] == 0
+
+
 def test_create_category(get_token, client: TestClient):
     data = {
         'name': 'Test category'
@@ -189,34 +277,160 @@ def test_list_of_transactions(get_token, client: TestClient, create_transactions
     assert len(response_data.get('transactions')) == 6
 
 
+def test_list_of_transactions_pagination(get_token, client: TestClient):
+    response = client.get('/transactions/all', headers=get_token, params={'limit': 4})
+    assert response.status_code == 200
+    first_page = response.json()
+    assert len(first_page['transactions']) == 4
+    assert first_page['next_cursor'] is not None
+
+    response = client.get('/transactions/all', headers=get_token,
+                          params={'limit': 4, 'after': first_page['next_cursor']})
+    assert response.status_code == 200
+    second_page = response.json()
+    assert len(second_page['transactions']) == 2
+    assert second_page['next_cursor'] is None
+    ids = [item['id'] for item in first_page['transactions'] + second_page['transactions']]
+    assert ids == sorted(set(ids))
+    for item in second_page['transactions']:  # rows serialized from .values() match the pydantic schema
+        assert client.get(f'/transactions/detail/{item["id"]}', headers=get_token).json() == item
+
+    response = client.get('/transactions/all', headers=get_token, params={'after': 'wrong'})
+    assert response.status_code == 400
+
+
+def test_transaction_endpoints_query_count(get_token, client: TestClient):
+    transactions = client.get('/transactions/all', headers=get_token).json()['transactions']
+    assert len(transactions) > 1
+    urls = ('/transactions/all?limit=1', '/transactions/all?limit=100',
+            '/transactions/all/True/?limit=1', '/transactions/all/True/?limit=100',
+            '/transactions/all/by_category/1?limit=1', '/transactions/all/by_category/1?limit=100',
+            f'/transactions/detail/{transactions[0]["id"]}')
+    for url in urls:
+        with count_queries() as queries:
+            response = client.get(url, headers=get_token)
+        assert response.status_code == 200
+        # principal is cached, category_id is read from the row, lists also look up the data version for ETag
+        assert len(queries) == (1 if '/detail/' in url else 2), (url, queries)
+        assert all(transaction['category_id'] for transaction in response.json().get('transactions', []))
+
+
+def test_query_transactions(get_token, client: TestClient):
+    transactions = client.get('/transactions/all', headers=get_token).json()['transactions']
+    category_ids = sorted({transaction['category_id'] for transaction in transactions})
+    params = {'type': True, 'category': category_ids, 'min_sum': 0, 'max_sum': 10 ** 6, 'status': 'settled',
+              'order': '-sum', 'from': '2000-01-01', 'to': '2100-01-01'}
+    expected = sorted((transaction for transaction in transactions if transaction['type']),
+                      key=lambda transaction: (transaction['sum'], transaction['id']), reverse=True)
+    assert expected
+    with count_queries() as queries:
+        response = client.get('/transactions/query', headers=get_token, params=params)
+    assert response.status_code == 200
+    assert response.json()['transactions'] == expected
+    assert len(queries) == 2  # data version for ETag and one SELECT
+
+    pages, cursor = [], None
+    while True:
+        response = client.get('/transactions/query', headers=get_token,
+                              params={'order': 'sum', 'limit': 2, **({'after': cursor} if cursor else {})})
+        assert response.status_code == 200
+        pages += response.json()['transactions']
+        cursor = response.json()['next_cursor']
+        if cursor is None:
+            break
+    assert pages == sorted(transactions, key=lambda transaction: (transaction['sum'], transaction['id']))
+
+    response = client.get('/transactions/query', headers=get_token, params={'category': category_ids[0]})
+    assert [item['id'] for item in response.json()['transactions']] == [
+        transaction['id'] for transaction in transactions if transaction['category_id'] == category_ids[0]]
+    response = client.get('/transactions/query', headers=get_token, params={'status': 'planned'})
+    assert response.json()['transactions'] == []
+
+    first_page = client.get('/transactions/query', headers=get_token, params={'order': 'sum', 'limit': 1}).json()
+    response = client.get('/transactions/query', headers=get_token,
+                          params={'order': 'created', 'after': first_page['next_cursor']})
+    assert response.status_code == 400
+    response = client.get('/transactions/query', headers=get_token, params={'min_sum': 10, 'max_sum': 1})
+    assert response.status_code == 400
+    response = client.get('/transactions/query', headers=get_token, params={'order': 'number'})
+    assert response.status_code == 422
+
+
+def test_export_transactions(get_token, client: TestClient, monkeypatch):
+    monkeypatch.setattr(config, 'EXPORT_CHUNK_SIZE', 4)
+    response = client.get('/transactions/export', headers=get_token, params={'format': 'csv'})
+    assert response.status_code == 200
+    assert response.headers['content-type'].startswith('text/csv')
+    lines = response.text.splitlines()
+    assert lines[0] == 'id,number,sum,type,created,category_id'
+    assert len(lines) == 7
+
+    response = client.get('/transactions/export', headers=get_token, params={'format': 'ndjson'})
+    assert response.status_code == 200
+    rows = [json.loads(line) for line in response.text.splitlines()]
+    assert len(rows) == 6
+    assert rows[0]['category_id'] == 1
+
+    response = client.get('/transactions/export', headers=get_token, params={'format': 'xml'})
+    assert response.status_code == 422
+
+
+def test_transactions_summary(get_token, client: TestClient):
+    response = client.get('/transactions/summary', headers=get_token, params={'group_by': 'year'})
+    assert response.status_code == 200
+    summary = response.json()
+    assert summary['income'] == 7000
+    assert summary['income_count'] == 6
+    assert summary['outcome_count'] == 0
+    assert len(summary['periods']) == 1
+    assert summary['periods'][0]['start'] == date(date.today().year, 1, 1).isoformat()
+    assert summary['periods'][0]['categories'] == [
+        {'category_id': 1, 'income': 7000, 'outcome': 0, 'income_count': 6, 'outcome_count': 0}
+    ]
+
+    response = client.get('/transactions/summary', headers=get_token, params={'group_by': 'quarter'})
+    assert response.status_code == 422
+
+
 def test_delete_transaction(get_token, client: TestClient):
     response = client.delete('/transactions/detail/1/delete', headers=get_token)
     assert response.status_code == 200
 
 
-@pytest.mark.skip(reason='Sqlite and Tortoise don`t support date period lookups')
 def test_list_of_transactions_by_period(get_token, client: TestClient, create_transactions):
-    """ There is a problem with testing filtering by period. Sqlite and Tortoise
-        don`t support date period lookups. Only with postgres.
-     """
     event_loop = client.task.get_loop()
 
     async def change_transaction_data():
         transaction_to_edit = await Transaction.first()
-        transaction_to_edit.created = datetime(2021, 7, 21)
+        transaction_to_edit.created = datetime(2021, 7, 21, 12, tzinfo=timezone.utc)
         await transaction_to_edit.save()
     event_loop.run_until_complete(change_transaction_data())
 
-    response = client.get('/transactions/all/statistic/month/7', headers=get_token)
+    response = client.get('/transactions/all/statistic/year/2021', headers=get_token)
+    assert response.status_code == 200
+    assert len(response.json()['transactions']) == 1
+
+    params = {'from': '2021-07-21', 'to': '2021-07-22'}
+    response = client.get('/transactions/all/statistic/month/7', headers=get_token, params=params)
     assert response.status_code == 200
     assert len(response.json()['transactions']) == 1
 
+    params = {'from': '2021-07-22'}
+    response = client.get('/transactions/all/statistic/year/2021', headers=get_token, params=params)
+    assert response.status_code == 200
+    assert len(response.json()['transactions']) == 0
+
+    response = client.get('/transactions/all/statistic/month/13', headers=get_token)
+    assert response.status_code == 400
+
 
 def test_list_of_transactions_by_type(get_token, client: TestClient, create_transactions):
     event_loop = client.task.get_loop()
 
     async def change_transactions_type():
         transaction_to_edit = await Transaction.first()
+        if transaction_to_edit.type:  # bypasses crud, so the balance is kept in line here
+            await User.filter(id=transaction_to_edit.user_id).update(balance=F('balance') - 2 * transaction_to_edit.sum)
         transaction_to_edit.type = False
         await transaction_to_edit.save()
     event_loop.run_until_complete(change_transactions_type())
@@ -232,6 +446,45 @@ def test_user_balance(get_token, client: TestClient, create_transactions):
     assert response.json()['balance'] != 0
 
 
+def test_concurrent_transaction_creates(client: TestClient):
+    event_loop = client.task.get_loop()
+
+    async def create_concurrently():
+        balance_before = (await User.get(id=2)).balance
+        results = await asyncio.gather(*(
+            crud.create_transaction({'sum': 10, 'type': True, 'category_id': 1}, 2) for _ in range(20)
+        ))
+        return balance_before, (await User.get(id=2)).balance, results
+    balance_before, balance_after, results = event_loop.run_until_complete(create_concurrently())
+    assert balance_after == balance_before + 200
+    assert max(balance for _, balance in results) == balance_after
+    numbers = [instance.number for instance, _ in results]
+    assert len(set(numbers)) == len(numbers)
+    assert max(numbers) - min(numbers) == len(numbers) - 1
+
+
+def test_bulk_create_transactions(get_token, client: TestClient):
+    balance = client.get('/users/detail/2', headers=get_token).json()['balance']
+    data = [
+        {'category': 1, 'sum': 300, 'type': True},
+        {'category': 1, 'sum': 100, 'type': False},
+        {'category': 1, 'sum': 50, 'type': True, 'planned': date.today().strftime('%Y-%m-%d')},
+    ]
+    response = client.post('/transactions/bulk', json=data, headers=get_token)
+    assert response.status_code == 200
+    result = response.json()
+    assert result['created'] == 3
+    assert result['last_number'] - result['first_number'] == 2
+    assert result['balance'] == balance + 200
+    assert client.get('/users/detail/2', headers=get_token).json()['balance'] == balance + 200
+
+    response = client.post('/transactions/bulk', json=[{'category': 999, 'sum': 1, 'type': True}],
+                           headers=get_token)
+    assert response.status_code == 404
+    response = client.post('/transactions/bulk', json=[], headers=get_token)
+    assert response.status_code == 422
+
+
 def test_user_fixed_balance(get_token, client: TestClient):
     edit_user_data = {
         'use_fixed_balance': True,
@@ -324,18 +577,314 @@ def test_check_celery(get_token, client: TestClient):
         'type': True,
         'planned': date.today().strftime('%Y-%m-%d')
     }
+    balance = client.get('/users/detail/2', headers=get_token).json()['balance']
     response_create = client.post('/transactions/create', json=data, headers=get_token)
     assert response_create.status_code == 200
+    assert response_create.json()['settled'] is False
     check_transaction_planned_date.apply()
 
+    assert client.get('/users/detail/2', headers=get_token).json()['balance'] == balance + 5 + 50  # planned item from the bulk test is due today too
     response_user_messages = client.get('/users/detail/2/messages', headers=get_token)
     assert response_user_messages.status_code == 200
-    assert len(response_user_messages.json()['messages']) == 11
+    assert len(response_user_messages.json()['messages']) == 14
+
+    assert check_transaction_planned_date.apply().get() == 0
+
+
+def test_transaction_rollup(get_token, client: TestClient):
+    event_loop = client.task.get_loop()
+
+    def summaries():
+        async def get_summaries():
+            settled = Transaction.filter(user_id=2, settled=True)
+            return await crud.get_rollup_summary(2, 'month'), await crud.get_transactions_summary(settled, 'month')
+        return event_loop.run_until_complete(get_summaries())
+
+    assert event_loop.run_until_complete(rollup.rebuild(chunk_size=1, workers=1)) > 0
+    rollup_summary, scanned_summary = summaries()
+    assert rollup_summary == scanned_summary
+    assert rollup_summary['income_count'] > 0
+
+    transaction = client.get('/transactions/all', headers=get_token).json()['transactions'][-1]
+    response = client.patch(f'/transactions/detail/{transaction["id"]}/edit', headers=get_token,
+                            json={'sum': transaction['sum'] + 1000})
+    assert response.status_code == 200
+    assert summaries()[0] == summaries()[1]
+    assert summaries()[0]['income' if transaction['type'] else 'outcome'] == \
+        scanned_summary['income' if transaction['type'] else 'outcome'] + 1000
+
+    client.delete(f'/transactions/detail/{transaction["id"]}/delete', headers=get_token)
+    client.post('/transactions/create', headers=get_token, json={'category': 1, 'sum': 3, 'type': False})
+    rollup_summary, scanned_summary = summaries()
+    assert rollup_summary == scanned_summary
+
+    response = client.get('/transactions/summary', headers=get_token, params={'group_by': 'month'})
+    assert response.json()['income'] == rollup_summary['income']
+
+
+def test_transaction_timeline(get_token, client: TestClient):
+    today = date.today()
+    balance = client.get('/users/detail/2', headers=get_token).json()['balance']
+    transactions = client.get('/transactions/all', headers=get_token).json()['transactions']
+    pending = [transaction for transaction in transactions if not transaction['settled']]
+    assert pending and max(transaction['planned'] for transaction in pending) > today.isoformat()
+
+    with count_queries() as queries:
+        response = client.get('/transactions/timeline', headers=get_token, params={'from': '2021-01-01'})
+    assert response.status_code == 200
+    assert len(queries) == 5  # opening checkpoint and two sums after it, daily totals of regular and of planned
+    data = response.json()
+    assert data['dates'][0] == '2021-01-01' and data['today'] == today.isoformat()
+    assert data['dates'][-1] == max(transaction['planned'] for transaction in pending)
+
+    def day_of(transaction: dict) -> str:
+        day = transaction['planned'] or transaction['created'][:10]
+        return day if transaction['settled'] else max(day, today.isoformat())
+
+    def delta(transaction: dict) -> float:
+        return transaction['sum'] if transaction['type'] else -transaction['sum']
+
+    for day, value in zip(data['dates'], data['balance']):  # replaying transactions gives the same series
+        expected = balance - sum(delta(transaction) for transaction in transactions
+                                 if transaction['settled'] and day_of(transaction) > day) + \
+            sum(delta(transaction) for transaction in pending if day_of(transaction) <= day)
+        assert value == pytest.approx(expected), day
+
+    response = client.get('/transactions/timeline', headers=get_token, params={'forecast': 3, 'from': '2021-01-01',
+                                                                             'to': '2022-01-01'})
+    assert response.status_code == 200
+    data = response.json()
+    assert data['dates'][-1] == '2021-12-31'
+    assert [month['start'] for month in data['forecast']] == [
+        date(today.year + (today.month + index) // 12, (today.month + index) % 12 + 1, 1).isoformat()
+        for index in range(3)]
+    assert all(month['net'] == pytest.approx(sum(category['net'] for category in month['categories']))
+               for month in data['forecast'])
+
+    history = np.array([[10 + 2 * month for month in range(30)], [-5] * 30], dtype=float)
+    assert timeline.forecast(history, date(2020, 1, 1), 2) == pytest.approx(np.array([[70, 72], [-5, -5]]))
+
+    response = client.get('/transactions/timeline', headers=get_token, params={'from': '1900-01-01'})
+    assert response.status_code == 400
+    response = client.get('/transactions/timeline', headers=get_token, params={'to': '2000-01-01'})
+    assert response.status_code == 400
+
+
+def test_balance_checkpoints(get_token, client: TestClient):
+    event_loop = client.task.get_loop()
+    today = date.today().isoformat()
+
+    def ledger(day: str) -> float:
+        transactions = client.get('/transactions/all', headers=get_token).json()['transactions']
+        return sum(transaction['sum'] if transaction['type'] else -transaction['sum'] for transaction in transactions
+                   if transaction['settled'] and (transaction['planned'] or transaction['created'][:10]) <= day)
+
+    def balance_at(day: str) -> dict:
+        response = client.get('/users/me/balance', headers=get_token, params={'at': day})
+        assert response.status_code == 200
+        return response.json()
+
+    assert event_loop.run_until_complete(checkpoints.rebuild(chunk_size=1, workers=1)) > 0
+    assert event_loop.run_until_complete(checkpoints.check(chunk_size=1, workers=1)) == []
+    assert client.get('/users/me/balance', headers=get_token).json()['at'] == today
+    for day, checkpoint in (('2021-07-20', None), ('2021-07-21', None), ('2021-08-15', '2021-08-01'),
+                            (today, '2021-08-01')):
+        with count_queries() as queries:
+            data = balance_at(day)
+        assert len(queries) == 3  # nearest checkpoint and sums of regular and planned transactions after it
+        assert data['balance'] == pytest.approx(ledger(day)) and data['checkpoint'] == checkpoint
+
+    old = next(transaction for transaction in client.get('/transactions/all', headers=get_token).json()[
+        'transactions'] if transaction['created'].startswith('2021-07'))
+    before = balance_at('2021-08-15')['balance']
+    response = client.patch(f'/transactions/detail/{old["id"]}/edit', headers=get_token, json={'sum': old['sum'] + 10})
+    assert response.status_code == 200
+    assert balance_at('2021-08-15')['balance'] == pytest.approx(before + (10 if old['type'] else -10))
+    assert event_loop.run_until_complete(checkpoints.check(chunk_size=1, workers=1)) == []
+
+    async def break_and_add_checkpoints():
+        await BalanceCheckpoint.filter(user_id=2).update(balance=F('balance') + 1)
+        mismatches = await checkpoints.check()
+        await BalanceCheckpoint.filter(user_id=2).delete()
+        return mismatches, await checkpoints.add_checkpoints(date(2021, 8, 1)), await checkpoints.check()
+    mismatches, added, after = event_loop.run_until_complete(break_and_add_checkpoints())
+    assert [(mismatch.user_id, mismatch.date) for mismatch in mismatches] == [(2, date(2021, 8, 1))]
+    assert added == 1 and after == []
+    assert balance_at('2021-08-15')['balance'] == pytest.approx(ledger('2021-08-15'))
+
+
+def test_balance_follows_edits(get_token, client: TestClient):
+    category_id = client.get('/transactions/all', headers=get_token).json()['transactions'][0]['category_id']
+
+    def balances() -> tuple[float, float]:
+        stored = client.get('/users/detail/2', headers=get_token).json()['balance']
+        return stored, client.get('/users/me/balance', headers=get_token).json()['balance']
+
+    income, outcome = (client.post('/transactions/create', headers=get_token,
+                                   json={'sum': total, 'category': category_id, 'type': type}).json()
+                       for total, type in ((100, True), (40, False)))
+    stored, ledger = balances()
+    assert stored == pytest.approx(ledger)
+
+    response = client.patch(f'/transactions/detail/{income["id"]}/edit', headers=get_token, json={'sum': 500})
+    assert response.status_code == 200
+    assert balances() == pytest.approx((stored + 400, ledger + 400))
+    response = client.delete(f'/transactions/detail/{outcome["id"]}/delete', headers=get_token)
+    assert response.status_code == 200
+    assert balances() == pytest.approx((stored + 440, ledger + 440))
+
+
+def test_conditional_list_requests(get_token, client: TestClient):
+    response = client.get('/transactions/all', headers=get_token)
+    assert response.status_code == 200
+    etag = response.headers['etag']
+    assert 'last-modified' in response.headers
+
+    with count_queries() as queries:
+        response = client.get('/transactions/all', headers={**get_token, 'If-None-Match': etag})
+    assert response.status_code == 304
+    assert response.content == b''
+    assert len(queries) == 1 and 'data_version' in queries[0]
+    response = client.get('/transactions/all', headers={**get_token, 'If-Modified-Since': 'Fri, 01 Jan 2100 00:00:00 GMT'})
+    assert response.status_code == 304
+    last_modified = client.get('/transactions/all', headers=get_token).headers['last-modified']
+    response = client.get('/transactions/all', headers={**get_token, 'If-Modified-Since': last_modified})
+    assert response.status_code == 304
+    response = client.get('/transactions/all', headers={**get_token, 'If-Modified-Since': 'Fri, 01 Jan 2021 00:00:00 GMT'})
+    assert response.status_code == 200
+
+    categories_etag = client.get('/categories/all', headers=get_token).headers['etag']
+    assert categories_etag == etag  # version is shared by all data of the user
+    response = client.post('/categories/create', json={'name': 'Conditional'}, headers=get_token)
+    assert response.status_code == 200
+    for url in ('/transactions/all', '/categories/all'):
+        response = client.get(url, headers={**get_token, 'If-None-Match': etag})
+        assert response.status_code == 200
+        assert response.headers['etag'] != etag
+
+    messages_etag = client.get('/users/detail/2/messages', headers=get_token).headers['etag']
+    event_loop = client.task.get_loop()
+    background_tasks = BackgroundTasks()
+    event_loop.run_until_complete(send_message(2, 'New message', background_tasks))
+    event_loop.run_until_complete(background_tasks())
+    response = client.get('/users/detail/2/messages', headers={**get_token, 'If-None-Match': messages_etag})
+    assert response.status_code == 200
+
+
+def test_messages_stream(client: TestClient):
+    event_loop = client.task.get_loop()
+
+    async def is_disconnected():
+        return False
+
+    async def stream():
+        async with hub.subscribe(2) as subscription:
+            last_id = await crud.get_last_message_id(2)
+            events = message_events(subscription, last_id - 1, is_disconnected)
+            resumed = await events.__anext__()
+            waiting = asyncio.ensure_future(events.__anext__())
+            await asyncio.sleep(0.1)
+            assert not waiting.done()
+
+            background_tasks = BackgroundTasks()
+            await send_message(2, 'Pushed message', background_tasks)
+            await background_tasks()
+            pushed = await asyncio.wait_for(waiting, 1)
+            await events.aclose()
+            return last_id, resumed, pushed
+    last_id, resumed, pushed = event_loop.run_until_complete(stream())
+    assert resumed.startswith(f'id: {last_id}\nevent: message\n')
+    assert pushed.startswith(f'id: {last_id + 1}\n')
+    assert json.loads(pushed.split('data: ')[1])['text'] == 'Pushed message'
+    assert 2 not in hub.subscriptions
+
+
+def test_startup_helpers(client: TestClient, monkeypatch):
+    async def hash_password(password: str):
+        raise AssertionError('Admin exists, password must not be hashed')
+
+    monkeypatch.setattr(startup, 'get_password_hash_async', hash_password)
+    created = client.task.get_loop().run_until_complete(
+        startup.ensure_admin(config.ADMIN_USERNAME, 'another password', config.ADMIN_EMAIL))
+    assert created is False
+
+    versions = startup.migration_versions()
+    assert [int(version.split('_', 1)[0]) for version in versions] == list(range(len(versions)))
+    assert versions[0] == '0_20210829000000_init.sql'
+
+    async def check_migrations() -> Optional[str]:
+        try:
+            await startup.check_migrations()
+        except RuntimeError as error:
+            return str(error)
+
+    loop = client.task.get_loop()
+    loop.run_until_complete(Aerich.bulk_create([Aerich(version=version, app='models', content={})
+                                                for version in versions]))
+    assert loop.run_until_complete(check_migrations()) is None
+    loop.run_until_complete(Aerich.filter(version=versions[-1]).delete())
+    error = loop.run_until_complete(check_migrations())  # production mode refuses to start
+    assert error and f'pending: {versions[-1]}' in error
+
+
+def test_replica_routing(get_token, client: TestClient):
+    loop = client.task.get_loop()
+    replica = SqliteClient(':memory:', connection_name=database.REPLICA)
+
+    async def create_replica():
+        """ Second database with a snapshot of users and categories, later writes are not replicated """
+        await replica.create_connection(with_db=True)
+        _, tables = await Category._meta.db.execute_query(
+            "SELECT sql FROM sqlite_master WHERE sql IS NOT NULL AND name NOT LIKE 'sqlite_%' ORDER BY type DESC")
+        await replica.execute_script(';\n'.join(table['sql'] for table in tables))
+        for model in (User, Category):
+            rows = await model.all().values()
+            await model.bulk_create([model(**row) for row in rows], using_db=replica)
+        Tortoise._connections[database.REPLICA] = replica
+        current_transaction_map[database.REPLICA] = ContextVar(database.REPLICA, default=replica)
+        connection_router.init_routers([database.ReplicaRouter])
+
+    async def count_in_transaction() -> int:
+        async with in_transaction(Category._meta.default_connection):
+            database.read_from_replica.set(True)
+            return await Category.all().count()
+
+    def category_names() -> list:
+        response = client.get('/categories/all', headers=get_token)
+        return [category['name'] for category in response.json()['categories']]
+
+    try:
+        loop.run_until_complete(create_replica())
+        database._last_writes.clear()
+        names = category_names()
+        assert client.post('/categories/create', json={'name': 'Not replicated'}, headers=get_token).status_code == 200
+        assert category_names() == names + ['Not replicated']  #: own write is read from primary
+
+        database._last_writes.clear()  # sticky period is over
+        assert category_names() == names  #: replica lags behind
+        export = client.get('/transactions/export', headers=get_token)
+        assert export.text.splitlines() == ['id,number,sum,type,created,category_id']  #: transactions weren't copied
+
+        # Reads inside a transaction see the primary even if replica is allowed
+        primary_count = loop.run_until_complete(Category.all().count())
+        assert loop.run_until_complete(count_in_transaction()) == primary_count
+    finally:
+        connection_router.init_routers([])
+        Tortoise._connections.pop(database.REPLICA, None)
+        current_transaction_map.pop(database.REPLICA, None)
+        loop.run_until_complete(replica.close())
+        database._last_writes.clear()
 
 
 def test_delete_category(get_token, client: TestClient):
+    event_loop = client.task.get_loop()
+    transactions = client.get('/transactions/all', headers=get_token).json()['transactions']
+    assert any(transaction['category_id'] == 1 and transaction['settled'] and transaction['created'] < '2021-08'
+               for transaction in transactions)
     response = client.delete('/categories/detail/1/delete', headers=get_token)
     assert response.status_code == 200
+    # Transactions of the category are deleted by cascade, checkpoints must not keep their sums
+    assert event_loop.run_until_complete(checkpoints.check()) == []
 
 
 def test_access_to_admin(get_token, get_admin_token, client: TestClient):
@@ -366,6 +915,133 @@ def test_change_user_admin_status(get_token, get_admin_token, client: TestClient
     assert new_response.json()['admin-panel'] == 'You have access to this page'
 
 
+def test_admin_metrics(get_token, get_admin_token, client: TestClient):
+    def scrape() -> dict:
+        response = client.get('/admin/metrics', headers=get_admin_token)
+        assert response.status_code == 200
+        assert response.headers['content-type'].startswith('text/plain')
+        return dict(line.rsplit(' ', 1) for line in response.text.splitlines() if not line.startswith('#'))
+
+    transaction_id = client.get('/transactions/all', headers=get_token).json()['transactions'][0]['id']
+    before = scrape()
+    client.get(f'/transactions/detail/{transaction_id}', headers=get_token)
+    after = scrape()
+
+    labels = 'method="GET",route="/transactions/detail/{transaction_id}"'
+    assert int(after[f'http_requests_total{{{labels},status="200"}}']) == \
+        int(before.get(f'http_requests_total{{{labels},status="200"}}', 0)) + 1
+    # Detail is a single query, so only the "le=1" bucket of the route grows
+    assert int(after[f'http_request_db_queries_bucket{{{labels},le="1"}}']) - \
+        int(before.get(f'http_request_db_queries_bucket{{{labels},le="1"}}', 0)) == 1
+    assert after[f'http_request_db_queries_bucket{{{labels},le="0"}}'] == \
+        before.get(f'http_request_db_queries_bucket{{{labels},le="0"}}', '0')
+    assert int(after['db_queries_total']) > int(before['db_queries_total'])
+    assert after['http_requests_in_flight'] == '1'  # the metrics request itself
+    assert {'auth_cache_hits_total', 'auth_cache_entries', 'password_hash_queue_depth'} <= after.keys()
+
+    assert client.get('/admin/metrics').status_code == 401
+
+
+def test_rate_limit_and_load_shedding(get_token, get_admin_token, client: TestClient, monkeypatch):
+    monkeypatch.setattr(rate_limiter, 'backend', MemoryBackend())
+    monkeypatch.setattr(rate_limiter, 'limits', {'read': (1, 2), 'write': (0, 0)})
+    statuses = [client.get('/categories/all', headers=get_token).status_code for _ in range(3)]
+    assert statuses == [200, 200, 429]
+    response = client.get('/categories/all', headers=get_token)
+    assert response.status_code == 429 and response.headers['retry-after'] == '1'
+    assert client.get('/categories/all', headers=get_admin_token).status_code == 200  #: buckets are per user
+    monkeypatch.setattr(rate_limiter, 'limits', {})
+
+    backend, event_loop = MemoryBackend(maxsize=2), client.task.get_loop()
+    for key in ('busy', 'idle', 'busy', 'new'):  # a key in use is not evicted by new keys
+        event_loop.run_until_complete(backend.acquire(key, 1, 1))
+    assert list(backend._buckets) == ['busy', 'new']
+    assert event_loop.run_until_complete(backend.acquire('busy', 1, 1)) > 0
+
+    # Average DB connection wait over the threshold sheds everything except exempt paths
+    monkeypatch.setattr(config, 'SHED_MAX_POOL_WAIT', 0.5)
+    monkeypatch.setattr(metrics, '_pool_wait', 10.0)
+    monkeypatch.setattr(metrics, '_pool_wait_updated', time.monotonic())
+    response = client.get('/categories/all', headers=get_token)
+    assert response.status_code == 503 and response.headers['retry-after'] == str(config.SHED_RETRY_AFTER)
+    scraped = client.get('/admin/metrics', headers=get_admin_token)
+    assert scraped.status_code == 200
+    assert int(next(line for line in scraped.text.splitlines() if line.startswith('http_requests_shed_total ')).split()[1]) >= 1
+
+    monkeypatch.setattr(metrics, '_pool_wait', 0.0)
+    assert client.get('/categories/all', headers=get_token).status_code == 200
+
+    shedder = LoadSheddingMiddleware(app)
+    monkeypatch.setattr(config, 'SHED_MAX_IN_FLIGHT', 2)
+    shedder.in_flight = 2
+    assert shedder.overloaded()
+    shedder.in_flight = 1
+    assert not shedder.overloaded()
+
+
 def test_getting_admin_log(get_admin_token, client: TestClient):
+    request_id = uuid.uuid4().hex  #: app.log outlives the test run, records of earlier runs stay in it
+    response = client.post('/categories/create', json={'name': 'Logged'},
+                           headers={**get_admin_token, 'X-Request-ID': request_id})
+    assert response.headers['x-request-id'] == request_id
+    logger.flush()
+
     response = client.get('/admin/get_log_file', headers=get_admin_token)
     assert response.status_code == 200
+    records = [json.loads(line) for line in response.text.splitlines() if line.startswith('{')]
+    records = [record for record in records if record['request_id'] == request_id]
+    assert [record['message'] for record in records] == ['Created new category', 'request']
+    assert records[1]['status'] == 200 and records[1]['path'] == '/categories/create'
+    assert records[1]['latency_ms'] > 0
+
+
+def test_log_rotation(tmp_path, monkeypatch):
+    monkeypatch.setattr(config, 'LOG_MAX_BYTES', 1000)
+    monkeypatch.setattr(config, 'LOG_BACKUP_COUNT', 2)
+    file = tmp_path / 'rotated.log'
+    rotated_log = logger.get_logger('rotation', file=str(file))
+    for index in range(100):
+        rotated_log.info('line', extra={'index': index})
+    logger.flush(rotated_log)
+    assert sorted(path.name for path in tmp_path.iterdir()) == ['rotated.log', 'rotated.log.1.gz', 'rotated.log.2.gz']
+    with gzip.open(tmp_path / 'rotated.log.1.gz', 'rt') as rotated:
+        assert json.loads(rotated.readline())['message'] == 'line'
+
+
+def test_broadcast_mailing(get_admin_token, client: TestClient):
+    controller_module = pytest.importorskip('aiosmtpd.controller')  # test SMTP server, see requirements-test.txt
+
+    class Handler:
+        def __init__(self):
+            self.recipients = []
+
+        async def handle_DATA(self, server, session, envelope):
+            self.recipients.extend(envelope.rcpt_tos)
+            return '250 OK'
+
+    handler = Handler()
+    controller = controller_module.Controller(handler, hostname='127.0.0.1', port=8025)
+    controller.start()
+    pool = mailer.pool
+    mailer.pool = SMTPPool(3, '127.0.0.1', 8025)
+    try:
+        event_loop = client.task.get_loop()
+        event_loop.run_until_complete(User.bulk_create(
+            [User(username=f'mailing_{i}', password='x', email=f'mailing_{i}@example.com') for i in range(50)]
+        ))
+
+        response = client.get('/admin/broadcast', params={'text': 'Hello'}, headers=get_admin_token)
+        assert response.status_code == 200
+        job_id = response.json()['id']
+        job = client.get(f'/admin/broadcast/{job_id}', headers=get_admin_token).json()
+        assert job['status'] == 'finished'
+        assert job['sent'] == job['total'] == len(handler.recipients) >= 50
+        assert job['failed'] == 0
+        stored = event_loop.run_until_complete(MailBroadcast.get(id=job_id))  # any worker reads the same row
+        assert (stored.status, stored.sent) == ('finished', job['sent'])
+        assert len(set(handler.recipients)) == len(handler.recipients)
+        assert mailer.pool.opened <= 3  # connections are reused between messages
+        assert client.get('/admin/broadcast/unknown', headers=get_admin_token).status_code == 404
+    finally:
+        mailer.pool = pool
+        controller.stop()
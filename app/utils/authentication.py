@@ -6,6 +6,8 @@ from jose import JWTError, jwt
 
 from db.crud import get_user_by_username, create_instance
 from db.schema import Token, TokenData, UserIn
+from utils.cache import Principal, principal_cache
+from utils.hashing import password_hasher
 
 from fastapi.security import OAuth2PasswordBearer, OAuth2PasswordRequestForm
 from fastapi import Depends, HTTPException, status, APIRouter, Request
@@ -32,11 +34,19 @@ def get_password_hash(password: str) -> str:
     return pwd_context.hash(password)
 
 
+async def verify_password_async(plain_password: str, hashed_password: str) -> bool:
+    return await password_hasher.run(verify_password, plain_password, hashed_password)
+
+
+async def get_password_hash_async(password: str) -> str:
+    return await password_hasher.run(get_password_hash, password)
+
+
 async def authenticate_user(username: str, password: str):
     user = await get_user_by_username(username)
     if not user:
         return False
-    if not verify_password(password, user.password):
+    if not await verify_password_async(password, user.password):
         return False
     return user
 
@@ -53,6 +63,10 @@ def create_access_token(data: dict, expires_delta: Optional[timedelta] = None) -
 
 
 async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)):
+    cached = principal_cache.get(token)
+    if cached is not None:
+        request.state.token_claims, request.state.user = cached
+        return
     credentials_exception = HTTPException(
         status_code=status.HTTP_401_UNAUTHORIZED,
         detail='Could not validate credentials',
@@ -69,7 +83,10 @@ async def get_current_user(request: Request, token: str = Depends(oauth2_scheme)
     user = await get_user_by_username(token_data.username)
     if user is None:
         raise credentials_exception
-    request.state.user = user
+    principal = Principal.from_user(user)
+    principal_cache.set(token, payload, principal)
+    request.state.token_claims = payload
+    request.state.user = principal
 
 
 @router.post('/', response_model=Token)
@@ -90,7 +107,7 @@ async def login_for_access_token(form_data: OAuth2PasswordRequestForm = Depends(
 
 @router.post('/sign-up', response_model=Token)
 async def create_user_handler(user: UserIn):
-    user.password = get_password_hash(user.password)
+    user.password = await get_password_hash_async(user.password)
     user = await create_instance(user.dict(), 'User')
     access_token_expires = timedelta(minutes=ACCESS_TOKEN_EXPIRE_MINUTES)
     access_token = create_access_token(
@@ -0,0 +1,82 @@
+import time
+from collections import OrderedDict
+from typing import NamedTuple, Optional
+
+import config
+
+
+class Principal(NamedTuple):
+    """ Snapshot of the authenticated user. Balance is not cached,
+        handlers that change it have to load a fresh row """
+    id: int
+    username: str
+    email: Optional[str]
+    use_fixed_balance: bool
+    fixed_balance: float
+    is_admin: bool
+
+    @classmethod
+    def from_user(cls, user) -> 'Principal':
+        return cls(user.id, user.username, user.email, user.use_fixed_balance, user.fixed_balance, user.is_admin)
+
+
+class PrincipalCache:
+    """
+    Bounded LRU cache of decoded token claims and user snapshots keyed by token.
+    Entries live until the token expires or `ttl` seconds pass, whichever comes first.
+    Invalidation of other workers goes through `utils.pubsub.hub.invalidate_principal`.
+    """
+
+    def __init__(self, maxsize: int, ttl: int):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries: OrderedDict[str, tuple[float, dict, Principal]] = OrderedDict()
+        self._tokens_by_user: dict[int, set[str]] = {}
+
+    def get(self, token: str) -> Optional[tuple[dict, Principal]]:
+        entry = self._entries.get(token)
+        if entry is None or entry[0] <= time.time():
+            if entry is not None:
+                self._remove(token)
+            self.misses += 1
+            return None
+        self._entries.move_to_end(token)
+        self.hits += 1
+        return entry[1], entry[2]
+
+    def set(self, token: str, claims: dict, principal: Principal):
+        if self.maxsize <= 0 or self.ttl <= 0:
+            return
+        expires = time.time() + self.ttl
+        if claims.get('exp'):
+            expires = min(expires, claims['exp'])
+        if token in self._entries:
+            self._remove(token)
+        self._entries[token] = (expires, claims, principal)
+        self._tokens_by_user.setdefault(principal.id, set()).add(token)
+        while len(self._entries) > self.maxsize:
+            self._remove(next(iter(self._entries)))
+
+    def invalidate_user(self, user_id: int):
+        for token in self._tokens_by_user.pop(user_id, ()):
+            self._entries.pop(token, None)
+
+    def clear(self):
+        self._entries.clear()
+        self._tokens_by_user.clear()
+
+    def stats(self) -> dict:
+        return {'size': len(self._entries), 'hits': self.hits, 'misses': self.misses}
+
+    def _remove(self, token: str):
+        _, _, principal = self._entries.pop(token)
+        tokens = self._tokens_by_user.get(principal.id)
+        if tokens is not None:
+            tokens.discard(token)
+            if not tokens:
+                del self._tokens_by_user[principal.id]
+
+
+principal_cache = PrincipalCache(config.AUTH_CACHE_SIZE, config.AUTH_CACHE_TTL)
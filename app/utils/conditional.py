@@ -0,0 +1,38 @@
+from datetime import datetime, timezone
+from email.utils import format_datetime, parsedate_to_datetime
+from typing import NamedTuple, Optional
+
+from fastapi import Request
+
+
+class DataVersion(NamedTuple):
+    """ Version of everything the user owns. It's bumped by every write, so it identifies list responses """
+    user_id: int
+    version: int
+    modified: Optional[datetime]
+
+    @property
+    def etag(self) -> str:
+        return f'W/"{self.user_id}-{self.version}"'
+
+    def headers(self) -> dict:
+        headers = {'ETag': self.etag, 'Cache-Control': 'private, no-cache'}
+        if self.modified:
+            headers['Last-Modified'] = format_datetime(self.modified.astimezone(timezone.utc), usegmt=True)
+        return headers
+
+    def is_not_modified(self, request: Request) -> bool:
+        """ If-None-Match takes precedence over If-Modified-Since as RFC 7232 requires """
+        if_none_match = request.headers.get('if-none-match')
+        if if_none_match is not None:
+            tags = {tag.strip().replace('W/', '', 1) for tag in if_none_match.split(',')}
+            return '*' in tags or self.etag.replace('W/', '', 1) in tags
+        if_modified_since = request.headers.get('if-modified-since')
+        if if_modified_since and self.modified:
+            try:
+                since = parsedate_to_datetime(if_modified_since)
+            except (TypeError, ValueError):
+                return False
+            # Header has seconds precision, so an echoed Last-Modified equals the truncated time
+            return self.modified.replace(microsecond=0) <= since
+        return False
@@ -1,21 +1,84 @@
+import time
+from contextvars import ContextVar
+from typing import Type
+
+from tortoise import Model
+from tortoise.backends.base.client import BaseTransactionWrapper
+from tortoise.transactions import current_transaction_map
+
 import config
 
 
+PRIMARY = 'default'
+REPLICA = 'replica'
+
+
+def _credentials(host: str, port: int, database: str, min_size: int, max_size: int) -> dict:
+    return {
+        'database': database,
+        'host': host,
+        'password': config.DB_PASSWORD,
+        'port': port,
+        'user': config.DB_USER,
+        'minsize': min_size,
+        'maxsize': max_size,
+        'statement_cache_size': config.DB_STATEMENT_CACHE_SIZE,
+    }
+
+
 TORTOISE_ORM = {
-    'connections': {'default': {
+    'connections': {PRIMARY: {
         'engine': 'tortoise.backends.asyncpg',
-        'credentials': {
-            'database': config.DB_NAME,
-            'host': config.DB_HOST,
-            'password': config.DB_PASSWORD,
-            'port': '5432',
-            'user': config.DB_USER
-        }
+        'credentials': _credentials(config.DB_HOST, config.DB_PORT, config.DB_NAME,
+                                    config.DB_POOL_MIN_SIZE, config.DB_POOL_MAX_SIZE)
     }},
     'apps': {
         'models': {
             'models': ['db.models', 'aerich.models'],
-            'default_connection': 'default'
+            'default_connection': PRIMARY
         }
     }
 }
+
+if config.DB_REPLICA_HOST:
+    TORTOISE_ORM['connections'][REPLICA] = {
+        'engine': 'tortoise.backends.asyncpg',
+        'credentials': _credentials(config.DB_REPLICA_HOST, config.DB_REPLICA_PORT, config.DB_REPLICA_NAME,
+                                    config.DB_REPLICA_POOL_MIN_SIZE, config.DB_REPLICA_POOL_MAX_SIZE)
+    }
+    TORTOISE_ORM['routers'] = ['utils.database.ReplicaRouter']
+
+
+read_from_replica: ContextVar[bool] = ContextVar('read_from_replica', default=False)
+
+#: user id -> time.monotonic() of their last write request in this process
+_last_writes: dict[int, float] = {}
+
+
+class ReplicaRouter:
+    """
+    Tortoise router. Reads go to the replica only when the request allowed it with `read_from_replica`
+    and no transaction is open on the primary, all writes go to the primary.
+    """
+    def db_for_read(self, model: Type[Model]) -> str:
+        primary = model._meta.default_connection
+        if read_from_replica.get() and not isinstance(current_transaction_map[primary].get(), BaseTransactionWrapper):
+            return REPLICA
+        return primary
+
+    def db_for_write(self, model: Type[Model]) -> str:
+        return model._meta.default_connection
+
+
+def mark_write(user_id: int):
+    now = time.monotonic()
+    _last_writes[user_id] = now
+    if len(_last_writes) > config.REPLICA_WRITE_TRACK_SIZE:
+        for expired in [key for key, written in _last_writes.items() if now - written > config.REPLICA_STICKY_SECONDS]:
+            del _last_writes[expired]
+
+
+def wrote_recently(user_id: int) -> bool:
+    """ Replica may lag behind, so the user reads from the primary for a while to see their own writes """
+    written = _last_writes.get(user_id)
+    return written is not None and time.monotonic() - written < config.REPLICA_STICKY_SECONDS
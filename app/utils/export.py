@@ -0,0 +1,23 @@
+import csv
+import io
+from typing import AsyncIterator
+
+import orjson
+
+
+async def csv_stream(chunks: AsyncIterator[list[dict]], fields: tuple[str, ...]) -> AsyncIterator[str]:
+    buffer = io.StringIO()
+    writer = csv.DictWriter(buffer, fieldnames=fields, extrasaction='ignore')
+    writer.writeheader()
+    async for rows in chunks:
+        writer.writerows(rows)
+        yield buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue()
+
+
+async def ndjson_stream(chunks: AsyncIterator[list[dict]]) -> AsyncIterator[bytes]:
+    async for rows in chunks:
+        yield b''.join(orjson.dumps(row) + b'\n' for row in rows)
@@ -0,0 +1,34 @@
+import asyncio
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, TypeVar
+
+import config
+
+T = TypeVar('T')
+
+
+class PasswordHasher:
+    """ Runs CPU-heavy password hashing in a bounded thread pool so it never blocks the event loop.
+        bcrypt releases the GIL, so up to `workers` hashes run in parallel and the rest wait in the queue """
+
+    def __init__(self, workers: int):
+        self.workers = workers
+        self.in_flight = 0
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix='password-hash')
+
+    @property
+    def queue_depth(self) -> int:
+        return max(0, self.in_flight - self.workers)
+
+    async def run(self, func: Callable[..., T], *args) -> T:
+        self.in_flight += 1
+        try:
+            return await asyncio.get_running_loop().run_in_executor(self._executor, func, *args)
+        finally:
+            self.in_flight -= 1
+
+    def stats(self) -> dict:
+        return {'workers': self.workers, 'in_flight': self.in_flight, 'queue_depth': self.queue_depth}
+
+
+password_hasher = PasswordHasher(config.PASSWORD_HASH_WORKERS)
@@ -0,0 +1,179 @@
+import asyncio
+import time
+import uuid
+from contextlib import asynccontextmanager
+from email.message import EmailMessage
+from typing import AsyncIterator, Optional
+
+import aiosmtplib
+from tortoise import timezone
+
+from db.models import MailBroadcast
+import config
+
+
+class RateLimiter:
+    """ Spaces calls out so that no more than `rate` of them pass per second. rate <= 0 disables the limit """
+    def __init__(self, rate: float):
+        self.interval = 1 / rate if rate > 0 else 0
+        self._next = 0.0
+
+    async def wait(self):
+        if not self.interval:
+            return
+        now = time.monotonic()
+        slot = max(now, self._next)
+        self._next = slot + self.interval
+        if slot > now:
+            await asyncio.sleep(slot - now)
+
+
+class SMTPPool:
+    """
+    Keeps up to `size` logged in SMTP connections open between messages.
+    A connection which raised during sending is closed and replaced by a new one on the next acquire.
+    """
+    def __init__(self, size: int, hostname: str, port: int, username: Optional[str] = None,
+                 password: Optional[str] = None, use_tls: bool = False, start_tls: bool = False):
+        self.size = size
+        self.hostname = hostname
+        self.port = port
+        self.username = username
+        self.password = password
+        self.use_tls = use_tls
+        self.start_tls = start_tls
+        self._idle: list[aiosmtplib.SMTP] = []
+        self._semaphore: Optional[asyncio.Semaphore] = None
+        self._loop = None
+        self.opened = 0
+
+    def _get_semaphore(self) -> asyncio.Semaphore:
+        loop = asyncio.get_event_loop()
+        if self._loop is not loop:  # connections and semaphore can't be shared between event loops
+            self._idle = []
+            self._semaphore = asyncio.Semaphore(self.size)
+            self._loop = loop
+        return self._semaphore
+
+    async def _connect(self) -> aiosmtplib.SMTP:
+        smtp = aiosmtplib.SMTP(hostname=self.hostname, port=self.port,
+                               use_tls=self.use_tls, start_tls=self.start_tls)
+        await smtp.connect()
+        if self.username:
+            await smtp.login(self.username, self.password)
+        self.opened += 1
+        return smtp
+
+    @asynccontextmanager
+    async def connection(self) -> AsyncIterator[aiosmtplib.SMTP]:
+        async with self._get_semaphore():
+            smtp = self._idle.pop() if self._idle else await self._connect()
+            try:
+                yield smtp
+            except Exception:
+                smtp.close()
+                raise
+            self._idle.append(smtp)
+
+    async def close(self):
+        idle, self._idle = self._idle, []
+        for smtp in idle:
+            try:
+                await smtp.quit()
+            except aiosmtplib.SMTPException:
+                smtp.close()
+
+
+class Mailer:
+    max_errors = 100  #: failures kept per broadcast, older ones are dropped
+
+    def __init__(self, pool: SMTPPool, rate: float, sender: str):
+        self.pool = pool
+        self.limiter = RateLimiter(rate)
+        self.sender = sender
+        self.running = 0  #: broadcasts sent by this process
+
+    def build_message(self, email_to: str, subject: str, body: str, subtype: str = 'html') -> EmailMessage:
+        message = EmailMessage()
+        message['From'] = self.sender
+        message['To'] = email_to
+        message['Subject'] = subject
+        message.set_content(body, subtype=subtype)
+        return message
+
+    async def send(self, email_to: str, subject: str, body: str, subtype: str = 'html'):
+        message = self.build_message(email_to, subject, body, subtype)
+        await self.limiter.wait()
+        try:
+            async with self.pool.connection() as smtp:
+                await smtp.send_message(message)
+        except aiosmtplib.SMTPServerDisconnected:  # idle connection was dropped by the server, retry once
+            async with self.pool.connection() as smtp:
+                await smtp.send_message(message)
+
+    async def create_job(self, total: int) -> MailBroadcast:
+        return await MailBroadcast.create(id=uuid.uuid4().hex, total=total)
+
+    async def get_job(self, job_id: str) -> Optional[MailBroadcast]:
+        return await MailBroadcast.get_or_none(id=job_id)
+
+    def add_error(self, job: MailBroadcast, email: str, error: Exception):
+        job.failed += 1
+        job.errors.append({'email': email, 'error': str(error)})
+        if len(job.errors) > self.max_errors:
+            del job.errors[0]
+
+    async def broadcast(self, job: MailBroadcast, recipients: AsyncIterator[list[str]], subject: str, body: str,
+                        subtype: str = 'html'):
+        """
+        Sends `body` to every address yielded by `recipients` chunk by chunk.
+        One worker per pooled connection pulls addresses from a bounded queue,
+        so only about one chunk of recipients is held in memory at a time.
+        Progress of the job is saved after every chunk.
+        """
+        queue = asyncio.Queue(maxsize=config.MAIL_CHUNK_SIZE)
+
+        async def worker():
+            while True:
+                email = await queue.get()
+                try:
+                    if email is None:
+                        return
+                    await self.send(email, subject, body, subtype)
+                    job.sent += 1
+                except Exception as error:
+                    self.add_error(job, email, error)
+                finally:
+                    queue.task_done()
+
+        job.status = 'running'
+        await job.save(update_fields=['status'])
+        self.running += 1
+        workers = [asyncio.ensure_future(worker()) for _ in range(self.pool.size)]
+        try:
+            async for chunk in recipients:
+                for email in chunk:
+                    await queue.put(email)
+                await job.save(update_fields=['sent', 'failed', 'errors'])
+            for _ in workers:
+                await queue.put(None)
+            await asyncio.gather(*workers)
+            job.status = 'finished'
+        except Exception:
+            job.status = 'failed'
+            for task in workers:
+                task.cancel()
+            raise
+        finally:
+            self.running -= 1
+            job.finished = timezone.now()
+            await job.save(update_fields=['status', 'sent', 'failed', 'errors', 'finished'])
+
+
+mailer = Mailer(
+    SMTPPool(config.MAIL_POOL_SIZE, config.MAIL_SERVER, int(config.MAIL_PORT),
+             username=config.MAIL_USERNAME or None, password=config.MAIL_PASSWORD,
+             use_tls=config.MAIL_SSL, start_tls=config.MAIL_TLS),
+    rate=config.MAIL_RATE_LIMIT,
+    sender=f'{config.MAIL_FROM_NAME} <{config.MAIL_FROM}>'
+)
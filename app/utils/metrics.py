@@ -0,0 +1,204 @@
+import time
+from bisect import bisect_left
+from contextvars import ContextVar
+from functools import wraps
+from typing import Callable, Iterable, Optional
+
+from starlette.background import BackgroundTask
+from tortoise.backends.base.client import BaseDBAsyncClient, ConnectionWrapper, PoolConnectionWrapper
+
+
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100)
+DB_METHODS = ('execute_query', 'execute_query_dict', 'execute_insert', 'execute_many', 'execute_script')
+POOL_WAIT_HALF_LIFE = 1.0  #: seconds, without new acquires the average pool wait halves this often
+
+
+class Histogram:
+    """ Cumulative and counted only on export, observe() is one bisect and two additions """
+    __slots__ = ('buckets', 'counts', 'sum')
+
+    def __init__(self, buckets: tuple):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.sum = 0.0
+
+    def observe(self, value: float):
+        self.counts[bisect_left(self.buckets, value)] += 1
+        self.sum += value
+
+
+class RequestStats:
+    __slots__ = ('queries', 'query_time')
+
+    def __init__(self):
+        self.queries = 0
+        self.query_time = 0.0
+
+
+request_stats: ContextVar[Optional[RequestStats]] = ContextVar('request_stats', default=None)
+
+
+class RouteMetrics:
+    """ Everything recorded for one method and route, so a request costs a single dict lookup """
+    __slots__ = ('statuses', 'latency', 'queries', 'query_time')
+
+    def __init__(self):
+        self.statuses: dict[int, int] = {}
+        self.latency = Histogram(LATENCY_BUCKETS)
+        self.queries = Histogram(QUERY_COUNT_BUCKETS)
+        self.query_time = Histogram(LATENCY_BUCKETS)
+
+
+class Metrics:
+    def __init__(self):
+        self.in_flight = 0
+        self.in_background = 0  #: background tasks started after a response was sent
+        self.routes: dict[tuple[str, str], RouteMetrics] = {}
+        self.db_queries = 0
+        self.db_query_time = 0.0
+        self.pool_acquires = 0
+        self.pool_wait_time = 0.0
+        self._pool_wait = 0.0  #: moving average, read it with recent_pool_wait()
+        self._pool_wait_updated = 0.0
+        self.shed = 0
+        self.collectors: dict[str, tuple[str, Callable[[], float]]] = {}
+
+    def observe_request(self, method: str, route: str, status: int, elapsed: float, stats: RequestStats):
+        route_metrics = self.routes.get((method, route))
+        if route_metrics is None:
+            route_metrics = self.routes[(method, route)] = RouteMetrics()
+        statuses = route_metrics.statuses
+        statuses[status] = statuses.get(status, 0) + 1
+        # Histogram.observe() inlined, a method call costs as much as the update itself
+        latency, queries, query_time = route_metrics.latency, route_metrics.queries, route_metrics.query_time
+        latency.counts[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+        latency.sum += elapsed
+        queries.counts[bisect_left(QUERY_COUNT_BUCKETS, stats.queries)] += 1
+        queries.sum += stats.queries
+        query_time.counts[bisect_left(LATENCY_BUCKETS, stats.query_time)] += 1
+        query_time.sum += stats.query_time
+
+    def observe_query(self, elapsed: float):
+        self.db_queries += 1
+        self.db_query_time += elapsed
+        stats = request_stats.get()
+        if stats is not None:
+            stats.queries += 1
+            stats.query_time += elapsed
+
+    def observe_pool_wait(self, elapsed: float):
+        self.pool_acquires += 1
+        self.pool_wait_time += elapsed
+        now = time.monotonic()
+        self._pool_wait = self.recent_pool_wait(now) * 0.9 + elapsed * 0.1
+        self._pool_wait_updated = now
+
+    def recent_pool_wait(self, now: Optional[float] = None) -> float:
+        """ Average time to get a DB connection. Decays with time, so it recovers when load is shed """
+        elapsed = (now or time.monotonic()) - self._pool_wait_updated
+        return self._pool_wait * 0.5 ** (elapsed / POOL_WAIT_HALF_LIFE)
+
+    def add_collector(self, name: str, function: Callable[[], float], type: str = 'gauge'):
+        """ Value of `function` is read only when metrics are rendered """
+        self.collectors[name] = (type, function)
+
+    def render(self) -> str:
+        """ Prometheus text exposition format """
+        routes = sorted(self.routes.items())
+        lines = [
+            '# TYPE http_requests_in_flight gauge', f'http_requests_in_flight {self.in_flight}',
+            '# TYPE http_background_tasks_in_flight gauge', f'http_background_tasks_in_flight {self.in_background}',
+            '# TYPE http_requests_total counter',
+        ]
+        for (method, route), route_metrics in routes:
+            for status, count in sorted(route_metrics.statuses.items()):
+                lines.append(f'http_requests_total{{method="{method}",route="{route}",status="{status}"}} {count}')
+        for name, attribute in (('http_request_duration_seconds', 'latency'),
+                                ('http_request_db_queries', 'queries'),
+                                ('http_request_db_duration_seconds', 'query_time')):
+            lines.append(f'# TYPE {name} histogram')
+            for (method, route), route_metrics in routes:
+                lines.extend(_render_histogram(name, f'method="{method}",route="{route}"',
+                                               getattr(route_metrics, attribute)))
+        lines += [
+            '# TYPE db_queries_total counter', f'db_queries_total {self.db_queries}',
+            '# TYPE db_query_duration_seconds_total counter', f'db_query_duration_seconds_total {self.db_query_time}',
+            '# TYPE db_pool_acquires_total counter', f'db_pool_acquires_total {self.pool_acquires}',
+            '# TYPE db_pool_wait_seconds_total counter', f'db_pool_wait_seconds_total {self.pool_wait_time}',
+            '# TYPE db_pool_wait_seconds gauge', f'db_pool_wait_seconds {self.recent_pool_wait()}',
+            '# TYPE http_requests_shed_total counter', f'http_requests_shed_total {self.shed}',
+        ]
+        for name, (type, function) in sorted(self.collectors.items()):
+            lines += [f'# TYPE {name} {type}', f'{name} {function()}']
+        return '\n'.join(lines) + '\n'
+
+
+def _render_histogram(name: str, labels: str, histogram: Histogram) -> Iterable[str]:
+    cumulative = 0
+    for bound, count in zip(histogram.buckets + ('+Inf', ), histogram.counts):
+        cumulative += count
+        yield f'{name}_bucket{{{labels},le="{bound}"}} {cumulative}'
+    yield f'{name}_sum{{{labels}}} {histogram.sum}'
+    yield f'{name}_count{{{labels}}} {cumulative}'
+
+
+def _instrument(method: Callable) -> Callable:
+    @wraps(method)
+    async def execute(*args, **kwargs):
+        started = time.perf_counter()
+        try:
+            return await method(*args, **kwargs)
+        finally:
+            metrics.observe_query(time.perf_counter() - started)
+    execute.instrumented = True
+    return execute
+
+
+def _instrument_acquire(method: Callable) -> Callable:
+    @wraps(method)
+    async def acquire(self):
+        started = time.perf_counter()
+        connection = await method(self)
+        metrics.observe_pool_wait(time.perf_counter() - started)
+        return connection
+    acquire.instrumented = True
+    return acquire
+
+
+def instrument_db():
+    """
+    Wraps execute methods of every loaded Tortoise backend client and connection acquiring
+    (pool for asyncpg, lock for sqlite). Safe to call more than once
+    """
+    for wrapper_class in (ConnectionWrapper, PoolConnectionWrapper):
+        if not getattr(wrapper_class.__aenter__, 'instrumented', False):
+            wrapper_class.__aenter__ = _instrument_acquire(wrapper_class.__aenter__)
+    classes = list(BaseDBAsyncClient.__subclasses__())
+    while classes:
+        client_class = classes.pop()
+        classes.extend(client_class.__subclasses__())
+        for name in DB_METHODS:
+            method = client_class.__dict__.get(name)
+            if method is not None and not getattr(method, 'instrumented', False):
+                setattr(client_class, name, _instrument(method))
+
+
+def instrument_background_tasks():
+    """ Counts running BackgroundTasks items. Safe to call more than once """
+    call = BackgroundTask.__call__
+    if getattr(call, 'instrumented', False):
+        return
+
+    @wraps(call)
+    async def counted_call(self):
+        metrics.in_background += 1
+        try:
+            await call(self)
+        finally:
+            metrics.in_background -= 1
+    counted_call.instrumented = True
+    BackgroundTask.__call__ = counted_call
+
+
+metrics = Metrics()
@@ -0,0 +1,130 @@
+import time
+import uuid
+
+from starlette.responses import JSONResponse
+from starlette.types import ASGIApp, Receive, Scope, Send, Message
+
+from logger import log, request_id
+from utils.metrics import metrics, request_stats, RequestStats
+import config
+
+
+class RequestLogMiddleware:
+    """
+    Gives every request an id (X-Request-ID from the client or a new one), makes it available
+    to log records of the request and logs one access line with status and latency.
+    Pure ASGI, so streaming responses are not buffered.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        headers = dict(scope['headers'])
+        current_id = headers.get(b'x-request-id', b'').decode('latin-1')[:64] or uuid.uuid4().hex
+        token = request_id.set(current_id)
+        started = time.perf_counter()
+        status = 500
+
+        async def send_with_id(message: Message):
+            nonlocal status
+            if message['type'] == 'http.response.start':
+                status = message['status']
+                message['headers'] = list(message.get('headers', [])) + [(b'x-request-id', current_id.encode())]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_with_id)
+        finally:
+            log.info('request', extra={'method': scope['method'], 'path': scope['path'], 'status': status,
+                                       'latency_ms': round((time.perf_counter() - started) * 1000, 3)})
+            request_id.reset(token)
+
+
+class MetricsMiddleware:
+    """
+    Records latency, DB query count and time per route into utils.metrics.
+    Latency ends with the last body chunk, so background tasks of the request are not included,
+    their queries are.
+    """
+    def __init__(self, app: ASGIApp):
+        self.app = app
+        self._routes = {}
+
+    def _route(self, scope: Scope) -> str:
+        """ Path template of the matched route, so /detail/1 and /detail/2 share metrics """
+        endpoint = scope.get('endpoint')
+        if endpoint is None:
+            return 'unmatched'
+        route = self._routes.get(endpoint)
+        if route is None:
+            route = next((route.path for route in scope['app'].routes
+                          if getattr(route, 'endpoint', None) is endpoint), 'unmatched')
+            self._routes[endpoint] = route
+        return route
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http':
+            await self.app(scope, receive, send)
+            return
+
+        stats = RequestStats()
+        token = request_stats.set(stats)
+        metrics.in_flight += 1
+        started = time.perf_counter()
+        elapsed = 0.0
+        status = 500
+
+        async def send_and_measure(message: Message):
+            nonlocal status, elapsed
+            if message['type'] == 'http.response.start':
+                status = message['status']
+            elif not message.get('more_body'):
+                elapsed = time.perf_counter() - started
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_and_measure)
+        finally:
+            metrics.in_flight -= 1
+            metrics.observe_request(scope['method'], self._route(scope), status,
+                                    elapsed or time.perf_counter() - started, stats)
+            request_stats.reset(token)
+
+
+class LoadSheddingMiddleware:
+    """
+    Answers 503 with Retry-After before routing once SHED_MAX_IN_FLIGHT requests are in progress
+    or getting a DB connection takes longer than SHED_MAX_POOL_WAIT on average.
+    Rejecting early keeps latency of the admitted requests bounded instead of queueing everyone.
+    Long-lived streams and metrics are `exempt`, they are neither counted nor shed
+    """
+    def __init__(self, app: ASGIApp, exempt: tuple = ()):
+        self.app = app
+        self.exempt = exempt
+        self.in_flight = 0
+
+    def overloaded(self) -> bool:
+        if config.SHED_MAX_IN_FLIGHT and self.in_flight >= config.SHED_MAX_IN_FLIGHT:
+            return True
+        return bool(config.SHED_MAX_POOL_WAIT) and metrics.recent_pool_wait() > config.SHED_MAX_POOL_WAIT
+
+    async def __call__(self, scope: Scope, receive: Receive, send: Send):
+        if scope['type'] != 'http' or scope['path'].startswith(self.exempt):
+            await self.app(scope, receive, send)
+            return
+        if self.overloaded():
+            metrics.shed += 1
+            response = JSONResponse({'detail': 'Server is overloaded'}, status_code=503,
+                                    headers={'Retry-After': str(config.SHED_RETRY_AFTER)})
+            await response(scope, receive, send)
+            return
+
+        self.in_flight += 1
+        try:
+            await self.app(scope, receive, send)
+        finally:
+            self.in_flight -= 1
@@ -0,0 +1,137 @@
+import asyncio
+from collections import defaultdict
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Callable, Optional
+
+import asyncpg
+from tortoise import Tortoise
+
+import config
+from utils.cache import principal_cache
+from utils.database import TORTOISE_ORM, PRIMARY
+from logger import log
+
+
+MESSAGES = 'user_messages'  #: the user may have new messages
+PRINCIPALS = 'user_principals'  #: cached principals of the user are stale
+
+
+class Subscription:
+    """ Flag raised when the subscribed user may have new messages. Notifications carry no payload """
+    def __init__(self, user_id: int):
+        self.user_id = user_id
+        self._event = asyncio.Event()
+
+    def notify(self):
+        self._event.set()
+
+    async def wait(self, timeout: Optional[float] = None) -> bool:
+        try:
+            await asyncio.wait_for(self._event.wait(), timeout)
+        except asyncio.TimeoutError:
+            return False
+        self._event.clear()
+        return True
+
+
+class MemoryBackend:
+    """ Delivers notifications inside current process only """
+    def __init__(self):
+        self.dispatch: Optional[Callable[[str, int], None]] = None
+
+    async def start(self, dispatch: Callable[[str, int], None]):
+        self.dispatch = dispatch
+
+    async def stop(self):
+        self.dispatch = None
+
+    async def publish(self, channel: str, user_ids: set[int]):
+        if self.dispatch:
+            for user_id in user_ids:
+                self.dispatch(channel, user_id)
+
+
+class PostgresBackend:
+    """
+    Shares notifications between workers and celery through LISTEN/NOTIFY.
+    Publishing goes through the ORM connection, so it works in processes which never call start().
+    """
+    channels = (MESSAGES, PRINCIPALS)
+
+    def __init__(self):
+        self._connection = None
+
+    async def start(self, dispatch: Callable[[str, int], None]):
+        credentials = TORTOISE_ORM['connections'][PRIMARY]['credentials']
+        self._connection = await asyncpg.connect(
+            host=credentials['host'], port=int(credentials['port']), user=credentials['user'],
+            password=credentials['password'], database=credentials['database']
+        )
+        for channel in self.channels:
+            await self._connection.add_listener(
+                channel, lambda connection, pid, channel, payload: dispatch(channel, int(payload)))
+
+    async def stop(self):
+        if self._connection:
+            await self._connection.close()
+            self._connection = None
+
+    async def publish(self, channel: str, user_ids: set[int]):
+        connection = Tortoise.get_connection(PRIMARY)
+        for user_id in user_ids:
+            await connection.execute_query('SELECT pg_notify($1, $2)', [channel, str(user_id)])
+
+
+backends = {
+    'memory': MemoryBackend,
+    'postgres': PostgresBackend,
+}
+
+
+class MessageHub:
+    """ Fans notifications about new messages out to subscriptions of the current process
+        and drops cached principals which changed in any process """
+    def __init__(self, backend):
+        self.backend = backend
+        self.subscriptions: dict[int, set[Subscription]] = defaultdict(set)
+
+    async def start(self):
+        await self.backend.start(self.dispatch)
+
+    async def stop(self):
+        await self.backend.stop()
+
+    def dispatch(self, channel: str, user_id: int):
+        if channel == PRINCIPALS:
+            principal_cache.invalidate_user(user_id)
+            return
+        for subscription in self.subscriptions.get(user_id, ()):
+            subscription.notify()
+
+    async def publish(self, *user_ids: int):
+        try:
+            await self.backend.publish(MESSAGES, set(user_ids))
+        except Exception as error:  # message rows are already saved, subscribers will get them on the next wakeup
+            log.error(f'Failed to publish messages notification: {error}')
+
+    async def invalidate_principal(self, user_id: int):
+        """ Drops cached principals of the user here at once and in other workers when they get the notification """
+        principal_cache.invalidate_user(user_id)
+        try:
+            await self.backend.publish(PRINCIPALS, {user_id})
+        except Exception as error:  # other workers fall back to the cache ttl
+            log.error(f'Failed to publish principal invalidation: {error}')
+
+    @asynccontextmanager
+    async def subscribe(self, user_id: int) -> AsyncIterator[Subscription]:
+        subscription = Subscription(user_id)
+        self.subscriptions[user_id].add(subscription)
+        try:
+            yield subscription
+        finally:
+            self.subscriptions[user_id].discard(subscription)
+            if not self.subscriptions[user_id]:
+                del self.subscriptions[user_id]
+
+
+hub = MessageHub(backends[config.PUBSUB_BACKEND]())
@@ -0,0 +1,83 @@
+import time
+from collections import OrderedDict
+from typing import Optional
+
+from tortoise import Tortoise
+
+from utils.database import PRIMARY
+import config
+
+
+class MemoryBackend:
+    """ Token buckets of this process. With several workers every worker allows the full rate """
+    def __init__(self, maxsize: int = 100000):
+        self.maxsize = maxsize
+        #: key -> [tokens, time.monotonic() of the last refill], least recently used first
+        self._buckets: OrderedDict[str, list[float]] = OrderedDict()
+
+    async def acquire(self, key: str, rate: float, burst: int) -> float:
+        now = time.monotonic()
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= self.maxsize:
+                self._buckets.popitem(last=False)  # least recently used key, at worst it gets a full bucket again
+            bucket = self._buckets[key] = [burst, now]
+        else:
+            self._buckets.move_to_end(key)  # busy keys are never the ones evicted
+        tokens = min(burst, bucket[0] + (now - bucket[1]) * rate)
+        bucket[1] = now
+        if tokens >= 1:
+            bucket[0] = tokens - 1
+            return 0.0
+        bucket[0] = tokens
+        return (1 - tokens) / rate
+
+
+class PostgresBackend:
+    """
+    Token buckets shared by all workers, one upsert per check. The table is created by migration 8,
+    it is UNLOGGED: buckets are not worth WAL writes and losing them on a crash only resets limits
+    """
+    table = 'rate_limit_bucket'
+    refill = 'LEAST($3, bucket.tokens + $2 * EXTRACT(EPOCH FROM clock_timestamp() - bucket.updated))'
+    query = f'''
+        INSERT INTO {table} AS bucket (key, tokens, allowed, updated) VALUES ($1, $3 - 1, TRUE, clock_timestamp())
+        ON CONFLICT (key) DO UPDATE SET
+            tokens = CASE WHEN {refill} >= 1 THEN {refill} - 1 ELSE {refill} END,
+            allowed = {refill} >= 1,
+            updated = clock_timestamp()
+        RETURNING allowed, tokens
+    '''
+
+    async def acquire(self, key: str, rate: float, burst: int) -> float:
+        _, rows = await Tortoise.get_connection(PRIMARY).execute_query(self.query, [key, float(rate), float(burst)])
+        allowed, tokens = rows[0]
+        return 0.0 if allowed else (1 - tokens) / rate
+
+
+class RateLimiter:
+    """ Per-user token buckets by route group, `limits` maps a group to (requests per second, burst) """
+    def __init__(self, backend, limits: dict[str, tuple[float, int]]):
+        self.backend = backend
+        self.limits = limits
+        self.limited = 0
+
+    async def acquire(self, group: str, user_id: int) -> float:
+        """ Takes a token of the user. Returns 0 if there was one, otherwise seconds until there will be """
+        rate, burst = self.limits.get(group, (0, 0))
+        if rate <= 0:
+            return 0.0
+        retry_after = await self.backend.acquire(f'{group}:{user_id}', rate, burst)
+        if retry_after:
+            self.limited += 1
+        return retry_after
+
+
+def get_backend(name: Optional[str] = None):
+    return PostgresBackend() if (name or config.RATE_LIMIT_BACKEND) == 'postgres' else MemoryBackend()
+
+
+rate_limiter = RateLimiter(get_backend(), {
+    'read': (config.RATE_LIMIT_READ, config.RATE_LIMIT_READ_BURST),
+    'write': (config.RATE_LIMIT_WRITE, config.RATE_LIMIT_WRITE_BURST),
+})
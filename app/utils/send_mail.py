@@ -1,9 +1,9 @@
 from fastapi import BackgroundTasks
-from fastapi_mail import FastMail, MessageSchema, ConnectionConfig
-
-import config
 
+from utils.mailer import mailer
+from utils.pubsub import hub
 from db.models import User, Message
+from db.crud import touch_user
 
 
 html = """
@@ -11,43 +11,9 @@ html = """
     <p>You have reached your balance</p>
 """
 
-conf = ConnectionConfig(
-    MAIL_USERNAME=config.MAIL_USERNAME,
-    MAIL_PASSWORD=config.MAIL_PASSWORD,
-    MAIL_FROM=config.MAIL_FROM,
-    MAIL_PORT=config.MAIL_PORT,
-    MAIL_SERVER=config.MAIL_SERVER,
-    MAIL_FROM_NAME=config.MAIL_FROM_NAME,
-    MAIL_TLS=True,
-    MAIL_SSL=False,
-    USE_CREDENTIALS=True
-)
-
 
 async def send_email(subject: str, email_to: str):
-    message = MessageSchema(
-        subject=subject,
-        recipients=[email_to],
-        html=html,
-        subtype='html',
-    )
-    fm = FastMail(conf)
-    await fm.send_message(message)
-
-
-def send_email_background(background_tasks: BackgroundTasks,
-                          subject: str, email_to: str, body: str):
-    message = MessageSchema(
-        subject=subject,
-        recipients=[email_to],
-        body=body,
-        html=html,
-        subtype='html',
-    )
-    fm = FastMail(conf)
-    background_tasks.add_task(
-        fm.send_message, message
-    )
+    await mailer.send(email_to, subject, html)
 
 
 async def send_message(user_id: int, text: str, background_tasks: BackgroundTasks):
@@ -55,6 +21,8 @@ async def send_message(user_id: int, text: str, background_tasks: BackgroundTask
 
     async def create_message():
         await Message.create(receiver=receiver, text=text)
+        await touch_user(receiver.id)
+        await hub.publish(receiver.id)
 
     background_tasks.add_task(
         create_message
@@ -0,0 +1,59 @@
+from pathlib import Path
+
+from aerich.models import Aerich
+
+from db.models import User
+from utils.authentication import get_password_hash_async
+from utils.cache import principal_cache
+from utils.hashing import password_hasher
+from utils.mailer import mailer
+from utils.metrics import metrics
+from utils.pubsub import hub
+from utils.ratelimit import rate_limiter
+import logger
+
+
+MIGRATIONS_DIR = Path(__file__).resolve().parent.parent / 'migrations' / 'models'
+
+#: seconds spent on module imports and on startup handlers of main.app, filled by main.py
+timings: dict[str, float] = {}
+
+
+def register_collectors():
+    """ Gauges and counters of other modules read when /admin/metrics is rendered, called by startup handlers """
+    metrics.add_collector('app_import_seconds', lambda: timings.get('import', 0))
+    metrics.add_collector('app_startup_seconds', lambda: timings.get('startup', 0))
+    metrics.add_collector('auth_cache_entries', lambda: principal_cache.stats()['size'])
+    metrics.add_collector('auth_cache_hits_total', lambda: principal_cache.hits, 'counter')
+    metrics.add_collector('auth_cache_misses_total', lambda: principal_cache.misses, 'counter')
+    metrics.add_collector('password_hash_in_flight', lambda: password_hasher.in_flight)
+    metrics.add_collector('password_hash_queue_depth', lambda: password_hasher.queue_depth)
+    metrics.add_collector('log_queue_depth', lambda: logger.log.queue.qsize())
+    metrics.add_collector('mail_broadcasts_running', lambda: mailer.running)  #: per worker, summed by Prometheus
+    metrics.add_collector('rate_limited_requests_total', lambda: rate_limiter.limited, 'counter')
+    metrics.add_collector('message_stream_subscribers',
+                          lambda: sum(len(subscriptions) for subscriptions in hub.subscriptions.values()))
+
+
+def migration_versions() -> list[str]:
+    """ Migration file names in the order aerich applies them, aerich stores these names as versions """
+    return sorted((path.name for path in MIGRATIONS_DIR.glob('*.sql')), key=lambda name: int(name.split('_', 1)[0]))
+
+
+async def check_migrations(app: str = 'models'):
+    """ Replaces schema generation in production, a worker refuses to start on a database behind the code """
+    applied = set(await Aerich.filter(app=app).values_list('version', flat=True))
+    pending = [version for version in migration_versions() if version not in applied]
+    if pending:
+        raise RuntimeError(f'Database is not migrated, pending: {", ".join(pending)}. Run "aerich upgrade"')
+
+
+async def ensure_admin(username: str, password: str, email: str) -> bool:
+    """ Creates the admin if there is none. bcrypt runs only then, not on every worker start """
+    if await User.exists(username=username):
+        return False
+    _, created = await User.get_or_create(
+        username=username,
+        defaults={'email': email, 'is_admin': True, 'password': await get_password_hash_async(password)}
+    )
+    return created
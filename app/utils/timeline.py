@@ -0,0 +1,128 @@
+"""
+Daily running balance and monthly forecast, computed with NumPy over whole columns instead of
+looping over transactions. Days are numbers of days since 1970-01-01
+"""
+from datetime import date
+from typing import Optional
+
+import numpy as np
+
+
+EPOCH_DATE = date(1970, 1, 1)
+
+
+def to_day(value: date) -> int:
+    return (value - EPOCH_DATE).days
+
+
+def to_dates(first_day: int, last_day: int) -> list[date]:
+    """ Dates of the days in [first_day, last_day) """
+    return np.arange(first_day, last_day).astype('datetime64[D]').tolist()
+
+
+def month_start(value: date, months: int = 0) -> date:
+    """ First day of the month `months` after the month of `value` """
+    index = value.year * 12 + value.month - 1 + months
+    return date(index // 12, index % 12 + 1, 1)
+
+
+def to_columns(rows: list[tuple]) -> dict[str, np.ndarray]:
+    """
+    Rows of `crud.get_balance_columns` as arrays: `day` is the planned day of planned transactions
+    and the local day of creation of others, `delta` is the signed sum
+    """
+    days, settled, types, sums = (np.array(column, dtype=np.float64) for column in zip(*rows)) \
+        if rows else np.zeros((4, 0))
+    return {'day': days.astype(np.int64), 'delta': np.where(types > 0, sums, -sums), 'settled': settled > 0}
+
+
+def running_balance(columns: dict[str, np.ndarray], opening: float, start: date, end: Optional[date],
+                    today: date) -> dict:
+    """
+    Balance at the end of every day of [start, end) from the `opening` balance at the start of `start`.
+    Pending planned transactions are not in the balance yet and are projected on their day,
+    overdue ones on `today`. Without `end` the series ends after the last pending transaction
+    """
+    start_day, today_day = to_day(start), to_day(today)
+    settled = columns['settled']
+    days = np.where(settled, columns['day'], np.maximum(columns['day'], today_day))
+    deltas = columns['delta']
+    end_day = to_day(end) if end else max(today_day, days[~settled].max(initial=today_day)) + 1
+
+    inside = (days >= start_day) & (days < end_day)
+    daily = np.bincount(days[inside] - start_day, weights=deltas[inside], minlength=end_day - start_day)
+    return {
+        'start': start,
+        'end': date.fromordinal(EPOCH_DATE.toordinal() + end_day),
+        'dates': to_dates(start_day, end_day),
+        'balance': np.round(opening + np.cumsum(daily), 2).tolist(),
+    }
+
+
+def monthly_history(rows: list[tuple], first_month: date, months: int) -> tuple[list[int], np.ndarray]:
+    """ Rollup rows (year, month, category_id, type, sum) as category ids and a category x month matrix
+        of net sums, month 0 is `first_month` """
+    if not rows:
+        return [], np.zeros((0, months))
+    values = np.array(rows, dtype=np.float64)
+    category_ids, categories = np.unique(values[:, 2].astype(np.int64), return_inverse=True)
+    month_index = (values[:, 0] * 12 + values[:, 1] - 1 - (first_month.year * 12 + first_month.month - 1))
+    history = np.zeros((len(category_ids), months))
+    np.add.at(history, (categories, month_index.astype(np.int64)), np.where(values[:, 3] > 0, 1, -1) * values[:, 4])
+    return category_ids.tolist(), history
+
+
+def forecast(history: np.ndarray, first_month: date, months: int) -> np.ndarray:
+    """
+    Net sums of the next `months` months per category: least squares trend over the history
+    plus the average deviation of the calendar month, once there are two years to average
+    """
+    categories, observed = history.shape
+    x = np.arange(observed)
+    if observed > 1:
+        centered = x - x.mean()
+        slope = (history - history.mean(axis=1, keepdims=True)) @ centered / (centered @ centered)
+    else:
+        slope = np.zeros(categories)
+    intercept = history.mean(axis=1) - slope * x.mean() if observed else np.zeros(categories)
+
+    calendar = (first_month.month - 1 + np.arange(observed + months)) % 12
+    seasonal = np.zeros((categories, 12))
+    if observed >= 24:
+        residual = history - (intercept[:, None] + slope[:, None] * x)
+        months_of_year = np.eye(12)[calendar[:observed]]
+        seasonal = residual @ months_of_year / months_of_year.sum(axis=0)
+
+    future = observed + np.arange(months)
+    return intercept[:, None] + slope[:, None] * future + seasonal[:, calendar[observed:]]
+
+
+def forecast_months(rows: list[tuple], columns: dict[str, np.ndarray], balance: float, today: date,
+                    history_months: int, months: int) -> list[dict]:
+    """
+    Forecast of the `months` months after the current one from settled history of the last
+    `history_months` complete months. Balance of a month is the current balance plus pending
+    planned transactions due by its end plus forecast net sums up to it
+    """
+    current = month_start(today)
+    first_month = month_start(current, -history_months)
+    if rows:
+        first_month = max(first_month, date(*min((year, month) for year, month, *_ in rows), 1))
+    observed = (current.year - first_month.year) * 12 + current.month - first_month.month
+    category_ids, history = monthly_history(rows, first_month, observed)
+    predicted = np.round(forecast(history, first_month, months), 2)
+    net = predicted.sum(axis=0)
+
+    starts = [month_start(current, index + 1) for index in range(months)]
+    ends = np.array([to_day(month_start(start, 1)) for start in starts])
+    pending = ~columns['settled']
+    pending_days, pending_deltas = np.maximum(columns['day'][pending], to_day(today)), columns['delta'][pending]
+    order = np.argsort(pending_days)
+    due = np.concatenate(([0], np.cumsum(pending_deltas[order])))[np.searchsorted(pending_days[order], ends)]
+    balances = np.round(balance + due + np.cumsum(net), 2)
+    return [
+        {'start': start, 'net': round(float(net[index]), 2), 'balance': float(balances[index]),
+         'categories': [{'category_id': category_id, 'net': float(predicted[row, index])}
+                        for row, category_id in enumerate(category_ids)]}
+        for index, start in enumerate(starts)
+    ]